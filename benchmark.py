@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import time
+import logging
+import sys
+import random
+import collections
+import typing
+
+import numpy as np
+
+import settings
+
+#
+# Helpers 🛠
+#
+
+# PMC pages mostly have a few hundred tokens, with a long tail of dense pages.
+_MAX_TOKENS_PER_PAGE = 2000
+
+_FakeDoc = collections.namedtuple("_FakeDoc", ["doc_id"])
+_FakePage = collections.namedtuple("_FakePage", ["page_number", "token_count"])
+
+def _random_page_lengths(rng: random.Random, max_tokens_per_page: int):
+    """Endless page lengths that roughly follow what we see in PMC: mostly full pages, some short
+    ones"""
+    while True:
+        if rng.random() < 0.2:
+            yield rng.randint(1, max(1, max_tokens_per_page // 4))
+        else:
+            length = int(rng.gauss(max_tokens_per_page * 0.6, max_tokens_per_page * 0.2))
+            yield max(1, min(max_tokens_per_page, length))
+
+def _report(name: str, count: int, unit: str, seconds: float):
+    logging.info(
+        "%s: %d %s in %.3f s (%.1f %s/s, %.3f ms each)",
+        name,
+        count,
+        unit,
+        seconds,
+        count / seconds,
+        unit,
+        1000 * seconds / count)
+
+#
+# Benchmarks ⏱
+#
+
+def benchmark_page_pool(model_settings: settings.ModelSettings, slice_count: int):
+    """Times PagePool.get_slice() with a pool of tokens_per_batch / 8 pages"""
+    import with_labels
+
+    rng = random.Random(1337)
+    max_page_pool_size = model_settings.tokens_per_batch // 8
+    doc = _FakeDoc("benchmark")
+    lengths = _random_page_lengths(rng, _MAX_TOKENS_PER_PAGE)
+
+    for smallest_pages in [False, True]:
+        page_pool = with_labels.PagePool()
+        page_number = 0
+        for length in lengths:
+            page_pool.add(doc, _FakePage(page_number, length))
+            page_number += 1
+            if len(page_pool) >= max_page_pool_size:
+                break
+
+        start = time.time()
+        page_count = 0
+        for _ in range(slice_count):
+            slice = page_pool.get_slice(model_settings.tokens_per_batch, smallest_pages)
+            page_count += len(slice)
+            # refill the pool after every slice
+            for length in lengths:
+                page_pool.add(doc, _FakePage(page_number, length))
+                page_number += 1
+                if len(page_pool) >= max_page_pool_size:
+                    break
+        elapsed = time.time() - start
+
+        _report(
+            "PagePool.get_slice(smallest_pages=%s), pool size %d, %d pages" %
+                (smallest_pages, max_page_pool_size, page_count),
+            slice_count,
+            "slices",
+            elapsed)
+
+def _random_documents(rng: np.random.RandomState, count: int):
+    """Featurized documents with random features, and labels on every token"""
+    import dataprep2
+
+    lengths = _random_page_lengths(random.Random(rng.randint(2**31)), _MAX_TOKENS_PER_PAGE)
+    for doc_index in range(count):
+        pages = []
+        for page_number in range(rng.randint(1, 12)):
+            length = next(lengths)
+            pages.append(dataprep2.Page(
+                page_number,
+                612.0,
+                792.0,
+                tokens=None,
+                token_hashes=rng.randint(1, 2**31, length).astype(np.uint32),
+                font_hashes=rng.randint(1, 4096, length).astype(np.uint32),
+                numeric_features=None,
+                scaled_numeric_features=rng.rand(length, 19).astype(np.float32) - 0.5,
+                labels=rng.randint(0, len(dataprep2.POTENTIAL_LABELS), length).astype(np.int8)))
+        yield dataprep2.Document(
+            "benchmark/%d" % doc_index,
+            "%040x" % doc_index,
+            None, None, None, None, None, None,
+            pages)
+
+def benchmark_batch_assembly(model_settings: settings.ModelSettings, batch_count: int):
+    """Times building batches from page slices, with and without reusing buffers"""
+    import with_labels
+
+    rng = np.random.RandomState(1337)
+    docs = list(_random_documents(rng, 1000))
+    page_pool = with_labels.PagePool()
+    for doc in docs:
+        for page in doc.get_relevant_pages():
+            page_pool.add(doc, page)
+    slices = []
+    while len(page_pool) > 0 and len(slices) < batch_count:
+        slices.append(page_pool.get_slice(model_settings.tokens_per_batch))
+    token_count = sum(page.token_count for slice in slices for doc, page in slice)
+
+    variants = [
+        ("new buffers", with_labels.batch_from_page_group, None),
+        ("buffer pool", with_labels.batch_from_page_group,
+            with_labels.BatchBufferPool(model_settings.tokens_per_batch)),
+        ("inference, buffer pool", with_labels.inputs_from_page_group,
+            with_labels.BatchBufferPool(model_settings.tokens_per_batch, include_labels=False))
+    ]
+    for name, make_batch, buffer_pool in variants:
+        start = time.time()
+        for slice in slices:
+            batch = make_batch(model_settings, slice, buffer_pool)
+            if buffer_pool is not None:
+                if make_batch is with_labels.batch_from_page_group:
+                    batch, _ = batch
+                buffer_pool.release(batch)
+        elapsed = time.time() - start
+
+        _report(
+            "%s(%s), %.1f M tokens" % (make_batch.__name__, name, token_count / 1e6),
+            len(slices),
+            "batches",
+            elapsed)
+
+# Random token ids go into an embedding matrix of this size
+_BENCHMARK_VOCAB_SIZE = 10000
+
+class _RandomEmbeddings(object):
+    """Stands in for dataprep2.CombinedEmbeddings when building a Keras model to time"""
+
+    def __init__(self, rng: np.random.RandomState, vocab_size: int, dimensions: int):
+        self.matrix = rng.randn(vocab_size + 1, dimensions).astype(np.float32)
+
+    def vocab_size(self):
+        return self.matrix.shape[0] - 1
+
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    def matrix_for_keras(self):
+        return self.matrix
+
+def _random_numpy_model(rng: np.random.RandomState, model_settings: settings.ModelSettings):
+    """A NumpyModel with the layer sizes of with_labels.model_with_labels(), and random weights"""
+    import numpy_model
+    import with_labels
+
+    def random(*shape):
+        return (rng.randn(*shape) * 0.05).astype(np.float32)
+
+    def lstm(input_size, units):
+        return numpy_model.LstmWeights(
+            random(input_size, 4 * units),
+            random(units, 4 * units),
+            random(4 * units))
+
+    embeddings = _RandomEmbeddings(rng, _BENCHMARK_VOCAB_SIZE, 101)
+    input_size = 8 + 8 + embeddings.dimensions() + 10 + with_labels.NUMERIC_INPUT_COUNT
+    label_count = 7
+    return numpy_model.NumpyModel(
+        random(with_labels.MAX_EMBEDDED_PAGES + 2, 8),
+        random(with_labels.MAX_EMBEDDED_PAGES + 2, 8),
+        embeddings.matrix,
+        random(model_settings.font_hash_size + 1, 10),
+        random(input_size, 1024),
+        random(1024),
+        [(lstm(1024, 512), lstm(1024, 512)), (lstm(1024, 512), lstm(1024, 512))],
+        numpy_model.CrfWeights(
+            random(1024, label_count),
+            random(label_count, label_count),
+            random(label_count),
+            random(label_count),
+            random(label_count))
+    ), embeddings
+
+def _random_model_inputs(
+    rng: np.random.RandomState,
+    model_settings: settings.ModelSettings,
+    batch_count: int,
+    token_embedding_count: int
+) -> typing.List[typing.List[np.ndarray]]:
+    """Model inputs for batches of random pages"""
+    import with_labels
+
+    page_pool = with_labels.PagePool()
+    for doc in _random_documents(rng, 20 * batch_count):
+        for page in doc.get_relevant_pages():
+            page_pool.add(doc, page)
+    batches = []
+    while len(page_pool) > 0 and len(batches) < batch_count:
+        inputs = with_labels.inputs_from_page_group(
+            model_settings,
+            page_pool.get_slice(model_settings.tokens_per_batch))
+        # keep the random token ids within the embedding matrix, and the mask where it is
+        token_inputs = inputs[2]
+        vocab_size = token_embedding_count - 1
+        token_inputs[:] = np.where(token_inputs != 0, token_inputs % vocab_size + 1, 0)
+        batches.append(inputs)
+    return batches
+
+def benchmark_numpy_model(
+    model_settings: settings.ModelSettings,
+    batch_count: int,
+    weights_filename: str = None
+):
+    """Times predictions with the NumPy model, and with the Keras model if Keras is installed"""
+    import numpy_model
+    import with_labels
+
+    rng = np.random.RandomState(1337)
+    model, embeddings = _random_numpy_model(rng, model_settings)
+    if weights_filename is not None:
+        model = numpy_model.NumpyModel.load(weights_filename)
+    batches = _random_model_inputs(rng, model_settings, batch_count, model.token_embeddings.shape[0])
+    token_count = sum(np.count_nonzero(inputs[0]) for inputs in batches)
+
+    backends = [("numpy", model)]
+    try:
+        import keras
+    except ImportError:
+        logging.info("Keras is not installed, so I'm timing only the NumPy model.")
+    else:
+        keras_model, _ = with_labels._uncompiled_model_with_labels(model_settings, embeddings)
+        keras_model._make_predict_function()
+        backends.append(("keras", keras_model))
+
+    for name, backend in backends:
+        start = time.time()
+        for inputs in batches:
+            with_labels.predict_label_ids(backend, inputs)
+        elapsed = time.time() - start
+
+        _report(
+            "%s predict_label_ids(), %.1f k tokens" % (name, token_count / 1e3),
+            len(batches),
+            "batches",
+            elapsed)
+        logging.info("%s: %.0f tokens/s", name, token_count / elapsed)
+
+def benchmark_precision(
+    model_settings: settings.ModelSettings,
+    batch_count: int,
+    weights_filename: str = None
+):
+    """Times the NumPy model with its weights in every precision, and reports how many
+    predictions change compared to float32"""
+    import numpy_model
+
+    rng = np.random.RandomState(1337)
+    model, _ = _random_numpy_model(rng, model_settings)
+    if weights_filename is not None:
+        model = numpy_model.NumpyModel.load(weights_filename)
+    batches = _random_model_inputs(rng, model_settings, batch_count, model.token_embeddings.shape[0])
+    token_count = sum(np.count_nonzero(inputs[0]) for inputs in batches)
+
+    float32_label_ids = None
+    for precision in numpy_model.PRECISIONS:
+        reduced_model = model.with_precision(precision)
+        start = time.time()
+        label_ids = [reduced_model.predict_label_ids(inputs) for inputs in batches]
+        elapsed = time.time() - start
+
+        if float32_label_ids is None:
+            float32_label_ids = label_ids
+        same_count = sum(
+            np.count_nonzero((ids == float32_ids) & (inputs[0] != 0))
+            for ids, float32_ids, inputs in zip(label_ids, float32_label_ids, batches))
+
+        _report(
+            "%s weights, %.1f k tokens" % (precision, token_count / 1e3),
+            len(batches),
+            "batches",
+            elapsed)
+        logging.info(
+            "%s: %.0f tokens/s, %.1f MB of weights, %.3f%% of predictions same as float32",
+            precision,
+            token_count / elapsed,
+            reduced_model.weight_bytes() / (1024 * 1024),
+            100.0 * same_count / token_count)
+
+def _load_embeddings(
+    token_stats_filename: str,
+    model_settings: settings.ModelSettings,
+    build_matrix: bool,
+    results
+):
+    """Loads embeddings the way the server does at startup, and puts the time it took and the
+    peak RSS into results. Runs in a fresh process, so the peak RSS is its own."""
+    import resource
+    import dataprep2
+
+    start = time.time()
+    embeddings = dataprep2.CombinedEmbeddings(
+        dataprep2.TokenStatistics(token_stats_filename),
+        dataprep2.GloveVectors(model_settings.glove_vectors),
+        model_settings.embedded_tokens_fraction)
+    embeddings._ensure_loaded()
+    if build_matrix:
+        embeddings.matrix_for_keras()
+    embeddings.glove_vocab()    # for the dehyphenator
+    elapsed = time.time() - start
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def benchmark_startup(model_settings: settings.ModelSettings, token_stats_filename: str):
+    """Times loading the embeddings for inference, with and without building the GloVe matrix"""
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+
+    for build_matrix in [True, False]:
+        results = context.Queue()
+        process = context.Process(
+            target=_load_embeddings,
+            args=(token_stats_filename, model_settings, build_matrix, results))
+        process.start()
+        elapsed, max_rss_kb = results.get()
+        process.join()
+        logging.info(
+            "CombinedEmbeddings %s the matrix: loaded in %.2f s, peak RSS %.0f MB",
+            "with" if build_matrix else "without",
+            elapsed,
+            max_rss_kb / 1024)
+
+_LONG_PAPER_PAGE_COUNT = 40
+
+def _write_long_papers(rng: random.Random, filename: str, doc_count: int, max_tokens_per_page: int):
+    """Writes JSON for long papers, in the format the dataprep server produces"""
+    import json
+    words = ["Deep", "learning", "of", "the", "ACM", "2017", "et", "al.", "network", "(", ")"]
+    fonts = ["Times-Roman", "Times-Bold", "Helvetica"]
+    with open(filename, "w") as f:
+        for doc_index in range(doc_count):
+            page_lengths = _random_page_lengths(rng, max_tokens_per_page)
+            pages = []
+            for _ in range(_LONG_PAPER_PAGE_COUNT):
+                tokens = []
+                for token_index in range(next(page_lengths)):
+                    left = rng.uniform(50.0, 500.0)
+                    top = 50.0 + 12.0 * (token_index // 12)
+                    font_size = rng.choice([8.0, 9.0, 10.0, 12.0, 14.0])
+                    tokens.append({
+                        "text": rng.choice(words),
+                        "font": rng.choice(fonts),
+                        "left": left,
+                        "right": left + rng.uniform(5.0, 40.0),
+                        "top": top,
+                        "bottom": top + font_size,
+                        "fontSize": font_size,
+                        "fontSpaceWidth": rng.choice([2.0, 2.5, 3.0])
+                    })
+                pages.append({"width": 612.0, "height": 792.0, "tokens": tokens})
+            doc_sha = "%040x" % doc_index
+            json.dump({"docName": doc_sha + ".pdf", "docSha": doc_sha, "pages": pages}, f)
+            f.write("\n")
+
+def benchmark_featurize(
+    model_settings: settings.ModelSettings,
+    doc_count: int,
+    token_stats_filename: str
+):
+    """Times making the unlabeled and featurized tokens files for long papers, the way the server
+    does, with and without limiting the work to the pages the model looks at"""
+    import os
+    import tempfile
+    import h5py
+    import dataprep2
+
+    embeddings = dataprep2.CombinedEmbeddings(
+        dataprep2.TokenStatistics(token_stats_filename),
+        dataprep2.GloveVectors(model_settings.glove_vectors),
+        model_settings.embedded_tokens_fraction)
+    embeddings._ensure_loaded()
+
+    with tempfile.TemporaryDirectory(prefix="benchmark-featurize-") as temp_dir:
+        json_file_name = os.path.join(temp_dir, "docs.json")
+        _write_long_papers(random.Random(1337), json_file_name, doc_count, _MAX_TOKENS_PER_PAGE)
+
+        featurized_file_names = {}
+        for relevant_pages_only in [False, True]:
+            unlabeled_file_name = os.path.join(temp_dir, "unlabeled-%s.h5" % relevant_pages_only)
+            start = time.time()
+            dataprep2.make_unlabeled_tokens_file(
+                json_file_name,
+                unlabeled_file_name,
+                relevant_pages_only=relevant_pages_only)
+            unlabeled_time = time.time() - start
+
+            featurized_file_name = os.path.join(temp_dir, "featurized-%s.h5" % relevant_pages_only)
+            start = time.time()
+            with h5py.File(unlabeled_file_name, "r") as unlabeled_file:
+                dataprep2.make_featurized_tokens_file(
+                    featurized_file_name,
+                    unlabeled_file,
+                    embeddings.tokenstats,
+                    embeddings,
+                    dataprep2.VisionOutput(None),
+                    model_settings,
+                    relevant_pages_only=relevant_pages_only)
+            featurized_time = time.time() - start
+            featurized_file_names[relevant_pages_only] = featurized_file_name
+
+            logging.info(
+                "relevant_pages_only=%s: unlabeled tokens in %.2f s, featurized tokens in %.2f s, %.1f dps",
+                relevant_pages_only,
+                unlabeled_time,
+                featurized_time,
+                doc_count / (unlabeled_time + featurized_time))
+
+        # The pages the model looks at must come out the same either way.
+        with h5py.File(featurized_file_names[False], "r") as all_pages_file, \
+                h5py.File(featurized_file_names[True], "r") as relevant_pages_file:
+            page_table = all_pages_file["page_table"][()]
+            page_bounds = dataprep2.page_bounds_for_docs(page_table, len(all_pages_file["doc_shas"]))
+            relevant_tokens = dataprep2._relevant_token_mask(
+                page_table, page_bounds, len(all_pages_file["token_hashed_text_features"]))
+            for name in ["token_hashed_text_features", "token_scaled_numeric_features"]:
+                assert np.array_equal(
+                    all_pages_file[name][()][relevant_tokens],
+                    relevant_pages_file[name][()][relevant_tokens]), name
+            logging.info(
+                "Features on the %d relevant of %d tokens are the same",
+                relevant_tokens.sum(),
+                len(relevant_tokens))
+
+#
+# Main program 🎛
+#
+
+def main():
+    logging.getLogger().setLevel(logging.INFO)
+
+    # find which command to run
+    commands = {
+        "page_pool": "Times slicing pages out of the page pool",
+        "batch": "Times assembling batches from pages",
+        "numpy_model": "Times predictions with the NumPy model",
+        "precision": "Times the NumPy model with float32, float16, and int8 weights",
+        "startup": "Times loading the embeddings at startup, with and without the GloVe matrix",
+        "featurize": "Times featurizing long papers, with and without skipping irrelevant pages"
+    }
+
+    command = None
+    if len(sys.argv) > 1:
+        command = sys.argv[1].lower()
+        del sys.argv[1]
+    if command is None or command not in commands.keys():
+        progname = sys.argv[0]
+        print("%s {%s}" % (progname, ", ".join(commands.keys())))
+        return 1
+
+    model_settings = settings.default_model_settings
+
+    import argparse
+    parser = argparse.ArgumentParser(description=commands[command])
+    parser.add_argument(
+        "--tokens-per-batch",
+        type=int,
+        default=model_settings.tokens_per_batch,
+        help="the number of tokens in a batch"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1000,
+        help="how many times to repeat the timed operation"
+    )
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default=None,
+        help="model weights for the numpy_model and precision commands, instead of random ones"
+    )
+    parser.add_argument(
+        "--token-stats",
+        type=str,
+        default="model/all.tokenstats3.gz",
+        help="token statistics for the startup and featurize commands"
+    )
+    parser.add_argument(
+        "--glove-vectors",
+        type=str,
+        default=model_settings.glove_vectors,
+        help="GloVe vectors for the startup and featurize commands"
+    )
+    args = parser.parse_args()
+
+    model_settings = model_settings._replace(tokens_per_batch=args.tokens_per_batch)
+    model_settings = model_settings._replace(glove_vectors=args.glove_vectors)
+
+    if command == "page_pool":
+        benchmark_page_pool(model_settings, args.repeat)
+    elif command == "batch":
+        benchmark_batch_assembly(model_settings, args.repeat)
+    elif command == "numpy_model":
+        benchmark_numpy_model(model_settings, args.repeat, args.weights)
+    elif command == "precision":
+        benchmark_precision(model_settings, args.repeat, args.weights)
+    elif command == "startup":
+        benchmark_startup(model_settings, args.token_stats)
+    elif command == "featurize":
+        benchmark_featurize(model_settings, args.repeat, args.token_stats)
+
+if __name__ == "__main__":
+    main()
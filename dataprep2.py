@@ -3,6 +3,7 @@ import logging
 import numpy as np
 import json
 import os
+import pickle
 import token_statistics
 import re
 import xml.etree.ElementTree as ET
@@ -16,9 +17,26 @@ import typing
 import sys
 import html
 import time
+import mmap
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import traceback
 from enum import Enum
-from queue import Queue
-from threading import Thread
+
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = None
+
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
 
 import settings
 
@@ -27,41 +45,405 @@ import settings
 # Helpers 💁
 #
 
-def threaded_generator(g, maxsize=16):
-    q = Queue(maxsize=maxsize)
+class PrefetchStats(object):
+    """How full the queues of a Prefetcher were, and how long both ends waited for each other"""
 
-    sentinel = object()
+    def __init__(self):
+        self.item_count = 0
+        self.consumer_wait_time = 0.0   # waiting for the producers
+        self.producer_wait_time = 0.0   # waiting for room in the queue, summed over producers
+        self.queue_fill_sum = 0.0       # fraction of the queue that was full, summed over items
 
-    def fill_queue():
+    def mean_queue_fill(self) -> float:
+        return self.queue_fill_sum / max(1, self.item_count)
+
+    def log(self, name: str):
+        logging.info(
+            "%s: %d items, consumer waited %.2f s, producers waited %.2f s, queue %.0f%% full on average",
+            name,
+            self.item_count,
+            self.consumer_wait_time,
+            self.producer_wait_time,
+            100.0 * self.mean_queue_fill())
+
+# How often blocked producers and consumers check whether they should give up
+_PREFETCH_POLL_INTERVAL = 0.1
+
+def _put_until_cancelled(q, message, cancelled) -> bool:
+    """Puts a message into a queue, unless the Prefetcher is cancelled first"""
+    while not cancelled.is_set():
         try:
-            for value in g:
-                q.put(value)
-        finally:
-            q.put(sentinel)
+            q.put(message, timeout=_PREFETCH_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _run_producer(
+    producer: typing.Callable[[], typing.Iterable],
+    q,
+    cancelled,
+    in_process: bool = False,
+    log_level: int = logging.NOTSET
+):
+    """Runs one producer of a Prefetcher, on a thread or in a process"""
+    if in_process:
+        logging.getLogger().setLevel(log_level)
+    wait_time = 0.0
+    try:
+        for item in producer():
+            put_start_time = time.time()
+            if not _put_until_cancelled(q, ("item", item), cancelled):
+                return
+            wait_time += time.time() - put_start_time
+        _put_until_cancelled(q, ("done", wait_time), cancelled)
+    except BaseException as e:
+        message = traceback.format_exc()
+        if in_process:
+            # Exceptions from processes have to be pickled, and not all of them can be.
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(str(e))
+        _put_until_cancelled(q, ("error", (e, message)), cancelled)
+
+class Prefetcher(object):
+    """Runs producers in the background, and hands what they produce to the consumer
+
+    Every producer is a callable that returns an iterable, and runs on its own thread, or in its
+    own process with backend="process". Producers run ahead of the consumer by at most maxsize
+    items. With ordered=True, the consumer gets all the items of the first producer, then all of
+    the second, and so on, and every producer gets its own queue of maxsize items. Otherwise,
+    items come out in the order they are produced.
 
-    thread = Thread(name=repr(g), target=fill_queue, daemon=True)
-    thread.start()
+    If a producer raises, iterating raises the same exception, and the other producers are
+    cancelled. Call close(), or use the prefetcher as a context manager, to cancel producers when
+    the consumer stops early. stats keeps the queue fill and the time both ends waited.
 
-    yield from iter(q.get, sentinel)
+    Process producers have to be picklable unless start_method is "fork", and so do their items
+    and exceptions."""
 
-def json_from_file(filename: str):
+    def __init__(
+        self,
+        producers: typing.List[typing.Callable[[], typing.Iterable]],
+        maxsize: int = 16,
+        ordered: bool = False,
+        backend: str = "thread",
+        start_method: typing.Optional[str] = None,
+        name: str = "Prefetcher"
+    ):
+        assert backend in {"thread", "process"}
+        self.producers = producers
+        self.maxsize = maxsize
+        self.ordered = ordered
+        self.backend = backend
+        self.name = name
+        self.stats = PrefetchStats()
+
+        if backend == "process":
+            context = multiprocessing.get_context(start_method)
+            make_queue = context.Queue
+            self.cancelled = context.Event()
+        else:
+            context = None
+            make_queue = queue.Queue
+            self.cancelled = threading.Event()
+        self.context = context
+        if ordered:
+            self.queues = [make_queue(maxsize) for _ in producers]
+        else:
+            self.queues = [make_queue(maxsize)]
+        self.workers = []
+
+    def _start(self):
+        for producer_index, producer in enumerate(self.producers):
+            q = self.queues[producer_index if self.ordered else 0]
+            worker_name = "%s-%d" % (self.name, producer_index)
+            if self.backend == "process":
+                worker = self.context.Process(
+                    name=worker_name,
+                    target=_run_producer,
+                    args=(producer, q, self.cancelled, True, logging.getLogger().getEffectiveLevel()),
+                    daemon=True)
+            else:
+                worker = threading.Thread(
+                    name=worker_name,
+                    target=_run_producer,
+                    args=(producer, q, self.cancelled),
+                    daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=_PREFETCH_POLL_INTERVAL)
+            except queue.Empty:
+                if self.backend != "process":
+                    continue
+                # A process can die without telling us, for example when it runs out of memory.
+                for worker in self.workers:
+                    if worker.exitcode is not None and worker.exitcode != 0:
+                        raise RuntimeError(
+                            "%s died with exit code %d" % (worker.name, worker.exitcode))
+
+    def _queue_fill(self, q) -> float:
+        try:
+            return q.qsize() / self.maxsize
+        except NotImplementedError:     # multiprocessing queues on macOS
+            return 0.0
+
+    def __iter__(self):
+        if len(self.workers) > 0:
+            raise ValueError("%s can only be iterated once" % self.name)
+        self._start()
+        try:
+            running_producer_count = len(self.producers)
+            queue_index = 0
+            while running_producer_count > 0:
+                q = self.queues[queue_index]
+                self.stats.queue_fill_sum += self._queue_fill(q)
+                wait_start_time = time.time()
+                kind, payload = self._get(q)
+                self.stats.consumer_wait_time += time.time() - wait_start_time
+
+                if kind == "item":
+                    self.stats.item_count += 1
+                    yield payload
+                elif kind == "done":
+                    self.stats.producer_wait_time += payload
+                    running_producer_count -= 1
+                    if self.ordered:
+                        queue_index += 1
+                else:
+                    exception, message = payload
+                    logging.error("A producer of %s failed:\n%s", self.name, message)
+                    raise exception
+        finally:
+            self.close()
+
+    def close(self):
+        """Cancels the producers, and waits for them to stop"""
+        self.cancelled.set()
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+            if self.backend == "process" and worker.is_alive():
+                # It might be stuck in something other than putting into our queue.
+                worker.terminate()
+                worker.join()
+        if self.backend == "process":
+            for q in self.queues:
+                q.cancel_join_thread()
+        if len(self.workers) > 0 and self.stats.item_count > 0:
+            self.stats.log(self.name)
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def prefetch(iterable: typing.Iterable, maxsize: int = 16, name: str = "Prefetcher") -> Prefetcher:
+    """Iterates over iterable on a background thread, at most maxsize items ahead of the consumer"""
+    return Prefetcher([lambda: iterable], maxsize, name=name)
+
+def _json_loads(s: str):
+    if _fast_json is not None:
+        try:
+            return _fast_json.loads(s)
+        except ValueError:
+            pass    # The fast decoders are stricter than the json module, for example about NaN.
+    return json.loads(s)
+
+def _json_from_lines(lines: typing.List[bytes]) -> list:
+    result = []
+    for line in lines:
+        try:
+            result.append(_json_loads(line.decode("UTF-8", errors="replace")))
+        except ValueError as e:
+            logging.warning("Error while reading document (%s); skipping", e)
+    return result
+
+_bz2_stream_start_re = re.compile(rb'BZh[1-9]1AY&SY')
+_bz2_stream_end_magic = 0x177245385090
+
+def _is_bz2_stream_start(data, offset: int) -> bool:
+    """Checks that the end-of-stream marker of the previous stream ends right at offset.
+
+    The marker is 48 bits of magic and 32 bits of CRC, not byte-aligned, followed by up to seven
+    bits of padding. Looking for it makes it vanishingly unlikely that we split a stream in the
+    middle of its compressed data."""
+    if offset == 0:
+        return True
+    if offset < 11:
+        return False
+    tail = int.from_bytes(data[offset - 11:offset], "big")
+    for padding in range(8):
+        if (tail >> (32 + padding)) & 0xffffffffffff == _bz2_stream_end_magic:
+            return True
+    return False
+
+def _bz2_decompress_streams(data: bytes) -> bytes:
+    result = []
+    while len(data) > 0:
+        decompressor = bz2.BZ2Decompressor()
+        result.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        data = decompressor.unused_data
+    return b"".join(result)
+
+_DECOMPRESSED_CHUNK_SIZE = 4 * 1024 * 1024
+
+def _bz2_chunks(filename: str, workers: int) -> typing.Generator[bytes, None, None]:
+    """Decompresses a bz2 file in parallel.
+
+    If indexed_bzip2 is installed, it can decompress any bz2 file block by block. Without it, we
+    can still decompress files written by pbzip2 in parallel, because those consist of many
+    independent streams. bz2 releases the GIL while decompressing, so threads are good enough."""
+    if indexed_bzip2 is not None:
+        with indexed_bzip2.open(filename, parallelization=workers) as f:
+            while True:
+                chunk = f.read(_DECOMPRESSED_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        return
+
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            stream_starts = [
+                m.start() for m in _bz2_stream_start_re.finditer(data)
+                if _is_bz2_stream_start(data, m.start())
+            ]
+            if len(stream_starts) <= 1:
+                with bz2.BZ2File(data) as decompressor:
+                    while True:
+                        chunk = decompressor.read(_DECOMPRESSED_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+                return
+
+            stream_starts[0] = 0
+            stream_ends = stream_starts[1:] + [len(data)]
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                pending = collections.deque()
+                for start, end in zip(stream_starts, stream_ends):
+                    pending.append(executor.submit(_bz2_decompress_streams, data[start:end]))
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().result()
+                while len(pending) > 0:
+                    yield pending.popleft().result()
+
+def _raw_chunks(filename: str, workers: int) -> typing.Generator[bytes, None, None]:
     if filename.endswith(".bz2"):
+        if workers > 1:
+            yield from _bz2_chunks(filename, workers)
+            return
         open_fn = bz2.open
     elif filename.endswith(".gz"):
         open_fn = gzip.open
     else:
         open_fn = open
 
-    with open_fn(filename, "rt", encoding="UTF-8", errors="replace") as p:
-        for line in p:
-            try:
-                yield json.loads(line)
-            except ValueError as e:
-                logging.warning("Error while reading document (%s); skipping", e)
-
-def json_from_files(filenames: typing.List[str]):
+    with open_fn(filename, "rb") as f:
+        while True:
+            chunk = f.read(_DECOMPRESSED_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def _line_batches(
+    chunks: typing.Iterable[bytes],
+    lines_per_batch: int
+) -> typing.Generator[typing.List[bytes], None, None]:
+    leftover = b""
+    batch = []
+    for chunk in chunks:
+        lines = (leftover + chunk).split(b"\n")
+        leftover = lines.pop()
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= lines_per_batch:
+                yield batch
+                batch = []
+    if len(leftover) > 0:
+        batch.append(leftover)
+    if len(batch) > 0:
+        yield batch
+
+# Below this size, starting the worker processes costs more than it saves.
+_PARALLEL_JSON_MIN_FILE_SIZE = 16 * 1024 * 1024
+
+def json_from_file(filename: str, workers: typing.Optional[int] = None):
+    """Reads one json document per line from a file that might be compressed.
+
+    Big files are decompressed and parsed with multiple workers. Documents come out in the same
+    order as they appear in the file either way. workers defaults to the number of CPUs.
+
+    The parsing workers are forked, so processes that have TensorFlow loaded or threads running,
+    like the server and db_worker, have to pass workers=1."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if os.path.getsize(filename) < _PARALLEL_JSON_MIN_FILE_SIZE:
+        workers = 1
+
+    bytes_read = 0
+    docs_read = 0
+    start = time.time()
+    def log_progress(message: str):
+        elapsed = max(time.time() - start, 1e-6)
+        logging.info(
+            "%s %d documents (%.1f MB) from %s in %.2f seconds (%.2f MB/s, %.2f dps)",
+            message,
+            docs_read,
+            bytes_read / (1024 * 1024),
+            filename,
+            elapsed,
+            bytes_read / (1024 * 1024) / elapsed,
+            docs_read / elapsed)
+
+    def counted_chunks():
+        nonlocal bytes_read
+        for chunk in _raw_chunks(filename, workers):
+            bytes_read += len(chunk)
+            yield chunk
+
+    if workers <= 1:
+        for batch in _line_batches(counted_chunks(), 1):
+            for doc in _json_from_lines(batch):
+                yield doc
+                docs_read += 1
+                if docs_read % 10000 == 0:
+                    log_progress("Read")
+        log_progress("Finished reading")
+        return
+
+    # This is the same as executor.map(), except that map() reads all of its input up front,
+    # and we want to keep a bounded number of batches in memory.
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        def results_from_oldest_batch():
+            nonlocal docs_read
+            docs = pending.popleft().result()
+            docs_read += len(docs)
+            if docs_read // 10000 != (docs_read - len(docs)) // 10000:
+                log_progress("Read")
+            return docs
+
+        for batch in _line_batches(counted_chunks(), 64):
+            pending.append(executor.submit(_json_from_lines, batch))
+            if len(pending) >= 4 * workers:
+                yield from results_from_oldest_batch()
+        while len(pending) > 0:
+            yield from results_from_oldest_batch()
+    log_progress("Finished reading")
+
+def json_from_files(filenames: typing.List[str], workers: typing.Optional[int] = None):
     for filename in filenames:
-        yield from json_from_file(filename)
+        yield from json_from_file(filename, workers)
 
 def normalize(s: str) -> str:
     s = s.lower()
@@ -123,11 +505,13 @@ class TokenStatistics(object):
         self.token_count = None
         self.cum_font_sizes = None
         self.cum_space_widths = None
+        self.load_time = 0.0
         # We load all this stuff lazily.
 
     def _ensure_loaded(self):
         if self.tokens is not None:
             return
+        start_time = time.time()
 
         # load the file
         (texts, fonts, font_sizes, space_widths) = \
@@ -152,6 +536,13 @@ class TokenStatistics(object):
         # prepare font sizes and token widths
         self.percentile_function_for_font_size = percentile_function_from_counts(font_sizes)
         self.percentile_function_for_space_width = percentile_function_from_counts(space_widths)
+        self.load_time += time.time() - start_time
+
+    def memory_size(self) -> int:
+        """Approximate number of bytes this takes up in memory"""
+        if self.tokens is None:
+            return 0
+        return _approximate_memory_size(self.tokens)
 
     def get_font_size_percentile(self, font_size):
         self._ensure_loaded()
@@ -250,10 +641,13 @@ class GloveVectors(object):
         self.vectors = None
         self.vectors_stddev = None
         self.word2index = None
+        self.vocab = None
+        self.load_time = 0.0
 
     def _ensure_vectors(self):
         if self.vectors is not None:
             return
+        start_time = time.time()
 
         self.word2index = {}
         self.vectors = []
@@ -273,13 +667,39 @@ class GloveVectors(object):
                     raise
         self.vectors = np.stack(self.vectors)
         self.vectors_stddev = np.std(self.vectors)
+        self.load_time += time.time() - start_time
+
+    def memory_size(self) -> int:
+        """Approximate number of bytes this takes up in memory"""
+        size = 0
+        if self.vectors is not None:
+            size += self.vectors.nbytes + _approximate_memory_size(self.word2index)
+        if self.vocab is not None and self.word2index is None:
+            size += _approximate_memory_size(self.vocab)
+        return size
 
     def get_dimensions(self) -> int:
         return self.dimensions
 
+    def _ensure_vocab(self):
+        """Reads only the words from the file, without parsing any of the vectors"""
+        if self.vocab is not None:
+            return
+        if self.word2index is not None:
+            self.vocab = frozenset(self.word2index.keys())
+            return
+        start_time = time.time()
+
+        vocab = set()
+        with gzip.open(self.filename, "rt", encoding="UTF-8") as lines:
+            for line in lines:
+                vocab.add(normalize(line.split(" ", 1)[0]))
+        self.vocab = frozenset(vocab)
+        self.load_time += time.time() - start_time
+
     def get_vocab(self):
-        self._ensure_vectors()
-        return self.word2index.keys()
+        self._ensure_vocab()
+        return self.vocab
 
     def get_vocab_size(self) -> int:
         self._ensure_vectors()
@@ -312,7 +732,10 @@ class GloveVectors(object):
             return vector
 
 class CombinedEmbeddings(object):
-    """Combines token statistics and glove vectors to produce embeddings to start training with."""
+    """Combines token statistics and glove vectors to produce embeddings to start training with.
+
+    The embedding matrix is only built when something asks for it. A trained model has the matrix
+    in its weights, so inference only builds token2index, and never loads the glove vectors."""
 
     OOV = " ⚠ OOV ⚠ " # must be something that the tokenizer would destroy
     OOV_INDEX = 1     # 0 is the keras masking value
@@ -329,10 +752,14 @@ class CombinedEmbeddings(object):
 
         self.token2index = None
         self.matrix = None
+        self.load_time = 0.0
 
     def _ensure_loaded(self):
         if self.token2index is not None:
             return
+        # Load what we depend on first, so that its time isn't counted as ours.
+        self.tokenstats._ensure_loaded()
+        start_time = time.time()
 
         # build token2index
         self.token2index = {
@@ -346,6 +773,15 @@ class CombinedEmbeddings(object):
         assert len(indices) == len(self.token2index)
         # make sure that 0, the keras masking value, did not make it into the indices
         assert 0 not in indices
+        logging.info("%d words in vocab", len(self.token2index))
+        self.load_time += time.time() - start_time
+
+    def _ensure_matrix(self):
+        if self.matrix is not None:
+            return
+        self._ensure_loaded()
+        self.glove._ensure_vectors()
+        start_time = time.time()
 
         # build the embedding matrix
         self.matrix = np.zeros(
@@ -373,6 +809,17 @@ class CombinedEmbeddings(object):
                 tokens_printed += 1
                 if tokens_printed >= 30:
                     break
+        self.load_time += time.time() - start_time
+
+    def memory_size(self) -> int:
+        """Approximate number of bytes this takes up in memory, not counting the token statistics
+        and glove vectors it uses"""
+        if self.token2index is None:
+            return 0
+        size = _approximate_memory_size(self.token2index)
+        if self.matrix is not None:
+            size += self.matrix.nbytes
+        return size
 
     def index_for_token(self, token: str) -> int:
         self._ensure_loaded()
@@ -381,26 +828,114 @@ class CombinedEmbeddings(object):
         return r
 
     def dimensions(self):
-        self._ensure_loaded()
-        return self.matrix.shape[1]
+        return self.glove.get_dimensions_with_random()
 
     def glove_vocab(self):
         return self.glove.get_vocab()
 
     def vocab_size(self):
         self._ensure_loaded()
-        return self.matrix.shape[0] - 1 # -1 for the keras mask
+        return len(self.token2index)
 
-    def matrix_for_keras(self):
-        self._ensure_loaded()
+    def matrix_for_keras(self) -> np.ndarray:
+        """Returns the embedding matrix, building it the first time"""
+        self._ensure_matrix()
         return self.matrix
 
 
+#
+# Shared Resources 📚
+#
+
+def _approximate_memory_size(o) -> int:
+    """Approximate number of bytes taken up by a numpy array, or by a container of small
+    objects"""
+    if isinstance(o, np.ndarray):
+        return o.nbytes
+    size = sys.getsizeof(o)
+    if isinstance(o, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in o.items())
+    elif isinstance(o, (list, tuple, set, frozenset)):
+        size += sum(
+            sum(map(sys.getsizeof, item)) if isinstance(item, tuple) else sys.getsizeof(item)
+            for item in o)
+    return size
+
+_shared_resources = collections.OrderedDict()
+_shared_resources_lock = threading.RLock()    # making a resource can get other resources
+
+def _shared_resource(key: tuple, make: typing.Callable[[], typing.Any]):
+    with _shared_resources_lock:
+        resource = _shared_resources.get(key)
+        if resource is None:
+            resource = make()
+            _shared_resources[key] = resource
+        return resource
+
+def shared_token_statistics(filename: str) -> TokenStatistics:
+    """Returns the process-wide TokenStatistics for the given file. It loads lazily, like any
+    TokenStatistics, but only once per process."""
+    filename = os.path.abspath(filename)
+    return _shared_resource(
+        ("TokenStatistics", filename),
+        lambda: TokenStatistics(filename))
+
+def shared_glove_vectors(filename: str) -> GloveVectors:
+    """Returns the process-wide GloveVectors for the given file"""
+    filename = os.path.abspath(filename)
+    return _shared_resource(
+        ("GloveVectors", filename),
+        lambda: GloveVectors(filename))
+
+def shared_combined_embeddings(
+    token_stats_filename: str,
+    model_settings: settings.ModelSettings
+) -> CombinedEmbeddings:
+    """Returns the process-wide CombinedEmbeddings for the given token statistics and settings.
+    Users that only need token indices share one instance with users that need the matrix."""
+    token_stats_filename = os.path.abspath(token_stats_filename)
+    glove_filename = os.path.abspath(model_settings.glove_vectors)
+    return _shared_resource(
+        (
+            "CombinedEmbeddings",
+            token_stats_filename,
+            glove_filename,
+            model_settings.embedded_tokens_fraction
+        ),
+        lambda: CombinedEmbeddings(
+            shared_token_statistics(token_stats_filename),
+            shared_glove_vectors(glove_filename),
+            model_settings.embedded_tokens_fraction))
+
+def log_shared_resources(level: int = logging.INFO):
+    """Logs how long each shared resource took to load, and how much memory it takes up"""
+    with _shared_resources_lock:
+        resources = list(_shared_resources.items())
+    total_time = 0.0
+    total_size = 0
+    for key, resource in resources:
+        size = resource.memory_size()
+        logging.log(
+            level,
+            "Shared %s: loaded in %.2f s, %.0f MB",
+            " ".join(map(str, key)),
+            resource.load_time,
+            size / (1024 * 1024))
+        total_time += resource.load_time
+        total_size += size
+    logging.log(
+        level,
+        "%d shared resources: loaded in %.2f s, %.0f MB",
+        len(resources),
+        total_time,
+        total_size / (1024 * 1024))
+
+
 #
 # Unlabeled Tokens 🗄
 #
 
-UNLABELED_TOKENS_VERSION = "tok6"
+UNLABELED_TOKENS_VERSION = "tok7"
 
 h5_unicode_type = h5py.special_dtype(vlen=np.unicode)
 
@@ -419,6 +954,104 @@ MAX_PAGE_COUNT = 40
 # the model settings.
 MAX_PAGES_PER_BUCKET = MAX_DOCS_PER_BUCKET * MAX_PAGE_COUNT
 
+# All token files describe their documents with these datasets:
+#  * doc_ids: one string per document
+#  * doc_shas: one sha per document
+#  * page_table: one row per page, sorted by document, with the columns below
+#  * doc_gold: one json structure per document with the gold title, authors and bibs. Only
+#    labeled files have this.
+PAGE_TABLE_DTYPE = np.dtype([
+    ("doc_index", np.int32),
+    ("page_number", np.int32),
+    ("width", np.float64),
+    ("height", np.float64),
+    ("first_token_index", np.int64),
+    ("token_count", np.int32)
+])
+
+def _create_doc_datasets(h5_file: h5py.File, max_doc_count: int, max_page_count: int):
+    h5_doc_ids = h5_file.create_dataset(
+        "doc_ids",
+        dtype=h5_unicode_type,
+        shape=(0,),
+        maxshape=(max_doc_count,))
+    h5_doc_shas = h5_file.create_dataset(
+        "doc_shas",
+        dtype="S40",
+        shape=(0,),
+        maxshape=(max_doc_count,))
+    h5_page_table = h5_file.create_dataset(
+        "page_table",
+        dtype=PAGE_TABLE_DTYPE,
+        shape=(0,),
+        maxshape=(max_page_count,))
+    return h5_doc_ids, h5_doc_shas, h5_page_table
+
+def _append_doc(
+    h5_doc_ids: h5py.Dataset,
+    h5_doc_shas: h5py.Dataset,
+    h5_page_table: h5py.Dataset,
+    doc_id: str,
+    doc_sha: str,
+    pages: typing.List[typing.Tuple[float, float, int, int]]   # width, height, first_token_index, token_count
+) -> int:
+    doc_index = len(h5_doc_ids)
+    h5_doc_ids.resize(doc_index + 1, axis=0)
+    h5_doc_ids[doc_index] = doc_id
+    h5_doc_shas.resize(doc_index + 1, axis=0)
+    h5_doc_shas[doc_index] = doc_sha.encode("ascii")
+
+    first_page_index = len(h5_page_table)
+    h5_page_table.resize(first_page_index + len(pages), axis=0)
+    h5_page_table[first_page_index:first_page_index + len(pages)] = np.array([
+        (doc_index, page_number, width, height, first_token_index, token_count)
+        for page_number, (width, height, first_token_index, token_count) in enumerate(pages)
+    ], dtype=PAGE_TABLE_DTYPE)
+    return doc_index
+
+def page_bounds_for_docs(page_table: np.ndarray, doc_count: int) -> np.ndarray:
+    """Returns an array b, such that the pages of document i are page_table[b[i]:b[i+1]]."""
+    return page_table["doc_index"].searchsorted(np.arange(doc_count + 1))
+
+def token_bounds_for_docs(
+    page_table: np.ndarray,
+    page_bounds: np.ndarray
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Returns arrays s and e, such that the tokens of document i are in rows s[i]:e[i]. Documents
+    without pages get an empty range where the previous document ends."""
+    page_ends = page_table["first_token_index"] + page_table["token_count"]
+    has_pages = page_bounds[1:] > page_bounds[:-1]
+    doc_ends = np.zeros(len(page_bounds) - 1, dtype=np.int64)
+    doc_ends[has_pages] = page_ends[page_bounds[1:][has_pages] - 1]
+    doc_ends = np.maximum.accumulate(doc_ends)
+    doc_starts = np.zeros_like(doc_ends)
+    doc_starts[1:] = doc_ends[:-1]
+    doc_starts[has_pages] = page_table["first_token_index"][page_bounds[:-1][has_pages]]
+    return doc_starts, doc_ends
+
+# The model only looks at these pages of a document. Negative indices count from the back.
+RELEVANT_PAGE_INDICES = {0, 1, 2, -1, -2, -3, -4, -5}
+
+def relevant_page_indices(page_count: int) -> typing.Set[int]:
+    """Returns the positions of the pages the model looks at in a document with page_count
+    pages"""
+    if page_count <= 0:
+        return set()
+    return {i % page_count for i in RELEVANT_PAGE_INDICES}
+
+def _relevant_token_mask(page_table: np.ndarray, page_bounds: np.ndarray, token_count: int) -> np.ndarray:
+    """Returns a mask that is True for the tokens on the pages the model looks at"""
+    mask = np.zeros(token_count, dtype=np.bool_)
+    for doc_index in range(len(page_bounds) - 1):
+        page_rows = page_table[page_bounds[doc_index]:page_bounds[doc_index + 1]]
+        for page_index in relevant_page_indices(len(page_rows)):
+            first_token_index = int(page_rows[page_index]["first_token_index"])
+            mask[first_token_index:first_token_index + int(page_rows[page_index]["token_count"])] = True
+    return mask
+
+def decode_doc_sha(doc_sha: bytes) -> str:
+    return doc_sha.decode("ascii")
+
 _sha1_re = re.compile(r'^[0-9a-f]{40}$')
 _sha1DotPdf_re = re.compile(r'^[0-9a-f]{40}\.pdf$')
 _sha1FromS2Url = re.compile(r'.*([0-9a-f]{4})/([0-9a-f]{36}).pdf$')
@@ -426,18 +1059,23 @@ _sha1FromS2Url = re.compile(r'.*([0-9a-f]{4})/([0-9a-f]{36}).pdf$')
 def make_unlabeled_tokens_file(
     json_file_names: typing.Union[str, typing.List[str]],
     output_file_name: str,
-    ignore_errors=False
+    ignore_errors=False,
+    relevant_pages_only=False,
+    json_workers: typing.Optional[int] = None
 ):
+    """Writes the tokens from the json files into an unlabeled tokens file. json_workers goes to
+    json_from_file().
+
+    With relevant_pages_only, the text and fonts of tokens on pages the model doesn't look at are
+    left empty. Those pages keep their place in the page table, so that len(doc.pages) stays the
+    same, and their numeric features stay, because features relative to the document use them."""
     if isinstance(json_file_names, str):
         json_file_names = [json_file_names]
 
     h5_file = h5py.File(output_file_name, "w-", libver="latest")
     try:
-        h5_doc_metadata = h5_file.create_dataset(
-            "doc_metadata",
-            dtype=h5_unicode_type,
-            shape=(0,),   # free-wheeling json structure
-            maxshape=(MAX_DOCS_PER_BUCKET,))
+        h5_doc_ids, h5_doc_shas, h5_page_table = \
+            _create_doc_datasets(h5_file, MAX_DOCS_PER_BUCKET, MAX_PAGES_PER_BUCKET)
         h5_token_text_features = h5_file.create_dataset(
             "token_text_features",
             dtype=h5_unicode_type,
@@ -453,7 +1091,7 @@ def make_unlabeled_tokens_file(
             compression="gzip",
             compression_opts=9)
 
-        for json_doc in json_from_files(json_file_names):
+        for json_doc in json_from_files(json_file_names, json_workers):
             if "error" in json_doc:
                 if ignore_errors:
                     continue
@@ -482,9 +1120,6 @@ def make_unlabeled_tokens_file(
                         doc_name = "/".join(doc_name)
             assert _sha1_re.match(doc_sha) is not None, doc_sha
 
-            doc_in_h5 = {}  # the structure we are stuffing into doc_metadata
-            doc_in_h5["doc_id"] = doc_name
-            doc_in_h5["doc_sha"] = doc_sha
             pages_in_h5 = []
 
             try:
@@ -493,11 +1128,13 @@ def make_unlabeled_tokens_file(
                 logging.warning("Document %s has no pages, skipping", doc_sha)
                 continue
             effective_page_count = min(MAX_PAGE_COUNT, len(json_pages))
-            for json_page in json_pages[:effective_page_count]:
-                page_in_h5 = {}
+            if relevant_pages_only:
+                page_indices_with_text = relevant_page_indices(effective_page_count)
+            else:
+                page_indices_with_text = range(effective_page_count)
+            for page_index, json_page in enumerate(json_pages[:effective_page_count]):
                 width = float(json_page["width"])
                 height = float(json_page["height"])
-                page_in_h5["dimensions"] = (width, height)
 
                 # Get the tokens from the page
                 json_tokens = json_page.get("tokens", [])
@@ -508,17 +1145,20 @@ def make_unlabeled_tokens_file(
                                "NaN" not in [token[field_name] for field_name in numeric_fields]]
 
                 first_token_index = len(h5_token_text_features)
-                page_in_h5["first_token_index"] = first_token_index
-                page_in_h5["token_count"] = len(json_tokens)
+                if len(json_tokens) <= 0:
+                    # h5py can't write an empty list into an empty slice of a 2-D dataset
+                    pages_in_h5.append((width, height, first_token_index, 0))
+                    continue
 
                 h5_token_text_features.resize(first_token_index + len(json_tokens), axis=0)
                 def sanitize_string(s: str) -> str:
                     return s.replace("\0", "\ufffd")
-                h5_token_text_features[first_token_index:first_token_index+len(json_tokens)] = \
-                    [(
-                        sanitize_string(json_token["text"]).encode("utf-8"),
-                        sanitize_string(json_token["font"]).encode("utf-8"),
-                    ) for json_token in json_tokens]
+                if page_index in page_indices_with_text:
+                    h5_token_text_features[first_token_index:first_token_index+len(json_tokens)] = \
+                        [(
+                            sanitize_string(json_token["text"]).encode("utf-8"),
+                            sanitize_string(json_token["font"]).encode("utf-8"),
+                        ) for json_token in json_tokens]
 
                 h5_token_numeric_features.resize(first_token_index + len(json_tokens), axis=0)
                 h5_token_numeric_features[first_token_index:first_token_index+len(json_tokens)] = \
@@ -542,12 +1182,9 @@ def make_unlabeled_tokens_file(
                     h5_token_numeric_features[first_token_index:first_token_index+len(json_tokens), numeric_fields.index("fontSpaceWidth")] = \
                         font_sizes
 
-                pages_in_h5.append(page_in_h5)
-            doc_in_h5["pages"] = pages_in_h5
+                pages_in_h5.append((width, height, first_token_index, len(json_tokens)))
 
-            doc_index = len(h5_doc_metadata)
-            h5_doc_metadata.resize(doc_index + 1, axis=0)
-            h5_doc_metadata[doc_index] = json.dumps(doc_in_h5)
+            _append_doc(h5_doc_ids, h5_doc_shas, h5_page_table, doc_name, doc_sha, pages_in_h5)
         h5_file.close()
     except:
         # If something fails, try cleaning up after ourselves
@@ -580,7 +1217,7 @@ def unlabeled_tokens_file(bucket_path: str):
 # Labeling 🏷
 #
 
-LABELED_TOKENS_VERSION = "tok6"
+LABELED_TOKENS_VERSION = "tok7"
 
 _split_words_re = re.compile(r'(\W|\d+)')
 _not_spaces_re = re.compile(r'\S+')
@@ -609,15 +1246,22 @@ def labeled_tokens_file(bucket_path: str):
         temp_labeled_tokens_path = labeled_tokens_path + ".%d.temp" % os.getpid()
         labeled_file = h5py.File(temp_labeled_tokens_path, "w-", libver="latest")
         try:
-            unlab_doc_metadata = unlabeled_tokens["doc_metadata"]
+            unlab_doc_ids = unlabeled_tokens["doc_ids"][()]
+            unlab_doc_shas = unlabeled_tokens["doc_shas"][()]
+            unlab_page_table = unlabeled_tokens["page_table"][()]
+            unlab_page_bounds = page_bounds_for_docs(unlab_page_table, len(unlab_doc_shas))
             unlab_token_text_features = unlabeled_tokens["token_text_features"]
             unlab_token_numeric_features = unlabeled_tokens["token_numeric_features"]
 
-            lab_doc_metadata = labeled_file.create_dataset(
-                "doc_metadata",
+            lab_doc_ids, lab_doc_shas, lab_page_table = _create_doc_datasets(
+                labeled_file,
+                len(unlab_doc_shas),
+                len(unlab_page_table))
+            lab_doc_gold = labeled_file.create_dataset(
+                "doc_gold",
                 dtype=h5_unicode_type,
                 shape=(0,),   # free-wheeling json structure
-                maxshape=(len(unlab_doc_metadata),)
+                maxshape=(len(unlab_doc_shas),)
             )
             lab_token_text_features = labeled_file.create_dataset(
                 "token_text_features",
@@ -641,10 +1285,10 @@ def labeled_tokens_file(bucket_path: str):
                 compression="gzip",
                 compression_opts=9)
 
-            for unlab_metadata in unlab_doc_metadata:
-                json_metadata = json.loads(unlab_metadata)
-                doc_sha = json_metadata["doc_sha"]
-                doc_id = json_metadata["doc_id"]
+            for unlab_doc_index, doc_id in enumerate(unlab_doc_ids):
+                doc_sha = decode_doc_sha(unlab_doc_shas[unlab_doc_index])
+                unlab_page_rows = unlab_page_table[
+                    unlab_page_bounds[unlab_doc_index]:unlab_page_bounds[unlab_doc_index + 1]]
                 logging.info("Labeling %s", doc_id)
 
                 nxml_path = re.sub("\\.pdf$", ".nxml", doc_id)
@@ -794,7 +1438,7 @@ def labeled_tokens_file(bucket_path: str):
 
                 effective_page_count = min(
                     MAX_PAGE_COUNT,
-                    len(json_metadata["pages"]))
+                    len(unlab_page_rows))
 
                 # find titles, authors, bibs in the document
                 title_match = None
@@ -817,9 +1461,9 @@ def labeled_tokens_file(bucket_path: str):
                 ])
 
                 for page_number in range(effective_page_count):
-                    json_page = json_metadata["pages"][page_number]
-                    page_first_token_index = int(json_page["first_token_index"])
-                    token_count = int(json_page["token_count"])
+                    page_row = unlab_page_rows[page_number]
+                    page_first_token_index = int(page_row["first_token_index"])
+                    token_count = int(page_row["token_count"])
 
                     tokens = unlab_token_text_features[page_first_token_index:page_first_token_index+token_count,0]
                     font_sizes = unlab_token_numeric_features[page_first_token_index:page_first_token_index+token_count,4]
@@ -1103,9 +1747,7 @@ def labeled_tokens_file(bucket_path: str):
 
                 # create the document in the new file
                 # This is the point of no return.
-                lab_doc_json = {
-                    "doc_id": doc_id,
-                    "doc_sha": doc_sha,
+                lab_doc_gold_json = {
                     "gold_title": gold_title,
                     "gold_authors": gold_authors,
                     "gold_bib_titles": gold_bib_titles,
@@ -1113,19 +1755,18 @@ def labeled_tokens_file(bucket_path: str):
                     "gold_bib_authors": gold_bib_authors,
                     "gold_bib_years": gold_bib_years
                 }
-                lab_doc_json_pages = []
+                lab_doc_pages = []
                 for page_number in range(effective_page_count):
-                    json_page = json_metadata["pages"][page_number]
+                    page_row = unlab_page_rows[page_number]
 
-                    unlab_first_token_index = int(json_page["first_token_index"])
-                    token_count = int(json_page["token_count"])
+                    unlab_first_token_index = int(page_row["first_token_index"])
+                    token_count = int(page_row["token_count"])
 
-                    lab_doc_json_page = {
-                        "dimensions": json_page["dimensions"],
-                        "first_token_index": len(lab_token_text_features),
-                        "token_count": token_count
-                    }
-                    lab_doc_json_pages.append(lab_doc_json_page)
+                    lab_doc_pages.append((
+                        float(page_row["width"]),
+                        float(page_row["height"]),
+                        len(lab_token_text_features),
+                        token_count))
 
                     # copy token text features
                     lab_first_token_index = len(lab_token_text_features)
@@ -1195,10 +1836,15 @@ def labeled_tokens_file(bucket_path: str):
 
                     assert len(lab_token_labels) == len(lab_token_text_features)
 
-                doc_index = len(lab_doc_metadata)
-                lab_doc_metadata.resize(doc_index + 1, axis=0)
-                lab_doc_json["pages"] = lab_doc_json_pages
-                lab_doc_metadata[doc_index] = json.dumps(lab_doc_json)
+                doc_index = _append_doc(
+                    lab_doc_ids,
+                    lab_doc_shas,
+                    lab_page_table,
+                    doc_id,
+                    doc_sha,
+                    lab_doc_pages)
+                lab_doc_gold.resize(doc_index + 1, axis=0)
+                lab_doc_gold[doc_index] = json.dumps(lab_doc_gold_json)
         except:
             try:
                 os.remove(temp_labeled_tokens_path)
@@ -1216,7 +1862,7 @@ def labeled_tokens_file(bucket_path: str):
 # Featurized Tokens 👣
 #
 
-FEATURIZED_TOKENS_VERSION = "tok6"
+FEATURIZED_TOKENS_VERSION = "tok7"
 
 def make_featurized_tokens_file(
     output_file_name: str,
@@ -1225,23 +1871,48 @@ def make_featurized_tokens_file(
     embeddings: CombinedEmbeddings,
     vision_output: VisionOutput,
     model_settings: settings.ModelSettings,
-    make_copies: bool = False
+    make_copies: bool = False,
+    relevant_pages_only: bool = False
 ):
+    """Writes the features the model needs into a featurized tokens file.
+
+    With relevant_pages_only, only the tokens on the pages the model looks at are featurized.
+    Features relative to the whole document still consider all the tokens in the document."""
     featurized_file = h5py.File(output_file_name, "w-", libver="latest")
     try:
-        lab_doc_metadata = input_file["doc_metadata"]
+        lab_doc_shas = input_file["doc_shas"][()]
+        lab_page_table = input_file["page_table"][()]
+        lab_page_bounds = page_bounds_for_docs(lab_page_table, len(lab_doc_shas))
         lab_token_text_features = input_file["token_text_features"]
         lab_token_numeric_features = input_file["token_numeric_features"]
 
+        if relevant_pages_only:
+            relevant_tokens = _relevant_token_mask(
+                lab_page_table, lab_page_bounds, len(lab_token_text_features))
+            logging.info(
+                "Featurizing %d of %d tokens on relevant pages",
+                relevant_tokens.sum(),
+                len(relevant_tokens))
+        else:
+            relevant_tokens = slice(None)
+
         # since we don't add or remove pages, we can link to datasets in the original file
-        for name in ["doc_metadata", "token_labels", "token_text_features", "token_numeric_features"]:
+        for name in [
+            "doc_ids",
+            "doc_shas",
+            "page_table",
+            "doc_gold",
+            "token_labels",
+            "token_text_features",
+            "token_numeric_features"
+        ]:
             if make_copies:
                 try:
                     input_file.copy(name, featurized_file, name)
                 except KeyError as e:
-                    # We're allowed to get a KeyError for token_labels, because we can run this
-                    # function on unlabeled data. All other datasets must exist.
-                    if name == "token_labels":
+                    # We're allowed to get a KeyError for doc_gold and token_labels, because we
+                    # can run this function on unlabeled data. All other datasets must exist.
+                    if name in {"doc_gold", "token_labels"}:
                         pass
                     else:
                         raise
@@ -1260,7 +1931,7 @@ def make_featurized_tokens_file(
         logging.info("Mapping tokens to embeddings ...")
         start = time.time()
         fn = np.vectorize(embeddings.index_for_token, otypes=[np.uint32])
-        text_features[:,0] = fn(lab_token_text_features[:,0])
+        text_features[relevant_tokens,0] = fn(lab_token_text_features[:,0][relevant_tokens])
         # The CombinedEmbeddings class already adds in the keras mask, so we don't have to do it
         # here.
         logging.info("Mapped tokens to embeddings in %.0f seconds", time.time() - start)
@@ -1269,8 +1940,9 @@ def make_featurized_tokens_file(
         logging.info("Mapping fonts to embeddings ...")
         start = time.time()
         fn = np.vectorize(lambda t: mmh3.hash(normalize(t)), otypes=[np.uint32])
-        text_features[:,1] = fn(lab_token_text_features[:,1]) % model_settings.font_hash_size
-        text_features[:,1] += 1  # plus one for keras' masking
+        text_features[relevant_tokens,1] = \
+            fn(lab_token_text_features[:,1][relevant_tokens]) % model_settings.font_hash_size
+        text_features[relevant_tokens,1] += 1  # plus one for keras' masking
         logging.info("Mapped fonts to embeddings in %.0f seconds", time.time() - start)
 
         logging.info("Saving tokens and fonts ...")
@@ -1298,14 +1970,16 @@ def make_featurized_tokens_file(
         # sizes and positions (these are also numeric features)
         docs_completed = 0
         start = time.time()
-        for json_metadata in lab_doc_metadata:
-            json_metadata = json.loads(json_metadata)
+        for doc_index, doc_sha in enumerate(lab_doc_shas):
+            doc_sha = decode_doc_sha(doc_sha)
+            page_rows = lab_page_table[lab_page_bounds[doc_index]:lab_page_bounds[doc_index + 1]]
+            if len(page_rows) <= 0:
+                docs_completed += 1
+                continue
 
             # make ordered lists of space widths and font sizes in the document
-            doc_first_token_index = int(json_metadata["pages"][0]["first_token_index"])
-            doc_token_count = 0
-            for json_page in json_metadata["pages"]:
-                doc_token_count += int(json_page["token_count"])
+            doc_first_token_index = int(page_rows[0]["first_token_index"])
+            doc_token_count = int(page_rows["token_count"].sum())
 
             # report progress
             if (docs_completed + 1) % 100 == 0:
@@ -1325,10 +1999,17 @@ def make_featurized_tokens_file(
             space_widths_in_doc.sort()
             space_width_percentiles_in_doc = percentile_function_from_values(space_widths_in_doc)
 
-            for page_number, json_page in enumerate(json_metadata["pages"]):
-                width, height = json_page["dimensions"]
-                first_token_index = int(json_page["first_token_index"])
-                token_count = int(json_page["token_count"])
+            if relevant_pages_only:
+                page_indices_to_featurize = relevant_page_indices(len(page_rows))
+            else:
+                page_indices_to_featurize = range(len(page_rows))
+            for page_index in page_indices_to_featurize:
+                page_row = page_rows[page_index]
+                page_number = int(page_row["page_number"])
+                width = float(page_row["width"])
+                height = float(page_row["height"])
+                first_token_index = int(page_row["first_token_index"])
+                token_count = int(page_row["token_count"])
                 one_past_last_token_index = first_token_index + token_count
 
                 numeric_features = \
@@ -1377,7 +2058,7 @@ def make_featurized_tokens_file(
 
                 # overlap the tokens' bounding boxes with bounding boxes from vision
                 bounding_boxes_from_vision = \
-                    vision_output.boxes_for_sha_and_page(json_metadata["doc_sha"], page_number)
+                    vision_output.boxes_for_sha_and_page(doc_sha, page_number)
                 title_bounding_boxes = [
                     (bb.left, bb.top, bb.right, bb.bottom)
                     for bb in bounding_boxes_from_vision
@@ -1451,8 +2132,9 @@ def make_featurized_tokens_file(
             shape=(len(lab_token_text_features), 7),
             dtype=np.float32)
         start = time.time()
-        for token_index, token in enumerate(lab_token_text_features[:,0]):
-            capitalization_features[token_index] = stringmatch.capitalization_features(token)
+        tokens = lab_token_text_features[:,0]
+        for token_index in np.arange(len(tokens))[relevant_tokens]:
+            capitalization_features[token_index] = stringmatch.capitalization_features(tokens[token_index])
             # The -0.5 offset is applied at the end.
         scaled_numeric_features[:, 10:10+7] = capitalization_features
         logging.info("Computed capitalization features in %.2f seconds", time.time() - start)
@@ -1466,12 +2148,7 @@ def make_featurized_tokens_file(
             pass
         raise
 
-def featurized_tokens_file(
-    bucket_path: str,
-    token_stats: TokenStatistics,
-    embeddings: CombinedEmbeddings,
-    model_settings: settings.ModelSettings
-):
+def _featurizing_hash(model_settings: settings.ModelSettings) -> int:
     # The hash of this structure becomes part of the filename, so if it changes, we essentially
     # invalidate the cache of featurized data.
     featurizing_hash_components = (
@@ -1484,12 +2161,19 @@ def featurized_tokens_file(
 
     # reverse the tuple, to help the hash function
     featurizing_hash_components = featurizing_hash_components[::-1]
+    return abs(hash(featurizing_hash_components))
 
+def featurized_tokens_file(
+    bucket_path: str,
+    token_stats: TokenStatistics,
+    embeddings: CombinedEmbeddings,
+    model_settings: settings.ModelSettings
+):
     featurized_tokens_path = \
         os.path.join(
             bucket_path,
             "featurized-tokens-%02x-%s.h5" %
-            (abs(hash(featurizing_hash_components)), FEATURIZED_TOKENS_VERSION))
+            (_featurizing_hash(model_settings), FEATURIZED_TOKENS_VERSION))
     if os.path.exists(featurized_tokens_path):
         return h5py.File(featurized_tokens_path, "r")
 
@@ -1544,99 +2228,347 @@ DocumentBase = collections.namedtuple(
 # Because the default representation of these makes debugging unbearably slow, we're overwriting
 # how they present themselves.
 
+class LazyChunkTokens(object):
+    """Token strings for a chunk of documents, read from the h5 file on first access.
+
+    Reading the strings is slow, and training never needs them, so we put this off as long as we
+    can. When we do need them, we read them for the whole chunk at once."""
+
+    def __init__(self, token_text_features: h5py.Dataset, first: int, one_past_last: int):
+        self.token_text_features = token_text_features
+        self.first = first
+        self.one_past_last = one_past_last
+        self.tokens = None
+
+    def get(self) -> np.ndarray:
+        if self.tokens is None:
+            self.tokens = self.token_text_features[self.first:self.one_past_last, 0]
+        return self.tokens
+
+class LazyPageTokens(object):
+    """The part of a LazyChunkTokens that belongs to one page"""
+
+    __slots__ = ["chunk_tokens", "first", "one_past_last"]
+
+    def __init__(self, chunk_tokens: LazyChunkTokens, first: int, one_past_last: int):
+        self.chunk_tokens = chunk_tokens
+        self.first = first
+        self.one_past_last = one_past_last
+
+    def __len__(self) -> int:
+        return self.one_past_last - self.first
+
+    def get(self) -> np.ndarray:
+        return self.chunk_tokens.get()[self.first:self.one_past_last]
+
 class Page(PageBase):
     def __str__(self):
         return "Page(%d, ...)" % self.page_number
     def __repr__(self):
         return "Page(%d, ...)" % self.page_number
 
+    @property
+    def tokens(self) -> np.ndarray:
+        tokens = PageBase.tokens.__get__(self)
+        if isinstance(tokens, LazyPageTokens):
+            tokens = tokens.get()
+        return tokens
+
+    @property
+    def token_count(self) -> int:
+        """The number of tokens on the page. Use this instead of len(page.tokens), so we don't
+        have to read the token strings."""
+        return len(self.token_hashes)
+
 class Document(DocumentBase):
     def __str__(self):
         return "Document('%s', ...)" % self.doc_id
     def __repr__(self):
         return "Document('%s', ...)" % self.doc_id
 
+    @property
+    def page_count(self) -> int:
+        return len(self.pages)
+
     def get_relevant_pages(self) -> typing.Generator[Page, None, None]:
         """Returns first three and last three pages, but not pages that have no tokens."""
-        page_indices = {0, 1, 2, -1, -2, -3, -4, -5}
         pages = self.pages
-        page_indices_for_this_doc = {i % len(pages) for i in page_indices}
-        pages = [pages[i] for i in page_indices_for_this_doc]
+        pages = [pages[i] for i in relevant_page_indices(len(pages))]
         for page in pages:
-            if len(page.tokens) > 0:
+            if page.token_count > 0:
                 yield page
 
+def _document_from_page_rows(
+    doc_id: str,
+    doc_sha: str,
+    doc_gold: typing.Optional[dict],
+    page_rows: np.ndarray,
+    token_text_features: typing.Union[np.ndarray, LazyChunkTokens],
+    token_hashed_text_features: np.ndarray,
+    token_numeric_features: np.ndarray,
+    token_scaled_numeric_features: np.ndarray,
+    token_labels: typing.Optional[np.ndarray],
+    max_tokens_per_page: typing.Optional[int] = None,
+    token_offset: int = 0
+) -> Document:
+    """Makes a document out of its rows in the page table and the feature arrays.
+
+    The feature arrays don't have to start at the beginning of the bucket. token_offset says which
+    token in the bucket the first row of the arrays corresponds to."""
+    first_token_indices = page_rows["first_token_index"] - token_offset
+    token_counts = page_rows["token_count"]
+    if max_tokens_per_page is not None:
+        token_counts = np.minimum(token_counts, max_tokens_per_page)
+    last_token_indices_plus_one = first_token_indices + token_counts
+
+    pages = []
+    for page_row, first_token_index, last_token_index_plus_one in \
+            zip(page_rows, first_token_indices, last_token_indices_plus_one):
+        if token_labels is not None:
+            labels = token_labels[first_token_index:last_token_index_plus_one]
+        else:
+            labels = None
+
+        if isinstance(token_text_features, LazyChunkTokens):
+            tokens = LazyPageTokens(
+                token_text_features,
+                first_token_index,
+                last_token_index_plus_one)
+        else:
+            tokens = token_text_features[first_token_index:last_token_index_plus_one, 0]
+
+        pages.append(Page(
+            int(page_row["page_number"]),
+            float(page_row["width"]),
+            float(page_row["height"]),
+            tokens = tokens,
+            token_hashes = \
+                token_hashed_text_features[first_token_index:last_token_index_plus_one, 0],
+            font_hashes = \
+                token_hashed_text_features[first_token_index:last_token_index_plus_one, 1],
+            numeric_features = \
+                token_numeric_features[first_token_index:last_token_index_plus_one, :],
+            scaled_numeric_features = \
+                token_scaled_numeric_features[first_token_index:last_token_index_plus_one, :],
+            labels = labels
+        ))
+
+    if doc_gold is not None:
+        gold_title = trim_punctuation(doc_gold["gold_title"])
+        gold_authors = doc_gold["gold_authors"]
+        gold_bib_titles = doc_gold["gold_bib_titles"]
+        gold_bib_venues = doc_gold["gold_bib_venues"]
+        gold_bib_years = doc_gold["gold_bib_years"]
+        gold_bib_authors = doc_gold["gold_bib_authors"]
+    else:
+        gold_title = None
+        gold_authors = None
+        gold_bib_titles = None
+        gold_bib_venues = None
+        gold_bib_years = None
+        gold_bib_authors = None
+
+    return Document(
+        doc_id,
+        doc_sha,
+        gold_title,
+        gold_authors,
+        gold_bib_titles,
+        gold_bib_authors,
+        gold_bib_venues,
+        gold_bib_years,
+        pages)
+
+# Documents are read from the featurized tokens file in chunks of whole documents. A chunk ends
+# at the first document boundary after this many tokens.
+DOCUMENT_CHUNK_TOKEN_COUNT = 128 * 1024
+# Number of chunks we read ahead in the background, in addition to the chunk that's being consumed.
+DOCUMENT_CHUNK_READ_AHEAD = 2
+
+DocumentChunk = collections.namedtuple(
+    "DocumentChunk", [
+        "token_offset",
+        "doc_ids",
+        "doc_shas",
+        "doc_golds",            # None if we're not reading labels
+        "page_rows",            # one array of page table rows per document
+        "token_text_features",
+        "token_hashed_text_features",
+        "token_numeric_features",
+        "token_scaled_numeric_features",
+        "token_labels"
+    ]
+)
+
+def _document_chunks(
+    featurized_tokens: h5py.File,
+    include_labels: bool,
+    chunk_token_count: int
+) -> typing.Generator[DocumentChunk, None, None]:
+    doc_ids = featurized_tokens["doc_ids"]
+    doc_shas = featurized_tokens["doc_shas"][()]
+    page_table = featurized_tokens["page_table"][()]
+    page_bounds = page_bounds_for_docs(page_table, len(doc_shas))
+    h5_doc_gold = featurized_tokens["doc_gold"] if include_labels else None
+    h5_token_text_features = featurized_tokens["token_text_features"]
+    h5_token_hashed_text_features = featurized_tokens["token_hashed_text_features"]
+    h5_token_numeric_features = featurized_tokens["token_numeric_features"]
+    h5_token_scaled_numeric_features = featurized_tokens["token_scaled_numeric_features"]
+    h5_token_labels = featurized_tokens["token_labels"] if include_labels else None
+
+    doc_starts, doc_ends = token_bounds_for_docs(page_table, page_bounds)
+
+    first_doc_index = 0
+    while first_doc_index < len(doc_shas):
+        first = int(doc_starts[first_doc_index])
+        # The chunk ends with the first document that brings it up to chunk_token_count tokens.
+        one_past_last_doc_index = int(doc_ends.searchsorted(first + chunk_token_count)) + 1
+        one_past_last_doc_index = min(one_past_last_doc_index, len(doc_shas))
+        last = int(doc_ends[one_past_last_doc_index - 1])
+
+        doc_golds = None
+        if h5_doc_gold is not None:
+            doc_golds = [
+                json.loads(doc_gold)
+                for doc_gold in h5_doc_gold[first_doc_index:one_past_last_doc_index]
+            ]
+
+        yield DocumentChunk(
+            first,
+            doc_ids[first_doc_index:one_past_last_doc_index],
+            [decode_doc_sha(doc_sha) for doc_sha in doc_shas[first_doc_index:one_past_last_doc_index]],
+            doc_golds,
+            [
+                page_table[page_bounds[doc_index]:page_bounds[doc_index + 1]]
+                for doc_index in range(first_doc_index, one_past_last_doc_index)
+            ],
+            LazyChunkTokens(h5_token_text_features, first, last),
+            h5_token_hashed_text_features[first:last],
+            h5_token_numeric_features[first:last],
+            h5_token_scaled_numeric_features[first:last],
+            h5_token_labels[first:last] if h5_token_labels is not None else None)
+
+        first_doc_index = one_past_last_doc_index
+
 def documents_for_featurized_tokens(
     featurized_tokens: h5py.File,
     include_labels: bool = True,
-    max_tokens_per_page: typing.Optional[int] = None
+    max_tokens_per_page: typing.Optional[int] = None,
+    chunk_token_count: typing.Optional[int] = None,
+    read_ahead: typing.Optional[int] = None
 ):
-    # read features for the whole bucket at once
-    # We do this for all but token_text_features. Tokens are probably too big.
-    token_hashed_text_features = featurized_tokens["token_hashed_text_features"][()]
-    token_numeric_features = featurized_tokens["token_numeric_features"][()]
-    token_scaled_numeric_features = featurized_tokens["token_scaled_numeric_features"][()]
+    """Streams the documents from a featurized tokens file.
+
+    The token arrays are read one chunk of documents at a time, and the pages we return are views
+    into the chunk. At most read_ahead chunks are read ahead of the one that's being consumed, so
+    memory stays bounded no matter how big the bucket is. Token strings are only read when
+    somebody first looks at page.tokens. chunk_token_count and read_ahead default to
+    DOCUMENT_CHUNK_TOKEN_COUNT and DOCUMENT_CHUNK_READ_AHEAD."""
+    if chunk_token_count is None:
+        chunk_token_count = DOCUMENT_CHUNK_TOKEN_COUNT
+    if read_ahead is None:
+        read_ahead = DOCUMENT_CHUNK_READ_AHEAD
+    chunks = _document_chunks(featurized_tokens, include_labels, chunk_token_count)
+    if read_ahead > 0:
+        chunks = prefetch(chunks, read_ahead, name="Document chunks")
+
+    for chunk in chunks:
+        for doc_index_in_chunk, page_rows in enumerate(chunk.page_rows):
+            yield _document_from_page_rows(
+                chunk.doc_ids[doc_index_in_chunk],
+                chunk.doc_shas[doc_index_in_chunk],
+                chunk.doc_golds[doc_index_in_chunk] if chunk.doc_golds is not None else None,
+                page_rows,
+                chunk.token_text_features,
+                chunk.token_hashed_text_features,
+                chunk.token_numeric_features,
+                chunk.token_scaled_numeric_features,
+                chunk.token_labels,
+                max_tokens_per_page,
+                chunk.token_offset)
+
+DocumentIndexEntry = collections.namedtuple(
+    "DocumentIndexEntry", [
+        "doc_index",
+        "first_page_index",             # row in the page table
+        "one_past_last_page_index",
+        "first_token_index",
+        "one_past_last_token_index"
+    ]
+)
+
+class DocumentIndex(object):
+    """Maps doc shas to where the documents live in a featurized tokens file.
+
+    Building the index only reads doc_shas and the page table, never the token arrays."""
+
+    def __init__(self, featurized_tokens: h5py.File):
+        doc_shas = featurized_tokens["doc_shas"][()]
+        page_table = featurized_tokens["page_table"][()]
+        page_bounds = page_bounds_for_docs(page_table, len(doc_shas))
+        doc_starts, doc_ends = token_bounds_for_docs(page_table, page_bounds)
+
+        self.sha2entry = {}
+        for doc_index, doc_sha in enumerate(doc_shas):
+            doc_sha = decode_doc_sha(doc_sha)
+            if doc_sha in self.sha2entry:
+                logging.warning("Duplicate sha %s in %s", doc_sha, featurized_tokens.filename)
+            self.sha2entry[doc_sha] = DocumentIndexEntry(
+                doc_index,
+                int(page_bounds[doc_index]),
+                int(page_bounds[doc_index + 1]),
+                int(doc_starts[doc_index]),
+                int(doc_ends[doc_index]))
+
+    def __len__(self) -> int:
+        return len(self.sha2entry)
+
+    def __contains__(self, doc_sha: str) -> bool:
+        return doc_sha in self.sha2entry
+
+    def __getitem__(self, doc_sha: str) -> DocumentIndexEntry:
+        return self.sha2entry[doc_sha]
+
+    def doc_shas(self) -> typing.KeysView[str]:
+        return self.sha2entry.keys()
+
+def get_document(
+    featurized_tokens: h5py.File,
+    doc_sha: str,
+    include_labels: bool = False,
+    max_tokens_per_page: typing.Optional[int] = None,
+    index: typing.Optional[DocumentIndex] = None
+) -> Document:
+    """Reads a single document from a featurized tokens file.
+
+    This reads only the slices of the token arrays that belong to the document. If you get more
+    than one document from the same file, pass in a DocumentIndex, so we don't have to rebuild it
+    every time. Labels and gold data are only read with include_labels, since files made for
+    inference don't have them. Raises KeyError if the document is not in the file."""
+    if index is None:
+        index = DocumentIndex(featurized_tokens)
+    entry = index[doc_sha]
+    first = entry.first_token_index
+    last = entry.one_past_last_token_index
+
+    doc_gold = None
     token_labels = None
     if include_labels:
-        token_labels = featurized_tokens["token_labels"][()]
-
-    for doc_metadata in featurized_tokens["doc_metadata"]:
-        doc_metadata = json.loads(doc_metadata)
-        pages = []
-        for page_number, json_page in enumerate(doc_metadata["pages"]):
-            first_token_index = int(json_page["first_token_index"])
-            token_count = int(json_page["token_count"])
-            if max_tokens_per_page is not None:
-                token_count = min(max_tokens_per_page, token_count)
-            last_token_index_plus_one = first_token_index + token_count
-
-            if include_labels:
-                labels = token_labels[first_token_index:last_token_index_plus_one]
-            else:
-                labels = None
-
-            pages.append(Page(
-                page_number,
-                float(json_page["dimensions"][0]),
-                float(json_page["dimensions"][1]),
-                tokens = \
-                    featurized_tokens["token_text_features"][first_token_index:last_token_index_plus_one, 0],
-                token_hashes = \
-                    token_hashed_text_features[first_token_index:last_token_index_plus_one, 0],
-                font_hashes = \
-                    token_hashed_text_features[first_token_index:last_token_index_plus_one, 1],
-                numeric_features = \
-                    token_numeric_features[first_token_index:last_token_index_plus_one, :],
-                scaled_numeric_features = \
-                    token_scaled_numeric_features[first_token_index:last_token_index_plus_one, :],
-                labels = labels
-            ))
-
-        if include_labels:
-            gold_title = trim_punctuation(doc_metadata["gold_title"])
-            gold_authors = doc_metadata["gold_authors"]
-            gold_bib_titles = doc_metadata["gold_bib_titles"]
-            gold_bib_venues = doc_metadata["gold_bib_venues"]
-            gold_bib_years = doc_metadata["gold_bib_years"]
-            gold_bib_authors = doc_metadata["gold_bib_authors"]
-        else:
-            gold_title = None
-            gold_authors = None
-            gold_bib_titles = None
-            gold_bib_venues = None
-            gold_bib_years = None
-            gold_bib_authors = None
-
-        yield Document(
-            doc_metadata["doc_id"],
-            doc_metadata["doc_sha"],
-            gold_title,
-            gold_authors,
-            gold_bib_titles,
-            gold_bib_authors,
-            gold_bib_venues,
-            gold_bib_years,
-            pages)
+        doc_gold = json.loads(featurized_tokens["doc_gold"][entry.doc_index])
+        token_labels = featurized_tokens["token_labels"][first:last]
+
+    return _document_from_page_rows(
+        featurized_tokens["doc_ids"][entry.doc_index],
+        doc_sha,
+        doc_gold,
+        featurized_tokens["page_table"][entry.first_page_index:entry.one_past_last_page_index],
+        featurized_tokens["token_text_features"][first:last],
+        featurized_tokens["token_hashed_text_features"][first:last],
+        featurized_tokens["token_numeric_features"][first:last],
+        featurized_tokens["token_scaled_numeric_features"][first:last],
+        token_labels,
+        max_tokens_per_page,
+        first)
 
 def documents_for_bucket(
     bucket_path: str,
@@ -1658,25 +2590,36 @@ class DocumentSet(Enum):
     TEST = 2
     VALIDATE = 3
 
+def tokenstats_filename_for_pmc_dir(pmc_dir: str) -> str:
+    return os.path.join(pmc_dir, "tokens6.tokenstats.pickle.gz")
+
 def tokenstats_for_pmc_dir(pmc_dir: str) -> TokenStatistics:
-    return TokenStatistics(os.path.join(pmc_dir, "tokens6.tokenstats.pickle.gz"))
+    return shared_token_statistics(tokenstats_filename_for_pmc_dir(pmc_dir))
 
-def documents(
+def embeddings_for_pmc_dir(
     pmc_dir: str,
-    model_settings: settings.ModelSettings,
-    document_set:DocumentSet = DocumentSet.TRAIN
-):
+    model_settings: settings.ModelSettings
+) -> CombinedEmbeddings:
+    return shared_combined_embeddings(tokenstats_filename_for_pmc_dir(pmc_dir), model_settings)
+
+def buckets_for_document_set(document_set: DocumentSet) -> typing.List[str]:
     if document_set is DocumentSet.TEST:
         buckets = range(0xf0, 0x100)
     elif document_set is DocumentSet.VALIDATE:
         buckets = range(0xe0, 0xf0)
     else:
         buckets = range(0x00, 0xe0)
-    buckets = ["%02x" % x for x in buckets]
+    return ["%02x" % x for x in buckets]
+
+def documents(
+    pmc_dir: str,
+    model_settings: settings.ModelSettings,
+    document_set:DocumentSet = DocumentSet.TRAIN
+):
+    buckets = buckets_for_document_set(document_set)
 
     token_stats = tokenstats_for_pmc_dir(pmc_dir)
-    glove = GloveVectors(model_settings.glove_vectors)
-    embeddings = CombinedEmbeddings(token_stats, glove, model_settings.embedded_tokens_fraction)
+    embeddings = embeddings_for_pmc_dir(pmc_dir, model_settings)
 
     for bucket in buckets:
         yield from documents_for_bucket(
@@ -1911,15 +2854,273 @@ def dump_documents(
     pmc_dir: str,
     token_stats: TokenStatistics,
     embeddings: CombinedEmbeddings,
-    model_settings: settings.ModelSettings
+    model_settings: settings.ModelSettings,
+    doc_shas: typing.Optional[typing.List[str]] = None
 ):
     bucket_path = os.path.join(pmc_dir, bucket_number)
-    for doc in documents_for_bucket(bucket_path, token_stats, embeddings, model_settings):
-        pdf_path = os.path.join(bucket_path, "..", doc.doc_id)
-        assert pdf_path.endswith(".pdf")
-        html_path = pdf_path[:-3] + "html"
-        with open(html_path, "w", encoding="UTF-8") as html_file:
-            dump_document(doc, html_file)
+
+    def dump(docs: typing.Iterable[Document]):
+        for doc in docs:
+            pdf_path = os.path.join(bucket_path, "..", doc.doc_id)
+            assert pdf_path.endswith(".pdf")
+            html_path = pdf_path[:-3] + "html"
+            with open(html_path, "w", encoding="UTF-8") as html_file:
+                dump_document(doc, html_file)
+
+    if doc_shas is None:
+        dump(documents_for_bucket(bucket_path, token_stats, embeddings, model_settings))
+        return
+
+    with featurized_tokens_file(
+        bucket_path,
+        token_stats,
+        embeddings,
+        model_settings
+    ) as featurized:
+        index = DocumentIndex(featurized)
+        dump(
+            get_document(featurized, doc_sha, include_labels=True, index=index)
+            for doc_sha in doc_shas
+            if doc_sha in index)
+
+
+#
+# Training Shards 🧱
+#
+
+# A training shard holds only what training reads from a bucket: the relevant pages of each
+# document that have at least one labeled token. The pages are sorted by length, and their tokens
+# are stored in the same order, so pages of similar length are contiguous rows.
+#  * doc_ids: one string per document that has pages in the shard
+#  * page_table: one row per page, sorted by token_count, with the columns below
+#  * token_hashed_text_features, token_scaled_numeric_features, token_labels: the same as in
+#    the featurized tokens file, for the tokens of the pages in the shard
+TRAINING_SHARD_VERSION = "shard1"
+
+TRAINING_SHARD_PAGE_TABLE_DTYPE = np.dtype([
+    ("doc_index", np.int32),
+    ("page_number", np.int32),
+    ("doc_page_count", np.int32),   # number of pages in the whole document
+    ("first_token_index", np.int64),
+    ("token_count", np.int32)
+])
+
+# Pages in a training shard belong to one of these instead of a full Document.
+TrainingDocument = collections.namedtuple("TrainingDocument", ["doc_id", "page_count"])
+
+def _labeled_page_mask(h5_token_labels: h5py.Dataset, page_rows: np.ndarray) -> np.ndarray:
+    """Returns which of the given pages have at least one labeled token. The pages have to be in
+    the order of their tokens. Labels are read a chunk at a time."""
+    result = np.zeros(len(page_rows), dtype=np.bool_)
+    first_token_indices = page_rows["first_token_index"].astype(np.int64)
+    token_ends = first_token_indices + page_rows["token_count"]
+    first_page_in_chunk = 0
+    while first_page_in_chunk < len(page_rows):
+        first = int(first_token_indices[first_page_in_chunk])
+        one_past_last_page_in_chunk = \
+            int(token_ends.searchsorted(first + DOCUMENT_CHUNK_TOKEN_COUNT, side="right"))
+        one_past_last_page_in_chunk = max(one_past_last_page_in_chunk, first_page_in_chunk + 1)
+        last = int(token_ends[one_past_last_page_in_chunk - 1])
+        chunk_label_counts = np.concatenate([[0], np.cumsum(h5_token_labels[first:last] != 0)])
+        chunk_pages = slice(first_page_in_chunk, one_past_last_page_in_chunk)
+        result[chunk_pages] = \
+            chunk_label_counts[token_ends[chunk_pages] - first] > \
+            chunk_label_counts[first_token_indices[chunk_pages] - first]
+        first_page_in_chunk = one_past_last_page_in_chunk
+    return result
+
+def make_training_shard_file(output_file_name: str, featurized_tokens: h5py.File):
+    """Writes the pages that training uses from a featurized tokens file into a training shard.
+
+    Only the page tables are held in memory whole. The labels are scanned a chunk at a time to
+    find the pages that go into the shard, and then the pages are copied in length order, about
+    DOCUMENT_CHUNK_TOKEN_COUNT tokens at a time, so memory use does not grow with the bucket."""
+    doc_ids = featurized_tokens["doc_ids"]
+    doc_count = len(featurized_tokens["doc_shas"])
+    page_table = featurized_tokens["page_table"][()]
+    page_bounds = page_bounds_for_docs(page_table, doc_count)
+    h5_token_labels = featurized_tokens["token_labels"]
+    h5_token_hashed_text_features = featurized_tokens["token_hashed_text_features"]
+    h5_token_scaled_numeric_features = featurized_tokens["token_scaled_numeric_features"]
+
+    # find the pages that go into the shard, in the order of the featurized tokens file
+    source_page_indices = []
+    for doc_index in range(doc_count):
+        first_page_index = int(page_bounds[doc_index])
+        page_count = int(page_bounds[doc_index + 1]) - first_page_index
+        source_page_indices.extend(
+            first_page_index + page_index
+            for page_index in sorted(relevant_page_indices(page_count)))
+    source_page_rows = page_table[np.array(source_page_indices, dtype=np.int64)]
+    source_page_rows = source_page_rows[source_page_rows["token_count"] > 0]
+    source_page_rows = source_page_rows[_labeled_page_mask(h5_token_labels, source_page_rows)]
+
+    shard_doc_indices = np.unique(source_page_rows["doc_index"])
+    shard_page_table = np.zeros(len(source_page_rows), dtype=TRAINING_SHARD_PAGE_TABLE_DTYPE)
+    shard_page_table["doc_index"] = shard_doc_indices.searchsorted(source_page_rows["doc_index"])
+    shard_page_table["page_number"] = source_page_rows["page_number"]
+    shard_page_table["doc_page_count"] = np.diff(page_bounds)[source_page_rows["doc_index"]]
+    shard_page_table["token_count"] = source_page_rows["token_count"]
+
+    # sort by length, and lay out the tokens in the same order
+    order = np.argsort(shard_page_table["token_count"], kind="mergesort")
+    shard_page_table = shard_page_table[order]
+    source_page_rows = source_page_rows[order]
+    token_counts = shard_page_table["token_count"].astype(np.int64)
+    shard_page_table["first_token_index"] = np.cumsum(token_counts) - token_counts
+    token_count = int(token_counts.sum())
+
+    shard_file = h5py.File(output_file_name, "w-", libver="latest")
+    try:
+        shard_file.create_dataset(
+            "doc_ids",
+            dtype=h5_unicode_type,
+            data=[doc_ids[doc_index] for doc_index in shard_doc_indices])
+        shard_file.create_dataset("page_table", data=shard_page_table)
+        sources_and_destinations = []
+        for name, source, dtype in [
+            ("token_hashed_text_features", h5_token_hashed_text_features, np.uint32),
+            ("token_scaled_numeric_features", h5_token_scaled_numeric_features, np.float32),
+            ("token_labels", h5_token_labels, np.int8)
+        ]:
+            destination = shard_file.create_dataset(
+                name,
+                shape=(token_count,) + source.shape[1:],
+                dtype=dtype,
+                compression="gzip",
+                compression_opts=9)
+            sources_and_destinations.append((source, destination))
+
+        # copy the tokens in the order of the shard, a chunk at a time
+        first_page_in_chunk = 0
+        while first_page_in_chunk < len(shard_page_table):
+            first = int(shard_page_table[first_page_in_chunk]["first_token_index"])
+            one_past_last_page_in_chunk = int(shard_page_table["first_token_index"].searchsorted(
+                first + DOCUMENT_CHUNK_TOKEN_COUNT,
+                side="left"))
+            one_past_last_page_in_chunk = max(one_past_last_page_in_chunk, first_page_in_chunk + 1)
+            chunk_source_rows = source_page_rows[first_page_in_chunk:one_past_last_page_in_chunk]
+            last = first + int(chunk_source_rows["token_count"].sum())
+            for source, destination in sources_and_destinations:
+                destination[first:last] = np.concatenate([
+                    source[source_first:source_first + source_token_count]
+                    for source_first, source_token_count in zip(
+                        chunk_source_rows["first_token_index"].astype(np.int64),
+                        chunk_source_rows["token_count"].astype(np.int64))
+                ])
+            first_page_in_chunk = one_past_last_page_in_chunk
+        shard_file.close()
+    except:
+        shard_file.close()
+        try:
+            os.remove(output_file_name)
+        except FileNotFoundError:
+            pass
+        raise
+    logging.info(
+        "Wrote %d pages with %d tokens from %d documents to %s",
+        len(shard_page_table),
+        token_count,
+        len(shard_doc_indices),
+        output_file_name)
+
+class TrainingShard(object):
+    """A training shard, opened for reading. The shard closes the file when it's closed."""
+
+    def __init__(self, shard_file: h5py.File):
+        self.shard_file = shard_file
+        self.doc_ids = shard_file["doc_ids"][()]
+        self.page_table = shard_file["page_table"][()]
+
+    def close(self):
+        self.shard_file.close()
+
+    def __len__(self) -> int:
+        return len(self.page_table)
+
+    def token_counts(self) -> np.ndarray:
+        """The length of every page in the shard, sorted"""
+        return self.page_table["token_count"]
+
+    def pages(
+        self,
+        first_page_index: int,
+        one_past_last_page_index: int
+    ) -> typing.List[typing.Tuple[TrainingDocument, Page]]:
+        """Reads a range of pages. Their tokens are contiguous, so this is one read per array.
+        The pages have no token strings and no raw numeric features."""
+        page_rows = self.page_table[first_page_index:one_past_last_page_index]
+        if len(page_rows) <= 0:
+            return []
+        first = int(page_rows[0]["first_token_index"])
+        last = int(page_rows[-1]["first_token_index"]) + int(page_rows[-1]["token_count"])
+        token_hashed_text_features = self.shard_file["token_hashed_text_features"][first:last]
+        token_scaled_numeric_features = self.shard_file["token_scaled_numeric_features"][first:last]
+        token_labels = self.shard_file["token_labels"][first:last]
+
+        result = []
+        for page_row in page_rows:
+            page_first = int(page_row["first_token_index"]) - first
+            page_last = page_first + int(page_row["token_count"])
+            doc = TrainingDocument(
+                self.doc_ids[page_row["doc_index"]],
+                int(page_row["doc_page_count"]))
+            page = Page(
+                int(page_row["page_number"]),
+                None,
+                None,
+                tokens=None,
+                token_hashes=token_hashed_text_features[page_first:page_last, 0],
+                font_hashes=token_hashed_text_features[page_first:page_last, 1],
+                numeric_features=None,
+                scaled_numeric_features=token_scaled_numeric_features[page_first:page_last, :],
+                labels=token_labels[page_first:page_last])
+            result.append((doc, page))
+        return result
+
+def training_shard_path(bucket_path: str, model_settings: settings.ModelSettings) -> str:
+    return os.path.join(
+        bucket_path,
+        "training-shard-%02x-%s-%s.h5" %
+        (_featurizing_hash(model_settings), FEATURIZED_TOKENS_VERSION, TRAINING_SHARD_VERSION))
+
+def training_shard_file(
+    bucket_path: str,
+    token_stats: TokenStatistics,
+    embeddings: CombinedEmbeddings,
+    model_settings: settings.ModelSettings
+) -> h5py.File:
+    shard_path = training_shard_path(bucket_path, model_settings)
+    if os.path.exists(shard_path):
+        return h5py.File(shard_path, "r")
+
+    logging.info("%s does not exist, will recreate", shard_path)
+
+    temp_training_shard_path = shard_path + ".%d.temp" % os.getpid()
+    with featurized_tokens_file(bucket_path, token_stats, embeddings, model_settings) as featurized:
+        make_training_shard_file(temp_training_shard_path, featurized)
+    os.rename(temp_training_shard_path, shard_path)
+    return h5py.File(shard_path, "r")
+
+def training_shards(
+    pmc_dir: str,
+    model_settings: settings.ModelSettings,
+    buckets: typing.Optional[typing.List[str]] = None
+) -> typing.Generator[TrainingShard, None, None]:
+    """Yields the training shards for the given buckets, or for all the training buckets, making
+    the ones that don't exist yet. The caller has to close the shards."""
+    if buckets is None:
+        buckets = buckets_for_document_set(DocumentSet.TRAIN)
+
+    token_stats = tokenstats_for_pmc_dir(pmc_dir)
+    embeddings = embeddings_for_pmc_dir(pmc_dir, model_settings)
+
+    for bucket in buckets:
+        yield TrainingShard(training_shard_file(
+            os.path.join(pmc_dir, bucket),
+            token_stats,
+            embeddings,
+            model_settings))
 
 
 def main():
@@ -1928,6 +3129,7 @@ def main():
     # find which command to run
     commands = {
         "warm": "Warms the cache for buckets in the PMC directory",
+        "shard": "Makes the training shards for buckets in the PMC directory",
         "dump": "Dumps labeled and featurized documents to HTML"
     }
 
@@ -1956,6 +3158,13 @@ def main():
         default=model_settings.glove_vectors,
         help="file containing the GloVe vectors"
     )
+    parser.add_argument(
+        "--doc-sha",
+        type=str,
+        action="append",
+        default=None,
+        help="only dump the documents with these shas (can be given multiple times)"
+    )
     parser.add_argument("bucket_number", type=str, nargs='+', help="buckets to process")
     args = parser.parse_args()
 
@@ -1963,15 +3172,26 @@ def main():
     print(model_settings)
 
     token_stats = tokenstats_for_pmc_dir(args.pmc_dir)
-    glove = GloveVectors(model_settings.glove_vectors)
-    embeddings = CombinedEmbeddings(token_stats, glove, model_settings.embedded_tokens_fraction)
+    embeddings = embeddings_for_pmc_dir(args.pmc_dir, model_settings)
 
     for bucket_number in args.bucket_number:
         logging.info("Processing bucket %s", bucket_number)
         if command == "warm":
             prepare_bucket(bucket_number, args.pmc_dir, token_stats, embeddings, model_settings)
+        elif command == "shard":
+            training_shard_file(
+                os.path.join(args.pmc_dir, bucket_number),
+                token_stats,
+                embeddings,
+                model_settings).close()
         elif command == "dump":
-            dump_documents(bucket_number, args.pmc_dir, token_stats, embeddings, model_settings)
+            dump_documents(
+                bucket_number,
+                args.pmc_dir,
+                token_stats,
+                embeddings,
+                model_settings,
+                args.doc_sha)
 
 if __name__ == "__main__":
     main()
@@ -92,6 +92,27 @@ def main():
         default=default_dataprep_port,
         help="Port where the dataprep service is running"
     )
+    parser.add_argument(
+        "--postprocessing-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of processes that find titles, authors and bibs in the model's predictions"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["keras", "numpy"],
+        default="keras",
+        help="run the model with Keras, or with NumPy without loading TensorFlow"
+    )
+    parser.add_argument(
+        "--weight-precision",
+        choices=["float32", "float16", "int8"],
+        default="float32",
+        help="with --backend numpy, keep the big weight matrices in this precision to save memory. "
+             "This is not faster: the matrices go back to float32 for every batch. The accuracy "
+             "of float16 and int8 has not been validated; measure it first with "
+             "with_labels.py --evaluate-only --numpy-precisions"
+    )
     args = parser.parse_args()
 
     taskdb_kwargs = dict(
@@ -130,8 +151,15 @@ def main():
     )
 
     import with_labels  # Heavy import, so we do it here
-    model = with_labels.model_with_labels(model_settings, embeddings)
-    model.load_weights("model/C49.h5")
+    if args.backend == "numpy":
+        import numpy_model
+        model = numpy_model.NumpyModel.load("model/C49.h5", args.weight_precision)
+    else:
+        model = with_labels.inference_model_with_labels(model_settings, embeddings, "model/C49.h5")
+    dehyphenator = with_labels.Dehyphenator(embeddings.glove_vocab())
+    postprocessing_pool = None
+    if args.postprocessing_workers > 0:
+        postprocessing_pool = with_labels.PostprocessingPool(args.postprocessing_workers, dehyphenator)
     model_version = 2
 
     logging.info("Starting to process tasks")
@@ -248,7 +276,7 @@ def main():
 
             # pick out errors and write them to the DB
             paper_id_to_error = {}
-            for line in dataprep2.json_from_file(json_file_name):
+            for line in dataprep2.json_from_file(json_file_name, workers=1):  # don't fork TensorFlow
                 if not "error" in line:
                     continue
                 error = line["error"]
@@ -272,7 +300,9 @@ def main():
             dataprep2.make_unlabeled_tokens_file(
                 json_file_name,
                 unlabeled_tokens_file_name,
-                ignore_errors=True)
+                ignore_errors=True,
+                relevant_pages_only=True,
+                json_workers=1)     # don't fork with TensorFlow loaded
             os.remove(json_file_name)
             making_unlabeled_tokens_time = time.time() - making_unlabeled_tokens_time
             logging.info("Made unlabeled tokens in %.2f seconds", making_unlabeled_tokens_time)
@@ -289,7 +319,8 @@ def main():
                     token_stats,
                     embeddings,
                     dataprep2.VisionOutput(None),
-                    model_settings
+                    model_settings,
+                    relevant_pages_only=True
                 )
                 # We don't delete the unlabeled file here because the featurized one contains references
                 # to it.
@@ -299,7 +330,10 @@ def main():
 
             yield temp_dir, featurized_tokens_file_name
 
-    for temp_dir, featurized_tokens_file_name in dataprep2.threaded_generator(featurized_tokens_filenames(), 1):
+    # Prepares the next batch of papers while the model runs on the current one. If preparing
+    # fails, the loop raises the same exception.
+    featurized_batches = dataprep2.prefetch(featurized_tokens_filenames(), 1, name="Featurized batches")
+    for temp_dir, featurized_tokens_file_name in featurized_batches:
         try:
             logging.info("Making and sending results ...")
             make_and_send_results_time = time.time()
@@ -307,14 +341,15 @@ def main():
                 def get_docs():
                     return dataprep2.documents_for_featurized_tokens(
                         featurized_tokens_file,
-                        include_labels=False,
-                        max_tokens_per_page=model_settings.tokens_per_batch)
+                        include_labels=False)
                 results = with_labels.run_model(
                     model,
                     model_settings,
-                    embeddings.glove_vocab(),
+                    dehyphenator,
                     get_docs,
-                    enabled_modes={"predictions"})
+                    enabled_modes={"predictions"},
+                    window_size=model_settings.tokens_per_batch,
+                    postprocessing_pool=postprocessing_pool)
                 results = {
                     doc.doc_sha: {
                         "docName": doc.doc_id,
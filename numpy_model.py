@@ -0,0 +1,432 @@
+import collections
+import logging
+import typing
+
+import h5py
+import numpy as np
+
+#
+# Weights 🏋
+#
+
+LstmWeights = collections.namedtuple(
+    "LstmWeights", [
+        "kernel",             # (input size, 4 * units), gates in the order i, f, c, o
+        "recurrent_kernel",   # (units, 4 * units)
+        "bias"                # (4 * units,)
+    ]
+)
+
+CrfWeights = collections.namedtuple(
+    "CrfWeights", [
+        "kernel",             # (input size, label count)
+        "chain_kernel",       # (label count, label count), from the label at t to the label at t+1
+        "bias",
+        "left_boundary",
+        "right_boundary"
+    ]
+)
+
+# The layers of with_labels.model_with_labels() that have weights, in the order Keras saves them.
+# The LSTM and CRF layers don't have names, so we find them by their position.
+_NAMED_LAYERS = [
+    "pageno_embedding",
+    "pageno_from_back_embedding",
+    "token_embedding",
+    "font_embedding",
+    "churned_tokens"
+]
+_UNNAMED_LAYER_COUNT = 3   # two bidirectional LSTMs and the CRF
+
+def _layer_weights_from_h5(filename: str) -> typing.List[typing.Tuple[str, typing.List[np.ndarray]]]:
+    """Reads (layer name, weights) for every layer with weights from a file written by Keras'
+    save_weights() or save()"""
+    with h5py.File(filename, "r") as f:
+        if "model_weights" in f:
+            f = f["model_weights"]
+        result = []
+        for layer_name in f.attrs["layer_names"]:
+            if isinstance(layer_name, bytes):
+                layer_name = layer_name.decode("utf8")
+            g = f[layer_name]
+            weights = []
+            for weight_name in g.attrs["weight_names"]:
+                if isinstance(weight_name, bytes):
+                    weight_name = weight_name.decode("utf8")
+                weights.append(np.asarray(g[weight_name], dtype=np.float32))
+            if len(weights) > 0:
+                result.append((layer_name, weights))
+        return result
+
+#
+# Reduced precision 🗜
+#
+
+PRECISIONS = ["float32", "float16", "int8"]
+
+class Int8Matrix(object):
+    """A weight matrix stored as int8, with a float32 scale for every column (output channel)"""
+
+    def __init__(self, matrix: np.ndarray):
+        scale = np.abs(matrix).max(axis=0) / 127.0
+        scale[scale == 0.0] = 1.0
+        self.scale = scale.astype(np.float32)
+        self.values = np.round(matrix / self.scale).astype(np.int8)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.scale.nbytes
+
+    def rows(self, indices: np.ndarray) -> np.ndarray:
+        result = self.values[indices].astype(np.float32)
+        result *= self.scale
+        return result
+
+    def float32(self) -> np.ndarray:
+        return self.rows(slice(None))
+
+def _reduce_precision(matrix: np.ndarray, precision: str):
+    if precision == "float32":
+        return matrix
+    elif precision == "float16":
+        return matrix.astype(np.float16)
+    elif precision == "int8":
+        return Int8Matrix(matrix)
+    else:
+        raise ValueError("Unknown precision %s; choose one of %s" % (precision, PRECISIONS))
+
+def _float32(matrix) -> np.ndarray:
+    """Turns a matrix that might be stored in reduced precision back into float32 for computing"""
+    if isinstance(matrix, Int8Matrix):
+        return matrix.float32()
+    return matrix.astype(np.float32, copy=False)
+
+def _rows(matrix, indices: np.ndarray) -> np.ndarray:
+    """Embedding lookup in a matrix that might be stored in reduced precision"""
+    if isinstance(matrix, Int8Matrix):
+        return matrix.rows(indices)
+    return matrix[indices].astype(np.float32, copy=False)
+
+#
+# Layers 🥞
+#
+
+def _hard_sigmoid_(x: np.ndarray) -> np.ndarray:
+    """Keras' default recurrent activation, in place"""
+    x *= 0.2
+    x += 0.5
+    return np.clip(x, 0.0, 1.0, out=x)
+
+def _bidirectional_lstm(
+    x: np.ndarray,
+    mask: np.ndarray,
+    forward: LstmWeights,
+    backward: LstmWeights
+) -> np.ndarray:
+    """Runs Bidirectional(LSTM(return_sequences=True)) over x, which is (pages, tokens, features).
+
+    Both directions run in the same loop, so each step is a single batched matmul. Like Keras,
+    masked steps carry the state and the output of the previous step forward."""
+    page_count, token_count, _ = x.shape
+    units = forward.recurrent_kernel.shape[0]
+
+    # The input projections for all tokens and both directions are one big matmul.
+    kernel = np.concatenate([_float32(forward.kernel), _float32(backward.kernel)], axis=1)
+    bias = np.concatenate([forward.bias, backward.bias])
+    x_projected = np.dot(x.reshape((-1, x.shape[-1])), kernel)
+    x_projected += bias
+    x_projected = x_projected.reshape((page_count, token_count, 2, 4 * units))
+
+    recurrent_kernels = np.stack([
+        _float32(forward.recurrent_kernel),
+        _float32(backward.recurrent_kernel)
+    ])
+    h = np.zeros((2, page_count, units), dtype=np.float32)
+    c = np.zeros((2, page_count, units), dtype=np.float32)
+    z = np.empty((2, page_count, 4 * units), dtype=np.float32)
+    mask = mask[:, :, np.newaxis]
+    result = np.empty((page_count, token_count, 2 * units), dtype=np.float32)
+
+    for t in range(token_count):
+        t_backward = token_count - 1 - t
+        np.matmul(h, recurrent_kernels, out=z)
+        z[0] += x_projected[:, t, 0]
+        z[1] += x_projected[:, t_backward, 1]
+
+        i = _hard_sigmoid_(z[:, :, :units])
+        f = _hard_sigmoid_(z[:, :, units:2 * units])
+        g = np.tanh(z[:, :, 2 * units:3 * units], out=z[:, :, 2 * units:3 * units])
+        o = _hard_sigmoid_(z[:, :, 3 * units:])
+        new_c = f * c
+        new_c += i * g
+        new_h = o * np.tanh(new_c)
+
+        step_mask = np.stack([mask[:, t], mask[:, t_backward]])
+        c = np.where(step_mask, new_c, c)
+        h = np.where(step_mask, new_h, h)
+        result[:, t, :units] = h[0]
+        result[:, t_backward, units:] = h[1]
+
+    return result
+
+def _crf_input_energy(x: np.ndarray, mask: np.ndarray, crf: CrfWeights) -> np.ndarray:
+    """The per-token label energies, with the boundary energies added the way keras_contrib's CRF
+    adds them"""
+    energy = np.dot(x.reshape((-1, x.shape[-1])), crf.kernel)
+    energy += crf.bias
+    energy = energy.reshape(x.shape[:2] + (crf.kernel.shape[1],))
+
+    mask = mask.astype(np.float32)
+    shifted_right = np.zeros_like(mask)
+    shifted_right[:, 1:] = mask[:, :-1]
+    shifted_left = np.zeros_like(mask)
+    shifted_left[:, :-1] = mask[:, 1:]
+    start_mask = (mask > shifted_right).astype(np.float32)
+    # keras_contrib compares the other way around than for the start, so for pages that are padded
+    # at the end, the right boundary never applies. We have to match it, not fix it.
+    end_mask = (shifted_left > mask).astype(np.float32)
+    energy += start_mask[:, :, np.newaxis] * crf.left_boundary
+    energy += end_mask[:, :, np.newaxis] * crf.right_boundary
+    return energy
+
+def _chain_mask(mask: np.ndarray) -> np.ndarray:
+    """The chain energy from a token to the next one counts only if both tokens are unmasked"""
+    chain_mask = mask.copy()
+    chain_mask[:, :-1] *= mask[:, 1:]
+    chain_mask[:, -1] = 0.0
+    return chain_mask
+
+def viterbi_decode(
+    input_energy: np.ndarray,
+    mask: np.ndarray,
+    chain_kernel: np.ndarray
+) -> np.ndarray:
+    """Finds the label sequence with the lowest energy for every page, the same way
+    keras_contrib's CRF does in test mode, and returns the label ids as int8 (pages, tokens)."""
+    page_count, token_count, label_count = input_energy.shape
+    if token_count == 0:
+        return np.zeros((page_count, 0), dtype=np.int8)
+    mask = mask.astype(np.float32)
+    chain_mask = _chain_mask(mask)
+
+    argmin_tables = np.empty((token_count, page_count, label_count), dtype=np.int8)
+    previous_energy = np.zeros((page_count, label_count), dtype=np.float32)
+    for t in range(token_count):
+        token_energy = input_energy[:, t] * mask[:, t, np.newaxis]
+        token_energy += previous_energy
+        # energy[page, label at t, label at t+1]
+        energy = chain_kernel[np.newaxis] * chain_mask[:, t, np.newaxis, np.newaxis]
+        energy += token_energy[:, :, np.newaxis]
+        argmin_tables[t] = energy.argmin(axis=1)
+        previous_energy = energy.min(axis=1)
+
+    pages = np.arange(page_count)
+    best_paths = np.empty((page_count, token_count), dtype=np.int8)
+    best = argmin_tables[-1, :, 0]
+    for t in range(token_count - 1, -1, -1):
+        best = argmin_tables[t, pages, best]
+        best_paths[:, t] = best
+    return best_paths
+
+def _logsumexp(x: np.ndarray, axis: int) -> np.ndarray:
+    x_max = x.max(axis=axis, keepdims=True)
+    result = np.log(np.exp(x - x_max).sum(axis=axis, keepdims=True))
+    result += x_max
+    return result.squeeze(axis=axis)
+
+def crf_marginals(
+    input_energy: np.ndarray,
+    mask: np.ndarray,
+    chain_kernel: np.ndarray
+) -> np.ndarray:
+    """Returns the probability of every label for every token, as (pages, tokens, labels), with
+    the forward-backward algorithm over the same energies that viterbi_decode() minimizes"""
+    page_count, token_count, label_count = input_energy.shape
+    mask = mask.astype(np.float32)
+    chain_mask = _chain_mask(mask)
+    # log probabilities are negative energies
+    token_scores = -input_energy * mask[:, :, np.newaxis]
+
+    alphas = np.empty(input_energy.shape, dtype=np.float32)
+    alpha = np.zeros((page_count, label_count), dtype=np.float32)
+    for t in range(token_count):
+        if t > 0:
+            # scores[page, label at t-1, label at t]
+            scores = -chain_kernel[np.newaxis] * chain_mask[:, t - 1, np.newaxis, np.newaxis]
+            scores += alpha[:, :, np.newaxis]
+            alpha = _logsumexp(scores, axis=1)
+        alpha += token_scores[:, t]
+        alphas[:, t] = alpha
+
+    betas = np.empty(input_energy.shape, dtype=np.float32)
+    beta = np.zeros((page_count, label_count), dtype=np.float32)
+    for t in range(token_count - 1, -1, -1):
+        betas[:, t] = beta
+        if t > 0:
+            scores = -chain_kernel[np.newaxis] * chain_mask[:, t - 1, np.newaxis, np.newaxis]
+            scores += (beta + token_scores[:, t])[:, np.newaxis, :]
+            beta = _logsumexp(scores, axis=2)
+
+    log_marginals = alphas + betas
+    log_marginals -= _logsumexp(log_marginals, axis=2)[:, :, np.newaxis]
+    return np.exp(log_marginals)
+
+#
+# Model 🧮
+#
+
+class NumpyModel(object):
+    """Runs the model from with_labels.model_with_labels() for inference, in NumPy
+
+    It loads the weights from the same files as the Keras model, and it stands in for it in
+    with_labels.run_model(), without importing Keras or TensorFlow.
+
+    The big weight matrices can be kept in float16, or in int8 with a scale per output channel,
+    to save memory. They go back to float32 one layer at a time for the matmuls, so this saves
+    memory, but it doesn't save time."""
+
+    def __init__(
+        self,
+        pageno_embeddings: np.ndarray,
+        pageno_from_back_embeddings: np.ndarray,
+        token_embeddings: np.ndarray,
+        font_embeddings: np.ndarray,
+        dense_kernel: np.ndarray,
+        dense_bias: np.ndarray,
+        lstms: typing.List[typing.Tuple[LstmWeights, LstmWeights]],
+        crf: CrfWeights
+    ):
+        self.pageno_embeddings = pageno_embeddings
+        self.pageno_from_back_embeddings = pageno_from_back_embeddings
+        self.token_embeddings = token_embeddings
+        self.font_embeddings = font_embeddings
+        self.dense_kernel = dense_kernel
+        self.dense_bias = dense_bias
+        self.lstms = lstms
+        self.crf = crf
+
+    @classmethod
+    def load(cls, filename: str, precision: str = "float32") -> "NumpyModel":
+        layer_weights = _layer_weights_from_h5(filename)
+        name_to_weights = dict(layer_weights)
+        for name in _NAMED_LAYERS:
+            if name not in name_to_weights:
+                raise ValueError("%s has no weights for layer %s" % (filename, name))
+        unnamed_weights = [
+            weights for name, weights in layer_weights if name not in _NAMED_LAYERS
+        ]
+        if len(unnamed_weights) != _UNNAMED_LAYER_COUNT:
+            raise ValueError(
+                "Expected %d unnamed layers with weights in %s, found %d" %
+                (_UNNAMED_LAYER_COUNT, filename, len(unnamed_weights)))
+        lstm1, lstm2, crf = unnamed_weights
+
+        def bidirectional(weights):
+            return LstmWeights(*weights[:3]), LstmWeights(*weights[3:])
+
+        dense_kernel, dense_bias = name_to_weights["churned_tokens"]
+        result = cls(
+            name_to_weights["pageno_embedding"][0],
+            name_to_weights["pageno_from_back_embedding"][0],
+            name_to_weights["token_embedding"][0],
+            name_to_weights["font_embedding"][0],
+            dense_kernel,
+            dense_bias,
+            [bidirectional(lstm1), bidirectional(lstm2)],
+            CrfWeights(*crf))
+        result = result.with_precision(precision)
+        logging.info(
+            "Loaded %s with %d token embeddings of size %d, %.1f MB of weights in %s",
+            filename,
+            result.token_embeddings.shape[0],
+            result.token_embeddings.shape[1],
+            result.weight_bytes() / (1024 * 1024),
+            precision)
+        return result
+
+    def with_precision(self, precision: str) -> "NumpyModel":
+        """Returns a model that keeps the token embeddings, the dense kernel, and the LSTM kernels
+        in the given precision. The small layers stay in float32."""
+        def lstm(weights: LstmWeights) -> LstmWeights:
+            return weights._replace(
+                kernel=_reduce_precision(weights.kernel, precision),
+                recurrent_kernel=_reduce_precision(weights.recurrent_kernel, precision))
+
+        return NumpyModel(
+            self.pageno_embeddings,
+            self.pageno_from_back_embeddings,
+            _reduce_precision(self.token_embeddings, precision),
+            self.font_embeddings,
+            _reduce_precision(self.dense_kernel, precision),
+            self.dense_bias,
+            [(lstm(forward), lstm(backward)) for forward, backward in self.lstms],
+            self.crf)
+
+    def weight_bytes(self) -> int:
+        matrices = [
+            self.pageno_embeddings,
+            self.pageno_from_back_embeddings,
+            self.token_embeddings,
+            self.font_embeddings,
+            self.dense_kernel,
+            self.dense_bias
+        ]
+        for forward, backward in self.lstms:
+            matrices.extend(forward)
+            matrices.extend(backward)
+        matrices.extend(self.crf)
+        return sum(matrix.nbytes for matrix in matrices)
+
+    def _crf_inputs(self, inputs: typing.List[np.ndarray]) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Runs everything up to the CRF, and returns its inputs and the token mask"""
+        page_inputs, page_from_back_inputs, token_inputs, font_inputs, numeric_inputs = inputs
+
+        # A token counts only if all of its inputs are unmasked.
+        mask = \
+            (page_inputs != 0) & \
+            (page_from_back_inputs != 0) & \
+            (token_inputs != 0) & \
+            (font_inputs != 0) & \
+            np.any(numeric_inputs != 0.0, axis=-1)
+
+        embedded = np.concatenate([
+            self.pageno_embeddings[page_inputs],
+            self.pageno_from_back_embeddings[page_from_back_inputs],
+            _rows(self.token_embeddings, token_inputs),
+            self.font_embeddings[font_inputs],
+            numeric_inputs.astype(np.float32, copy=False)
+        ], axis=2)
+
+        x = np.dot(embedded.reshape((-1, embedded.shape[-1])), _float32(self.dense_kernel))
+        x += self.dense_bias
+        x = x.reshape(embedded.shape[:2] + (x.shape[-1],))
+
+        for forward, backward in self.lstms:
+            x = _bidirectional_lstm(x, mask, forward, backward)
+        return x, mask
+
+    def predict_label_ids(self, inputs: typing.List[np.ndarray], with_confidence: bool = False):
+        """Returns the predicted label id for every token, as int8 (pages, tokens)
+
+        With with_confidence, it returns (label ids, confidence) instead, where confidence is the
+        CRF's marginal probability of each predicted label. That needs another two passes over
+        the batch, so it's off by default."""
+        x, mask = self._crf_inputs(inputs)
+        input_energy = _crf_input_energy(x, mask, self.crf)
+        label_ids = viterbi_decode(input_energy, mask, self.crf.chain_kernel)
+        if not with_confidence:
+            return label_ids
+
+        marginals = crf_marginals(input_energy, mask, self.crf.chain_kernel)
+        pages, tokens = np.indices(label_ids.shape)
+        return label_ids, marginals[pages, tokens, label_ids]
+
+    def predict_on_batch(self, inputs: typing.List[np.ndarray]) -> np.ndarray:
+        """Returns one-hot predictions as (pages, tokens, labels), like the Keras model does"""
+        label_ids = self.predict_label_ids(inputs)
+        label_count = self.crf.kernel.shape[1]
+        return np.eye(label_count, dtype=np.float32)[label_ids]
@@ -108,8 +108,14 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             dataprep2.make_unlabeled_tokens_file(
                 json_file_name,
                 unlabeled_tokens_file_name,
-                ignore_errors=True)
-            errors = [line for line in dataprep2.json_from_file(json_file_name) if "error" in line]
+                ignore_errors=True,
+                relevant_pages_only=True,
+                json_workers=1)     # don't fork with TensorFlow loaded
+            errors = [
+                line
+                for line in dataprep2.json_from_file(json_file_name, workers=1)
+                if "error" in line
+            ]
             os.remove(json_file_name)
             making_unlabeled_tokens_time = time.time() - making_unlabeled_tokens_time
             logging.info("Made unlabeled tokens in %.2f seconds", making_unlabeled_tokens_time)
@@ -125,7 +131,8 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                     self.server.token_stats,
                     self.server.embeddings,
                     dataprep2.VisionOutput(None),
-                    self.server.model_settings
+                    self.server.model_settings,
+                    relevant_pages_only=True
                 )
                 # We don't delete the unlabeled file here because the featurized one contains references
                 # to it.
@@ -138,17 +145,18 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 def get_docs():
                     return dataprep2.documents_for_featurized_tokens(
                         featurized_tokens_file,
-                        include_labels=False,
-                        max_tokens_per_page=self.server.model_settings.tokens_per_batch)
+                        include_labels=False)
                 response_body = codecs.getwriter("UTF-8")(self.wfile, "UTF-8")
 
                 if output_type == "json":
                     results = with_labels.run_model(
                         self.server.model,
                         self.server.model_settings,
-                        self.server.embeddings.glove_vocab(),
+                        self.server.dehyphenator,
                         get_docs,
-                        enabled_modes={"predictions"})
+                        enabled_modes={"predictions"},
+                        window_size=self.server.model_settings.tokens_per_batch,
+                        postprocessing_pool=self.server.postprocessing_pool)
 
                     started_sending = False
                     for doc, docresults in results:
@@ -202,17 +210,28 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 
 
 class Server(http.server.HTTPServer):
-    def __init__(self, model, token_stats: dataprep2.TokenStatistics, embeddings: dataprep2.CombinedEmbeddings, model_settings):
+    def __init__(
+        self,
+        model,
+        token_stats: dataprep2.TokenStatistics,
+        embeddings: dataprep2.CombinedEmbeddings,
+        model_settings,
+        postprocessing_workers: int = 0
+    ):
         super(Server, self).__init__(('', 8081), RequestHandler)
 
         self.model = model
-        self.model._make_predict_function()
         self.token_stats = token_stats
         self.embeddings = embeddings
         self.model_settings = model_settings
 
         self.token_stats._ensure_loaded()
         self.embeddings._ensure_loaded()
+        self.dehyphenator = with_labels.Dehyphenator(self.embeddings.glove_vocab())
+        self.postprocessing_pool = None
+        if postprocessing_workers > 0:
+            self.postprocessing_pool = \
+                with_labels.PostprocessingPool(postprocessing_workers, self.dehyphenator)
 
 
 def main():
@@ -238,6 +257,33 @@ def main():
         default="model/C49.h5",
         help="filename of existing model"
     )
+    parser.add_argument(
+        "--inference-model",
+        type=str,
+        default=None,
+        help="filename of a model written by with_labels.py --export-inference-model; overrides --model"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["keras", "numpy"],
+        default="keras",
+        help="run the model with Keras, or with NumPy without loading TensorFlow"
+    )
+    parser.add_argument(
+        "--weight-precision",
+        choices=["float32", "float16", "int8"],
+        default="float32",
+        help="with --backend numpy, keep the big weight matrices in this precision to save memory. "
+             "This is not faster: the matrices go back to float32 for every batch. The accuracy "
+             "of float16 and int8 has not been validated; measure it first with "
+             "with_labels.py --evaluate-only --numpy-precisions"
+    )
+    parser.add_argument(
+        "--postprocessing-workers",
+        type=int,
+        default=0,
+        help="number of processes that find titles, authors and bibs in the model's predictions"
+    )
     args = parser.parse_args()
 
     model_settings = model_settings._replace(tokens_per_batch=args.tokens_per_batch)
@@ -254,11 +300,16 @@ def main():
     )
 
     logging.info("Loading model")
-    model = with_labels.model_with_labels(model_settings, embeddings)
-    model.load_weights(args.model)
+    if args.backend == "numpy":
+        import numpy_model
+        model = numpy_model.NumpyModel.load(args.model, args.weight_precision)
+    elif args.inference_model is not None:
+        model = with_labels.load_inference_model(args.inference_model)
+    else:
+        model = with_labels.inference_model_with_labels(model_settings, embeddings, args.model)
 
     logging.info("Starting server")
-    server = Server(model, token_stats, embeddings, model_settings)
+    server = Server(model, token_stats, embeddings, model_settings, args.postprocessing_workers)
     server.serve_forever()
 
 if __name__ == "__main__":
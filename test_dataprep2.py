@@ -0,0 +1,660 @@
+#!/usr/bin/env python
+
+import bz2
+import functools
+import gzip
+import json
+import logging
+import threading
+import time
+
+import h5py
+import numpy as np
+
+import pytest
+
+import dataprep2
+
+
+def count_to(n: int, fail_at=None):
+    for i in range(n):
+        if i == fail_at:
+            raise ValueError("failed at %d" % i)
+        yield i
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_prefetcher_ordered(backend):
+    producers = [functools.partial(count_to, n) for n in [5, 0, 30, 7]]
+    prefetcher = dataprep2.Prefetcher(producers, maxsize=2, ordered=True, backend=backend)
+    expected = [i for n in [5, 0, 30, 7] for i in range(n)]
+    assert list(prefetcher) == expected
+    assert prefetcher.stats.item_count == len(expected)
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_prefetcher_unordered(backend):
+    producers = [functools.partial(count_to, n) for n in [50, 3, 20]]
+    prefetcher = dataprep2.Prefetcher(producers, maxsize=4, backend=backend)
+    assert sorted(prefetcher) == sorted(list(range(50)) + list(range(3)) + list(range(20)))
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_prefetcher_raises_producer_exceptions(backend):
+    producers = [
+        functools.partial(count_to, 1000),
+        functools.partial(count_to, 1000, fail_at=10)
+    ]
+    prefetcher = dataprep2.Prefetcher(producers, maxsize=4, backend=backend)
+    with pytest.raises(ValueError, match="failed at 10"):
+        for _ in prefetcher:
+            pass
+    assert len(prefetcher.workers) == 0
+
+
+def test_prefetch_raises_instead_of_ending_early():
+    with pytest.raises(ValueError):
+        list(dataprep2.prefetch(count_to(100, fail_at=50), 4))
+
+
+def test_prefetcher_close_stops_producers():
+    produced = []
+    def endless():
+        i = 0
+        while True:
+            produced.append(i)
+            yield i
+            i += 1
+
+    with dataprep2.prefetch(endless(), 4) as prefetcher:
+        for i in prefetcher:
+            if i >= 10:
+                break
+    time.sleep(0.5)
+    produced_after_close = len(produced)
+    time.sleep(0.5)
+    assert len(produced) == produced_after_close
+    # The producer never gets more than the queue size, plus the item it's holding, ahead.
+    assert produced_after_close <= 11 + 4 + 1
+    assert not any(thread.name.startswith("Prefetcher") for thread in threading.enumerate())
+
+
+@pytest.fixture
+def shared_resources():
+    """Clears the process-wide shared resources before and after a test"""
+    dataprep2._shared_resources.clear()
+    yield dataprep2._shared_resources
+    dataprep2._shared_resources.clear()
+
+def test_shared_resources(tmpdir, caplog, shared_resources):
+    import settings
+    import token_statistics
+    glove_filename = str(tmpdir.join("glove.txt.gz"))
+    with gzip.open(glove_filename, "wt", encoding="UTF-8") as f:
+        f.write("the 0.1 0.2 0.3\nof -0.1 0.0 0.5\n")
+    model_settings = settings.default_model_settings._replace(glove_vectors=glove_filename)
+    token_stats_filename = str(tmpdir.join("tokens.tokenstats.pickle.gz"))
+    token_statistics.save_stats_file(
+        token_stats_filename,
+        {"the": 5, "of": 3, "Deep": 2},
+        {"Times-Roman": 10},
+        {10.0: 10},
+        {2.5: 10},
+        {}, {}, {}, {})
+
+    embeddings = dataprep2.shared_combined_embeddings(token_stats_filename, model_settings)
+    assert dataprep2.shared_combined_embeddings(token_stats_filename, model_settings) is embeddings
+    assert dataprep2.shared_token_statistics(token_stats_filename) is embeddings.tokenstats
+    assert dataprep2.shared_glove_vectors(glove_filename) is embeddings.glove
+    assert len(shared_resources) == 3
+
+    other_settings = model_settings._replace(embedded_tokens_fraction=0.5)
+    other_embeddings = dataprep2.shared_combined_embeddings(token_stats_filename, other_settings)
+    assert other_embeddings is not embeddings
+    assert other_embeddings.tokenstats is embeddings.tokenstats
+
+    # Token indices don't need the glove vectors, and the matrix is built on first use.
+    assert embeddings.vocab_size() == 4
+    assert embeddings.matrix is None
+    assert embeddings.glove.memory_size() == 0
+    matrix = embeddings.matrix_for_keras()
+    assert matrix.shape == (5, 4)
+    assert embeddings.matrix_for_keras() is matrix
+    assert embeddings.glove.memory_size() > 0
+
+    with caplog.at_level(logging.INFO):
+        dataprep2.log_shared_resources()
+    assert glove_filename in caplog.text
+
+
+def doc_sha_for_index(doc_index):
+    return "%040x" % (7919 * (doc_index + 1))
+
+def gold_for_index(doc_index):
+    return {
+        "gold_title": "Title of doc %d" % doc_index,
+        "gold_authors": [["Ann", "Author"], ["Bob", "Writer%d" % doc_index]],
+        "gold_bib_titles": ["Cited work"],
+        "gold_bib_venues": ["ACM"],
+        "gold_bib_years": ["2017"],
+        "gold_bib_authors": [[["Carl", "Citee"]]]
+    }
+
+def write_featurized_tokens_file(filename, rng, doc_page_counts):
+    """Writes a featurized tokens file with random features, where some pages have no tokens,
+    and some have no labels"""
+    page_rows = []
+    token_count = 0
+    for doc_index, page_count in enumerate(doc_page_counts):
+        for page_number in range(page_count):
+            page_token_count = int(rng.choice([0, 1, rng.randint(2, 120)], p=[0.1, 0.1, 0.8]))
+            page_rows.append((doc_index, page_number, 600.0, 800.0, token_count, page_token_count))
+            token_count += page_token_count
+    page_table = np.array(page_rows, dtype=dataprep2.PAGE_TABLE_DTYPE)
+    labels = rng.randint(0, 4, size=token_count).astype(np.int8)
+    for row in page_table[rng.rand(len(page_table)) < 0.2]:
+        labels[row["first_token_index"]:row["first_token_index"] + row["token_count"]] = 0
+
+    words = np.array(["Deep", "learning", "of", "the", "ACM", "2017", "network"], dtype=object)
+    fonts = np.array(["Times-Roman", "Times-Bold", "Helvetica"], dtype=object)
+    with h5py.File(filename, "w") as f:
+        doc_ids = ["doc%d" % i for i in range(len(doc_page_counts))]
+        f.create_dataset("doc_ids", dtype=dataprep2.h5_unicode_type, data=doc_ids)
+        f.create_dataset(
+            "doc_shas",
+            dtype="S40",
+            data=[doc_sha_for_index(i).encode("ascii") for i in range(len(doc_page_counts))])
+        f.create_dataset(
+            "doc_gold",
+            dtype=dataprep2.h5_unicode_type,
+            data=[json.dumps(gold_for_index(i)) for i in range(len(doc_page_counts))])
+        f.create_dataset("page_table", data=page_table)
+        f.create_dataset(
+            "token_text_features",
+            dtype=dataprep2.h5_unicode_type,
+            data=np.stack([
+                words[rng.randint(0, len(words), size=token_count)],
+                fonts[rng.randint(0, len(fonts), size=token_count)]
+            ], axis=1).reshape(token_count, 2))
+        f.create_dataset(
+            "token_numeric_features",
+            data=rng.rand(token_count, 6).astype(np.float32))
+        f.create_dataset(
+            "token_hashed_text_features",
+            data=rng.randint(1, 1000, size=(token_count, 2)).astype(np.uint32))
+        f.create_dataset(
+            "token_scaled_numeric_features",
+            data=rng.rand(token_count, 19).astype(np.float32))
+        f.create_dataset("token_labels", data=labels)
+
+def assert_same_document(actual, expected):
+    assert actual.doc_id == expected.doc_id
+    assert actual.doc_sha == expected.doc_sha
+    assert actual.gold_title == expected.gold_title
+    assert actual.gold_authors == expected.gold_authors
+    assert actual.gold_bib_titles == expected.gold_bib_titles
+    assert actual.gold_bib_authors == expected.gold_bib_authors
+    assert actual.gold_bib_venues == expected.gold_bib_venues
+    assert actual.gold_bib_years == expected.gold_bib_years
+    assert len(actual.pages) == len(expected.pages)
+    for actual_page, expected_page in zip(actual.pages, expected.pages):
+        assert actual_page.page_number == expected_page.page_number
+        assert actual_page.width == expected_page.width
+        assert actual_page.height == expected_page.height
+        assert actual_page.token_count == expected_page.token_count
+        assert np.array_equal(actual_page.tokens, expected_page.tokens)
+        assert np.array_equal(actual_page.token_hashes, expected_page.token_hashes)
+        assert np.array_equal(actual_page.font_hashes, expected_page.font_hashes)
+        assert np.array_equal(actual_page.numeric_features, expected_page.numeric_features)
+        assert np.array_equal(
+            actual_page.scaled_numeric_features,
+            expected_page.scaled_numeric_features)
+        if expected_page.labels is None:
+            assert actual_page.labels is None
+        else:
+            assert np.array_equal(actual_page.labels, expected_page.labels)
+
+def test_get_document(tmpdir):
+    doc_page_counts = [4, 0, 1, 7, 2]
+    filename = str(tmpdir.join("featurized.h5"))
+    write_featurized_tokens_file(filename, np.random.RandomState(22), doc_page_counts)
+
+    with h5py.File(filename, "r") as f:
+        index = dataprep2.DocumentIndex(f)
+        assert len(index) == len(doc_page_counts)
+        assert set(index.doc_shas()) == set(map(doc_sha_for_index, range(len(doc_page_counts))))
+
+        page_table = f["page_table"][()]
+        token_text_features = f["token_text_features"][()]
+        token_labels = f["token_labels"][()]
+        streamed = list(dataprep2.documents_for_featurized_tokens(f, read_ahead=0))
+        assert len(streamed) == len(doc_page_counts)
+        for doc_index, streamed_doc in enumerate(streamed):
+            doc_sha = doc_sha_for_index(doc_index)
+            assert streamed_doc.doc_sha == doc_sha
+
+            doc = dataprep2.get_document(f, doc_sha, include_labels=True, index=index)
+            assert_same_document(doc, streamed_doc)
+            assert doc.gold_authors == gold_for_index(doc_index)["gold_authors"]
+            assert doc.gold_bib_authors == gold_for_index(doc_index)["gold_bib_authors"]
+            assert len(doc.pages) == doc_page_counts[doc_index]
+            for page, row in zip(doc.pages, page_table[page_table["doc_index"] == doc_index]):
+                tokens = slice(
+                    row["first_token_index"],
+                    row["first_token_index"] + row["token_count"])
+                assert np.array_equal(page.tokens, token_text_features[tokens, 0])
+                assert np.array_equal(page.labels, token_labels[tokens])
+
+            # without labels, there is no gold data either, and building our own index is the same
+            unlabeled_doc = dataprep2.get_document(f, doc_sha)
+            assert unlabeled_doc.gold_title is None
+            assert all(page.labels is None for page in unlabeled_doc.pages)
+            assert [page.token_count for page in unlabeled_doc.pages] == \
+                [page.token_count for page in doc.pages]
+
+        missing_sha = "f" * 40
+        assert missing_sha not in index
+        with pytest.raises(KeyError):
+            dataprep2.get_document(f, missing_sha, index=index)
+
+@pytest.mark.parametrize("chunk_token_count", [1, 50, 300, 128 * 1024])
+@pytest.mark.parametrize("read_ahead", [0, 2])
+def test_documents_in_chunks(tmpdir, monkeypatch, chunk_token_count, read_ahead):
+    monkeypatch.setattr(dataprep2, "DOCUMENT_CHUNK_TOKEN_COUNT", chunk_token_count)
+    monkeypatch.setattr(dataprep2, "DOCUMENT_CHUNK_READ_AHEAD", read_ahead)
+    doc_page_counts = [12, 0, 1, 3, 9, 0, 25, 2, 1, 1]
+    filename = str(tmpdir.join("featurized.h5"))
+    write_featurized_tokens_file(filename, np.random.RandomState(23), doc_page_counts)
+
+    with h5py.File(filename, "r") as f:
+        page_table = f["page_table"][()]
+        doc_token_counts = np.bincount(
+            page_table["doc_index"],
+            weights=page_table["token_count"],
+            minlength=len(doc_page_counts))
+        # some documents are bigger than a chunk, and some chunks have more than one document
+        if chunk_token_count == 50:
+            assert np.any(doc_token_counts > chunk_token_count)
+            assert np.any(doc_token_counts[doc_token_counts > 0] < chunk_token_count)
+
+        chunks = list(dataprep2._document_chunks(f, True, chunk_token_count))
+        assert sum(len(chunk.doc_ids) for chunk in chunks) == len(doc_page_counts)
+        if chunk_token_count < doc_token_counts.sum():
+            assert len(chunks) > 1
+
+        # Every document is the same as when it's read on its own, from plain arrays.
+        index = dataprep2.DocumentIndex(f)
+        docs = list(dataprep2.documents_for_featurized_tokens(f))
+        assert len(docs) == len(doc_page_counts)
+        for doc_index, doc in enumerate(docs):
+            expected = dataprep2.get_document(f, doc.doc_sha, include_labels=True, index=index)
+            assert index[doc.doc_sha].doc_index == doc_index
+            assert_same_document(doc, expected)
+
+        # max_tokens_per_page cuts pages the same way on both paths
+        for doc in dataprep2.documents_for_featurized_tokens(f, max_tokens_per_page=10):
+            expected = dataprep2.get_document(
+                f,
+                doc.doc_sha,
+                include_labels=True,
+                max_tokens_per_page=10,
+                index=index)
+            assert_same_document(doc, expected)
+
+def test_token_strings_are_read_lazily(tmpdir, monkeypatch):
+    monkeypatch.setattr(dataprep2, "DOCUMENT_CHUNK_TOKEN_COUNT", 50)
+    filename = str(tmpdir.join("featurized.h5"))
+    write_featurized_tokens_file(filename, np.random.RandomState(24), [6, 1, 0, 9, 3])
+
+    with h5py.File(filename, "r") as f:
+        token_text_features = f["token_text_features"][()]
+        page_table = f["page_table"][()]
+        docs = list(dataprep2.documents_for_featurized_tokens(f, read_ahead=0))
+
+        # Nothing has read token strings yet.
+        chunk_tokens = set()
+        for doc in docs:
+            for page in doc.pages:
+                page_tokens = dataprep2.PageBase.tokens.__get__(page)
+                assert isinstance(page_tokens, dataprep2.LazyPageTokens)
+                assert len(page_tokens) == page.token_count
+                chunk_tokens.add(page_tokens.chunk_tokens)
+        assert len(chunk_tokens) > 1
+        assert all(chunk.tokens is None for chunk in chunk_tokens)
+
+        # The strings are the ones in the file, including across chunk boundaries.
+        pages = [page for doc in docs for page in doc.pages]
+        assert len(pages) == len(page_table)
+        for page, row in zip(pages, page_table):
+            first = row["first_token_index"]
+            assert np.array_equal(
+                page.tokens,
+                token_text_features[first:first + row["token_count"], 0])
+        assert all(chunk.tokens is not None for chunk in chunk_tokens)
+
+@pytest.mark.parametrize("chunk_token_count", [50, 128 * 1024])
+def test_training_shard_round_trip(tmpdir, monkeypatch, chunk_token_count):
+    monkeypatch.setattr(dataprep2, "DOCUMENT_CHUNK_TOKEN_COUNT", chunk_token_count)
+    rng = np.random.RandomState(21)
+    featurized_filename = str(tmpdir.join("featurized.h5"))
+    write_featurized_tokens_file(featurized_filename, rng, [12, 0, 1, 3, 9, 0, 25, 2])
+    shard_filename = str(tmpdir.join("shard.h5"))
+
+    expected = {}
+    with h5py.File(featurized_filename, "r") as f:
+        dataprep2.make_training_shard_file(shard_filename, f)
+
+        doc_ids = f["doc_ids"][()]
+        page_table = f["page_table"][()]
+        hashed = f["token_hashed_text_features"][()]
+        scaled = f["token_scaled_numeric_features"][()]
+        labels = f["token_labels"][()]
+        page_bounds = dataprep2.page_bounds_for_docs(page_table, len(doc_ids))
+        for doc_index, doc_id in enumerate(doc_ids):
+            page_count = int(page_bounds[doc_index + 1] - page_bounds[doc_index])
+            for page_index in dataprep2.relevant_page_indices(page_count):
+                row = page_table[page_bounds[doc_index] + page_index]
+                tokens = slice(
+                    row["first_token_index"],
+                    row["first_token_index"] + row["token_count"])
+                if np.any(labels[tokens]):
+                    expected[(doc_id, int(row["page_number"]))] = \
+                        (page_count, hashed[tokens], scaled[tokens], labels[tokens])
+    assert len(expected) > 0
+
+    shard = dataprep2.TrainingShard(h5py.File(shard_filename, "r"))
+    try:
+        assert len(shard) == len(expected)
+        assert np.all(np.diff(shard.token_counts()) >= 0)
+        actual = {}
+        for first in range(0, len(shard), 7):
+            for doc, page in shard.pages(first, min(first + 7, len(shard))):
+                key = (doc.doc_id, page.page_number)
+                assert key not in actual
+                actual[key] = (doc, page)
+    finally:
+        shard.close()
+
+    assert actual.keys() == expected.keys()
+    for key, (doc, page) in actual.items():
+        page_count, expected_hashed, expected_scaled, expected_labels = expected[key]
+        assert doc.page_count == page_count
+        assert page.token_count == len(expected_labels)
+        assert np.array_equal(page.token_hashes, expected_hashed[:, 0])
+        assert np.array_equal(page.font_hashes, expected_hashed[:, 1])
+        assert np.array_equal(page.scaled_numeric_features, expected_scaled)
+        assert np.array_equal(page.labels, expected_labels)
+
+
+def write_multi_stream_bz2(filename, parts):
+    """Writes a bz2 file the way pbzip2 does, as one compressed stream per part"""
+    streams = [bz2.compress(part) for part in parts]
+    with open(filename, "wb") as f:
+        f.write(b"".join(streams))
+    stream_starts = []
+    offset = 0
+    for stream in streams:
+        stream_starts.append(offset)
+        offset += len(stream)
+    return stream_starts
+
+def json_lines(rng, count):
+    docs = [
+        {"id": i, "text": " ".join("w%d" % rng.randint(1000) for _ in range(rng.randint(1, 50)))}
+        for i in range(count)
+    ]
+    return docs, "".join(json.dumps(doc) + "\n" for doc in docs).encode("UTF-8")
+
+def test_bz2_stream_starts(tmpdir):
+    rng = np.random.RandomState(2)
+    _, data = json_lines(rng, 3000)
+    parts = [data[i:i + 10000] for i in range(0, len(data), 10000)]
+    filename = str(tmpdir.join("docs.json.bz2"))
+    stream_starts = write_multi_stream_bz2(filename, parts)
+    assert len(stream_starts) > 3
+
+    with open(filename, "rb") as f:
+        compressed = f.read()
+    found = [
+        m.start() for m in dataprep2._bz2_stream_start_re.finditer(compressed)
+        if dataprep2._is_bz2_stream_start(compressed, m.start())
+    ]
+    assert found == stream_starts
+
+    # The stream header in the middle of data that isn't the end of a stream doesn't count.
+    fake = b"0123456789abcdef" + compressed[:10]
+    assert not dataprep2._is_bz2_stream_start(fake, 16)
+    assert not dataprep2._is_bz2_stream_start(compressed, 5)
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_bz2_chunks_split_on_streams(tmpdir, monkeypatch, workers):
+    monkeypatch.setattr(dataprep2, "indexed_bzip2", None)
+    rng = np.random.RandomState(3)
+    _, data = json_lines(rng, 2000)
+    filename = str(tmpdir.join("docs.json.bz2"))
+    write_multi_stream_bz2(filename, [data[i:i + 7000] for i in range(0, len(data), 7000)])
+    assert b"".join(dataprep2._bz2_chunks(filename, workers)) == data
+
+    single_stream_filename = str(tmpdir.join("single.json.bz2"))
+    write_multi_stream_bz2(single_stream_filename, [data])
+    assert b"".join(dataprep2._bz2_chunks(single_stream_filename, workers)) == data
+
+@pytest.mark.parametrize("extension", ["", ".gz", ".bz2"])
+def test_json_from_file_in_parallel_keeps_order(tmpdir, monkeypatch, caplog, extension):
+    monkeypatch.setattr(dataprep2, "indexed_bzip2", None)
+    rng = np.random.RandomState(4)
+    docs, data = json_lines(rng, 5000)
+    data += b"this line is not json\n"
+    filename = str(tmpdir.join("docs.json" + extension))
+    if extension == ".bz2":
+        write_multi_stream_bz2(filename, [data[i:i + 20000] for i in range(0, len(data), 20000)])
+    elif extension == ".gz":
+        with gzip.open(filename, "wb") as f:
+            f.write(data)
+    else:
+        with open(filename, "wb") as f:
+            f.write(data)
+
+    with caplog.at_level(logging.INFO):
+        sequential = list(dataprep2.json_from_file(filename, workers=1))
+    assert sequential == docs
+    assert "Finished reading 5000 documents" in caplog.text
+
+    caplog.clear()
+    monkeypatch.setattr(dataprep2, "_PARALLEL_JSON_MIN_FILE_SIZE", 0)
+    with caplog.at_level(logging.INFO):
+        parallel = list(dataprep2.json_from_file(filename, workers=2))
+    assert parallel == sequential
+    assert "Finished reading 5000 documents" in caplog.text
+
+
+def json_token_doc(rng, doc_index, page_token_counts):
+    """A document in the format the dataprep server produces, with random tokens"""
+    pages = []
+    for token_count in page_token_counts:
+        tokens = []
+        for token_index in range(token_count):
+            left = float(rng.uniform(50.0, 500.0))
+            top = 50.0 + 12.0 * (token_index // 12)
+            tokens.append({
+                "text": "w%d" % rng.randint(100),
+                "font": rng.choice(["Times-Roman", "Times-Bold"]),
+                "left": left,
+                "right": left + float(rng.uniform(5.0, 40.0)),
+                "top": top,
+                "bottom": top + 10.0,
+                "fontSize": 10.0,
+                "fontSpaceWidth": 2.5
+            })
+        pages.append({"width": 612.0, "height": 792.0, "tokens": tokens})
+    doc_sha = doc_sha_for_index(doc_index)
+    return {"docName": doc_sha + ".pdf", "docSha": doc_sha, "pages": pages}
+
+def test_unlabeled_tokens_page_table(tmpdir):
+    rng = np.random.RandomState(25)
+    doc_page_token_counts = [[3, 0, 5], [], [0, 0], [12], [4, 0, 0, 7, 1, 0, 2, 9, 3, 3, 6]]
+    json_docs = [
+        json_token_doc(rng, doc_index, page_token_counts)
+        for doc_index, page_token_counts in enumerate(doc_page_token_counts)
+    ]
+    # a token with NaN in it gets dropped
+    json_docs[0]["pages"][2]["tokens"][1]["left"] = "NaN"
+    json_filename = str(tmpdir.join("tokens.json"))
+    with open(json_filename, "w") as f:
+        for json_doc in json_docs[:2]:
+            f.write(json.dumps(json_doc) + "\n")
+        f.write(json.dumps({"error": {"docName": "broken.pdf", "message": "no"}}) + "\n")
+        f.write(json.dumps({"docName": doc_sha_for_index(99) + ".pdf"}) + "\n")    # no pages
+        for json_doc in json_docs[2:]:
+            f.write(json.dumps({"doc": json_doc}) + "\n")
+
+    unlabeled_filename = str(tmpdir.join("unlabeled.h5"))
+    dataprep2.make_unlabeled_tokens_file(
+        json_filename,
+        unlabeled_filename,
+        ignore_errors=True,
+        json_workers=1)
+
+    with h5py.File(unlabeled_filename, "r") as f:
+        doc_shas = [dataprep2.decode_doc_sha(doc_sha) for doc_sha in f["doc_shas"][()]]
+        assert doc_shas == [json_doc["docSha"] for json_doc in json_docs]
+        assert f["doc_shas"].dtype == np.dtype("S40")
+        page_table = f["page_table"][()]
+        token_text_features = f["token_text_features"][()]
+        assert len(token_text_features) == len(f["token_numeric_features"])
+
+    # pages come in document order, and in page order within every document
+    assert np.all(np.diff(page_table["doc_index"]) >= 0)
+    page_bounds = dataprep2.page_bounds_for_docs(page_table, len(json_docs))
+    expected_token_count = 0
+    for doc_index, json_doc in enumerate(json_docs):
+        page_rows = page_table[page_bounds[doc_index]:page_bounds[doc_index + 1]]
+        assert list(page_rows["page_number"]) == list(range(len(json_doc["pages"])))
+        for page_row, json_page in zip(page_rows, json_doc["pages"]):
+            json_tokens = [t for t in json_page["tokens"] if t["left"] != "NaN"]
+            # Every page starts where the one before it ended, empty pages included.
+            assert page_row["first_token_index"] == expected_token_count
+            assert page_row["token_count"] == len(json_tokens)
+            assert page_row["width"] == json_page["width"]
+            tokens = token_text_features[
+                expected_token_count:expected_token_count + len(json_tokens), 0]
+            assert [t.decode("utf-8") if isinstance(t, bytes) else t for t in tokens] == \
+                [t["text"] for t in json_tokens]
+            expected_token_count += len(json_tokens)
+    assert expected_token_count == len(token_text_features)
+
+    doc_starts, doc_ends = dataprep2.token_bounds_for_docs(page_table, page_bounds)
+    assert list(doc_ends - doc_starts) == \
+        [sum(page_row["token_count"] for page_row in page_table[page_table["doc_index"] == i])
+         for i in range(len(json_docs))]
+
+def write_relevant_pages_json(filename, doc_page_counts):
+    rng = np.random.RandomState(45)
+    with open(filename, "w") as f:
+        for doc_index, page_count in enumerate(doc_page_counts):
+            page_token_counts = rng.randint(0, 20, size=page_count)
+            f.write(json.dumps(json_token_doc(rng, doc_index, page_token_counts)) + "\n")
+
+def relevant_token_mask(page_table, doc_page_counts):
+    page_bounds = dataprep2.page_bounds_for_docs(page_table, len(doc_page_counts))
+    assert list(np.diff(page_bounds)) == doc_page_counts
+    token_count = int(page_table["token_count"].sum())
+    relevant_tokens = dataprep2._relevant_token_mask(page_table, page_bounds, token_count)
+    assert relevant_tokens.any() and not relevant_tokens.all()
+    # documents that are short enough have only relevant pages
+    for doc_index, page_count in enumerate(doc_page_counts):
+        if page_count <= len(dataprep2.RELEVANT_PAGE_INDICES):
+            doc_rows = page_table[page_bounds[doc_index]:page_bounds[doc_index + 1]]
+            first_token_index = int(doc_rows[0]["first_token_index"])
+            token_count = int(doc_rows["token_count"].sum())
+            assert relevant_tokens[first_token_index:first_token_index + token_count].all()
+    return relevant_tokens
+
+def test_unlabeled_tokens_relevant_pages_only(tmpdir):
+    doc_page_counts = [12, 9, 8, 3, 1]
+    json_filename = str(tmpdir.join("tokens.json"))
+    write_relevant_pages_json(json_filename, doc_page_counts)
+
+    unlabeled = {}
+    for relevant_pages_only in [False, True]:
+        unlabeled_filename = str(tmpdir.join("unlabeled-%s.h5" % relevant_pages_only))
+        dataprep2.make_unlabeled_tokens_file(
+            json_filename,
+            unlabeled_filename,
+            relevant_pages_only=relevant_pages_only,
+            json_workers=1)
+        with h5py.File(unlabeled_filename, "r") as f:
+            unlabeled[relevant_pages_only] = \
+                {name: f[name][()] for name in f.keys() if name != "doc_shas"}
+
+    # Irrelevant pages keep their rows, so page counts and token positions don't change.
+    everything, relevant = unlabeled[False], unlabeled[True]
+    assert np.array_equal(relevant["page_table"], everything["page_table"])
+    assert np.array_equal(relevant["token_numeric_features"], everything["token_numeric_features"])
+
+    relevant_tokens = relevant_token_mask(everything["page_table"], doc_page_counts)
+    assert np.array_equal(
+        relevant["token_text_features"][relevant_tokens],
+        everything["token_text_features"][relevant_tokens])
+    assert all(len(s) == 0 for s in relevant["token_text_features"][~relevant_tokens].ravel())
+    assert all(len(s) > 0 for s in everything["token_text_features"][~relevant_tokens].ravel())
+
+@pytest.mark.skipif(
+    int(h5py.__version__.split(".")[0]) >= 3,
+    reason="h5py 3 reads token strings as bytes")
+def test_featurized_tokens_relevant_pages_only(tmpdir, shared_resources):
+    import settings
+    import token_statistics
+    glove_filename = str(tmpdir.join("glove.txt.gz"))
+    with gzip.open(glove_filename, "wt", encoding="UTF-8") as f:
+        f.write("w1 0.1 0.2 0.3\nw2 -0.1 0.0 0.5\n")
+    model_settings = settings.default_model_settings._replace(glove_vectors=glove_filename)
+    token_stats_filename = str(tmpdir.join("tokens.tokenstats.pickle.gz"))
+    token_statistics.save_stats_file(
+        token_stats_filename,
+        {"w%d" % i: 100 - i for i in range(100)},
+        {"Times-Roman": 10, "Times-Bold": 5},
+        {10.0: 10},
+        {2.5: 10},
+        {}, {}, {}, {})
+    embeddings = dataprep2.shared_combined_embeddings(token_stats_filename, model_settings)
+
+    doc_page_counts = [12, 9, 8, 3, 1]
+    json_filename = str(tmpdir.join("tokens.json"))
+    write_relevant_pages_json(json_filename, doc_page_counts)
+
+    featurized = {}
+    for relevant_pages_only in [False, True]:
+        unlabeled_filename = str(tmpdir.join("unlabeled-%s.h5" % relevant_pages_only))
+        dataprep2.make_unlabeled_tokens_file(
+            json_filename,
+            unlabeled_filename,
+            relevant_pages_only=relevant_pages_only,
+            json_workers=1)
+        featurized_filename = str(tmpdir.join("featurized-%s.h5" % relevant_pages_only))
+        with h5py.File(unlabeled_filename, "r") as unlabeled_file:
+            dataprep2.make_featurized_tokens_file(
+                featurized_filename,
+                unlabeled_file,
+                embeddings.tokenstats,
+                embeddings,
+                dataprep2.VisionOutput(None),
+                model_settings,
+                relevant_pages_only=relevant_pages_only)
+        with h5py.File(featurized_filename, "r") as f:
+            featurized[relevant_pages_only] = {name: f[name][()] for name in [
+                "page_table",
+                "token_hashed_text_features",
+                "token_scaled_numeric_features"
+            ]}
+
+    everything, relevant = featurized[False], featurized[True]
+    assert np.array_equal(relevant["page_table"], everything["page_table"])
+    relevant_tokens = relevant_token_mask(everything["page_table"], doc_page_counts)
+
+    # Relevant pages are featurized the same way as without the flag, the others not at all.
+    # Scaled features are offset by -0.5 after featurizing.
+    for name, blank in [("token_hashed_text_features", 0), ("token_scaled_numeric_features", -0.5)]:
+        assert np.array_equal(relevant[name][relevant_tokens], everything[name][relevant_tokens])
+        assert np.all(relevant[name][~relevant_tokens] == blank)
+        assert np.any(everything[name][~relevant_tokens] != blank)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import itertools
+
+import numpy as np
+import pytest
+
+import numpy_model
+
+
+def random_lstm_weights(rng, input_size, units):
+    return numpy_model.LstmWeights(
+        (rng.randn(input_size, 4 * units) * 0.3).astype(np.float32),
+        (rng.randn(units, 4 * units) * 0.3).astype(np.float32),
+        (rng.randn(4 * units) * 0.1).astype(np.float32))
+
+def random_model(rng, units=8, label_count=7):
+    embedding_sizes = [3, 3, 4, 2]
+    vocab_sizes = [5, 5, 50, 20]
+    embeddings = [
+        rng.randn(vocab_size, size).astype(np.float32)
+        for vocab_size, size in zip(vocab_sizes, embedding_sizes)
+    ]
+    input_size = sum(embedding_sizes) + 18
+    lstms = []
+    lstm_input_size = 16
+    for _ in range(2):
+        lstms.append((
+            random_lstm_weights(rng, lstm_input_size, units),
+            random_lstm_weights(rng, lstm_input_size, units)))
+        lstm_input_size = 2 * units
+    crf = numpy_model.CrfWeights(
+        rng.randn(2 * units, label_count).astype(np.float32),
+        rng.randn(label_count, label_count).astype(np.float32),
+        rng.randn(label_count).astype(np.float32),
+        rng.randn(label_count).astype(np.float32),
+        rng.randn(label_count).astype(np.float32))
+    return numpy_model.NumpyModel(
+        *embeddings,
+        (rng.randn(input_size, 16) * 0.3).astype(np.float32),
+        rng.randn(16).astype(np.float32),
+        lstms,
+        crf)
+
+def random_inputs(rng, lengths, max_length=None):
+    """Model inputs for pages with the given lengths, padded at the end like run_model pads them"""
+    if max_length is None:
+        max_length = max(lengths)
+    shape = (len(lengths), max_length)
+    inputs = [
+        rng.randint(1, 5, shape).astype(np.int32),
+        rng.randint(1, 5, shape).astype(np.int32),
+        rng.randint(1, 50, shape).astype(np.uint32),
+        rng.randint(1, 20, shape).astype(np.uint32),
+        (rng.rand(*shape, 18) - 0.5).astype(np.float32)
+    ]
+    for row, length in enumerate(lengths):
+        for input in inputs:
+            input[row, length:] = 0
+    return inputs
+
+
+def test_viterbi_finds_lowest_energy_path():
+    rng = np.random.RandomState(1337)
+    label_count = 3
+    for _ in range(50):
+        lengths = rng.randint(1, 6, size=4)
+        max_length = lengths.max() + rng.randint(0, 3)
+        input_energy = rng.randn(len(lengths), max_length, label_count).astype(np.float32)
+        chain_kernel = rng.randn(label_count, label_count).astype(np.float32)
+        mask = np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]
+
+        paths = numpy_model.viterbi_decode(input_energy, mask, chain_kernel)
+        assert paths.shape == (len(lengths), max_length)
+
+        for row, length in enumerate(lengths):
+            def energy(path):
+                return \
+                    sum(input_energy[row, t, label] for t, label in enumerate(path)) + \
+                    sum(chain_kernel[a, b] for a, b in zip(path, path[1:]))
+            best_path = min(itertools.product(range(label_count), repeat=length), key=energy)
+            assert list(paths[row, :length]) == list(best_path)
+
+def test_predictions_do_not_depend_on_padding():
+    rng = np.random.RandomState(42)
+    model = random_model(rng)
+    lengths = [7, 1, 12, 5]
+    inputs = random_inputs(rng, lengths)
+    batch_label_ids = model.predict_label_ids(inputs)
+
+    for row, length in enumerate(lengths):
+        page_inputs = [input[row:row + 1, :length] for input in inputs]
+        label_ids = model.predict_label_ids(page_inputs)
+        assert np.array_equal(label_ids[0], batch_label_ids[row, :length])
+
+    one_hot = model.predict_on_batch(inputs)
+    assert one_hot.shape == (len(lengths), max(lengths), 7)
+    assert np.array_equal(one_hot.argmax(axis=2), batch_label_ids)
+
+
+class FakeEmbeddings:
+    def __init__(self, rng, vocab_size, dimensions):
+        self.matrix = rng.randn(vocab_size + 1, dimensions).astype(np.float32)
+
+    def vocab_size(self):
+        return self.matrix.shape[0] - 1
+
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    def matrix_for_keras(self):
+        return self.matrix
+
+@pytest.mark.parametrize("full_model", [False, True])
+def test_matches_keras(tmpdir, full_model):
+    pytest.importorskip("keras")
+    pytest.importorskip("keras_contrib")
+    import settings
+    import with_labels
+
+    rng = np.random.RandomState(7)
+    model_settings = settings.default_model_settings
+    embeddings = FakeEmbeddings(rng, 50, 4)
+    keras_model, _ = with_labels._uncompiled_model_with_labels(model_settings, embeddings)
+    keras_model.set_weights([
+        (rng.randn(*w.shape) * 0.05).astype(np.float32) for w in keras_model.get_weights()
+    ])
+    filename = str(tmpdir.join("model.h5"))
+    if full_model:
+        with_labels.save_inference_model(keras_model, filename)
+    else:
+        keras_model.save_weights(filename)
+    model = numpy_model.NumpyModel.load(filename)
+
+    lengths = [30, 3, 17]
+    inputs = random_inputs(rng, lengths)
+    expected = keras_model.predict_on_batch(inputs).argmax(axis=2)
+    actual = model.predict_label_ids(inputs)
+    for row, length in enumerate(lengths):
+        assert np.array_equal(actual[row, :length], expected[row, :length])
+
+def write_keras_weights(filename, model):
+    """Writes the weights of a NumpyModel in the layout of Keras' save_weights()"""
+    import h5py
+
+    def lstm_weights(direction, weights):
+        return [
+            ("%s/kernel:0" % direction, weights.kernel),
+            ("%s/recurrent_kernel:0" % direction, weights.recurrent_kernel),
+            ("%s/bias:0" % direction, weights.bias)
+        ]
+
+    layers = [
+        ("pageno_input", []),
+        ("pageno_embedding", [("pageno_embedding/embeddings:0", model.pageno_embeddings)]),
+        ("pageno_from_back_embedding",
+            [("pageno_from_back_embedding/embeddings:0", model.pageno_from_back_embeddings)]),
+        ("token_embedding", [("token_embedding/embeddings:0", model.token_embeddings)]),
+        ("font_embedding", [("font_embedding/embeddings:0", model.font_embeddings)]),
+        ("numeric_masked", []),
+        ("churned_tokens", [
+            ("churned_tokens/kernel:0", model.dense_kernel),
+            ("churned_tokens/bias:0", model.dense_bias)
+        ])
+    ]
+    for index, (forward, backward) in enumerate(model.lstms):
+        layers.append((
+            "bidirectional_%d" % (index + 1),
+            lstm_weights("forward_lstm_%d" % (index + 1), forward) +
+                lstm_weights("backward_lstm_%d" % (index + 1), backward)))
+    layers.append(("crf_1", [
+        ("crf_1/%s:0" % field, weights) for field, weights in model.crf._asdict().items()
+    ]))
+
+    with h5py.File(filename, "w") as f:
+        f.attrs["layer_names"] = [name.encode("utf8") for name, _ in layers]
+        for layer_name, weights in layers:
+            g = f.create_group(layer_name)
+            g.attrs["weight_names"] = [name.encode("utf8") for name, _ in weights]
+            for name, value in weights:
+                g.create_dataset(name, data=value)
+
+def test_load_keras_weights(tmpdir):
+    rng = np.random.RandomState(3)
+    model = random_model(rng)
+    filename = str(tmpdir.join("weights.h5"))
+    write_keras_weights(filename, model)
+    loaded = numpy_model.NumpyModel.load(filename)
+
+    inputs = random_inputs(rng, [9, 4, 6])
+    assert np.array_equal(loaded.predict_label_ids(inputs), model.predict_label_ids(inputs))
+
+def test_crf_marginals_match_brute_force():
+    rng = np.random.RandomState(5)
+    label_count = 3
+    lengths = np.array([4, 1, 3])
+    max_length = 5
+    input_energy = rng.randn(len(lengths), max_length, label_count).astype(np.float32)
+    chain_kernel = rng.randn(label_count, label_count).astype(np.float32)
+    mask = np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]
+
+    marginals = numpy_model.crf_marginals(input_energy, mask, chain_kernel)
+    assert marginals.shape == input_energy.shape
+
+    for row, length in enumerate(lengths):
+        expected = np.zeros((length, label_count))
+        for path in itertools.product(range(label_count), repeat=length):
+            energy = \
+                sum(input_energy[row, t, label] for t, label in enumerate(path)) + \
+                sum(chain_kernel[a, b] for a, b in zip(path, path[1:]))
+            for t, label in enumerate(path):
+                expected[t, label] += np.exp(-energy)
+        expected /= expected.sum(axis=1, keepdims=True)
+        assert np.allclose(marginals[row, :length], expected, atol=1e-5)
+
+def test_confidence_on_request():
+    rng = np.random.RandomState(11)
+    model = random_model(rng)
+    inputs = random_inputs(rng, [6, 3])
+    label_ids = model.predict_label_ids(inputs)
+    assert label_ids.dtype == np.int8
+
+    label_ids_with_confidence, confidence = model.predict_label_ids(inputs, with_confidence=True)
+    assert np.array_equal(label_ids_with_confidence, label_ids)
+    assert confidence.shape == label_ids.shape
+    assert np.all((confidence > 0.0) & (confidence <= 1.0 + 1e-6))
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+def test_reduced_precision(precision):
+    rng = np.random.RandomState(13)
+    model = random_model(rng, units=32)
+    reduced = model.with_precision(precision)
+    assert reduced.weight_bytes() < model.weight_bytes()
+
+    lengths = [40, 25, 33, 12]
+    inputs = random_inputs(rng, lengths)
+    label_ids = model.predict_label_ids(inputs)
+    reduced_label_ids = reduced.predict_label_ids(inputs)
+    mask = np.arange(max(lengths))[np.newaxis, :] < np.array(lengths)[:, np.newaxis]
+    agreement = np.mean(label_ids[mask] == reduced_label_ids[mask])
+    assert agreement >= 0.95
+
+def test_int8_matrix():
+    rng = np.random.RandomState(17)
+    matrix = rng.randn(30, 8).astype(np.float32)
+    matrix[:, 3] = 0.0
+    quantized = numpy_model.Int8Matrix(matrix)
+    assert quantized.shape == matrix.shape
+    # every value is within half a quantization step of the original
+    assert np.all(np.abs(quantized.float32() - matrix) <= quantized.scale / 2 + 1e-6)
+    assert np.array_equal(quantized.rows(np.array([[2, 5]])), quantized.float32()[[[2, 5]]])
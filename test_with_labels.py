@@ -0,0 +1,814 @@
+#!/usr/bin/env python
+
+import collections
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+
+import numpy as np
+import pytest
+
+import dataprep2
+import with_labels
+
+
+Doc = collections.namedtuple("Doc", ["doc_id"])
+Page = collections.namedtuple("Page", ["page_number", "token_count"])
+
+
+class SortedListPagePool:
+    """The original PagePool, which sorts the whole pool on every call to get_slice()"""
+
+    def __init__(self):
+        self.pool = []
+        self.random = random.Random()
+        self.random.seed(1337)
+
+    def add(self, doc, page):
+        self.pool.append((doc, page))
+
+    def __len__(self):
+        return len(self.pool)
+
+    def get_slice(self, desired_slice_size, smallest_pages=False):
+        self.pool.sort(key=with_labels.page_length_for_doc_page_pair)
+
+        if smallest_pages:
+            slice_start_index = 0
+        else:
+            token_count_of_largest_page = self.pool[-1][1].token_count
+            max_slice_start_index = \
+                math.ceil(len(self.pool) - desired_slice_size / token_count_of_largest_page)
+            max_slice_start_index = min(max_slice_start_index, len(self.pool) - 1)
+            max_slice_start_index = max(0, max_slice_start_index)
+            slice_start_index = self.random.randint(0, max_slice_start_index)
+
+        slice = []
+        slice_max_token_count = 0
+        while len(self.pool) > slice_start_index:
+            next_doc, next_page = self.pool[slice_start_index]
+            new_slice_token_count = \
+                (len(slice) + 1) * max(next_page.token_count, slice_max_token_count)
+            if new_slice_token_count > desired_slice_size and len(slice) > 0:
+                break
+            slice.append(self.pool[slice_start_index])
+            slice_max_token_count = max(slice_max_token_count, next_page.token_count)
+            del self.pool[slice_start_index]
+
+        slice.sort(key=with_labels.page_length_for_doc_page_pair)
+        return slice
+
+
+@pytest.mark.parametrize("smallest_pages", [False, True])
+@pytest.mark.parametrize("max_page_length", [5, 100, 5000])
+def test_page_pool_slices_match_sorted_list(smallest_pages, max_page_length):
+    rng = random.Random(42)
+    doc = Doc("doc")
+    pool = with_labels.PagePool()
+    expected_pool = SortedListPagePool()
+    page_numbers = itertools.count()
+
+    def add_pages(count):
+        for _ in range(count):
+            page = Page(next(page_numbers), rng.randint(1, max_page_length))
+            pool.add(doc, page)
+            expected_pool.add(doc, page)
+
+    add_pages(500)
+    for _ in range(200):
+        add_pages(rng.randint(1, 50))
+        slice = pool.get_slice(1000, smallest_pages)
+        assert slice == expected_pool.get_slice(1000, smallest_pages)
+        assert len(pool) == len(expected_pool)
+
+    while len(pool) > 0:
+        assert pool.get_slice(1000, smallest_pages) == expected_pool.get_slice(1000, smallest_pages)
+    assert len(expected_pool) == 0
+
+
+def test_page_pool_empty():
+    pool = with_labels.PagePool()
+    with pytest.raises(ValueError):
+        pool.get_slice(1000)
+
+    pool.add(Doc("doc"), Page(0, 2000))
+    assert len(pool) == 1
+    assert pool.get_slice(1000) == [(Doc("doc"), Page(0, 2000))]
+    assert len(pool) == 0
+
+
+NumericPage = collections.namedtuple("NumericPage", ["numeric_features"])
+
+
+def continuous_index_sequences_taking_gap_size_into_account_loop(indices, page):
+    """The original, one pair at a time, implementation"""
+    if len(indices) <= 0:
+        return
+    indices = np.asarray(indices)
+    for index_sequence in np.split(indices, np.where(np.diff(indices) != 1)[0] + 1):
+        yield_from = 0
+        for ii in range(0, len(index_sequence) - 1):
+            before_left, before_right, before_top, before_bottom, before_font_size, before_space_width = \
+                page.numeric_features[index_sequence[ii]]
+            after_left, after_right, after_top, after_bottom, after_font_size, after_space_width = \
+                page.numeric_features[index_sequence[ii + 1]]
+            space_width = max(before_space_width, after_space_width)
+
+            same_font_size = abs(before_font_size - after_font_size) <= 1.0
+            same_line = \
+                abs(before_top - after_top) <= before_font_size / 2 and \
+                abs(before_bottom - after_bottom) <= before_font_size / 2
+            big_horizontal_gap = before_right + 3 * space_width <= after_left
+
+            if not (same_font_size and same_line and not big_horizontal_gap):
+                yield index_sequence[yield_from:ii + 1]
+                yield_from = ii + 1
+        yield index_sequence[yield_from:]
+
+
+def random_numeric_page(rng, token_count):
+    # Draw from small sets of values, so that tokens share lines and fonts often.
+    font_size = rng.choice([8.0, 9.0, 9.5, 12.0], size=token_count)
+    top = rng.choice([100.0, 103.0, 112.0], size=token_count)
+    left = rng.randint(0, 60, size=token_count).astype(np.float64)
+    right = left + rng.randint(1, 12, size=token_count)
+    space_width = rng.choice([1.0, 2.5], size=token_count)
+    numeric_features = np.stack(
+        [left, right, top, top + font_size, font_size, space_width],
+        axis=1).astype(np.float32)
+    return NumericPage(numeric_features)
+
+
+def test_gap_aware_index_sequences_match_loop():
+    rng = np.random.RandomState(1337)
+    for _ in range(500):
+        token_count = rng.randint(1, 60)
+        page = random_numeric_page(rng, token_count)
+        indices = np.where(rng.rand(token_count) < rng.rand())[0]
+        if rng.rand() < 0.5:
+            indices = list(indices)     # run_model passes lists after filtering by font
+
+        expected = list(continuous_index_sequences_taking_gap_size_into_account_loop(indices, page))
+        actual = list(with_labels._continuous_index_sequences_taking_gap_size_into_account(indices, page))
+        assert len(actual) == len(expected)
+        for a, e in zip(actual, expected):
+            assert np.array_equal(a, e)
+        # the sequences always cover all the indices, in order
+        if len(indices) > 0:
+            assert np.array_equal(np.concatenate(actual), indices)
+
+
+@pytest.mark.parametrize("window_size", [129, 200, 1000])
+def test_window_bounds_cover_page(window_size):
+    overlap = with_labels.WINDOW_OVERLAP
+    for token_count in [1, 2, window_size - 1, window_size, window_size + 1, 3 * window_size, 5000]:
+        bounds = with_labels.window_bounds(token_count, window_size)
+        assert bounds[0][0] == 0
+        assert bounds[-1][1] == token_count
+        for first, one_past_last in bounds:
+            assert 0 < one_past_last - first <= window_size
+        for (_, one_past_last), (next_first, _) in zip(bounds, bounds[1:]):
+            assert one_past_last - next_first == overlap
+
+def test_window_bounds_edge_cases():
+    window_size = 300
+    stride = window_size - with_labels.WINDOW_OVERLAP
+    assert with_labels.window_bounds(0, window_size) == [(0, 0)]
+    assert with_labels.window_bounds(299, window_size) == [(0, 299)]
+    assert with_labels.window_bounds(300, window_size) == [(0, 300)]
+    assert with_labels.window_bounds(301, window_size) == [(0, 300), (stride, 301)]
+
+    page = Page(3, 301)
+    assert with_labels.windows_for_page(page, None) == [page]
+    assert with_labels.windows_for_page(page._replace(token_count=300), window_size) == \
+        [page._replace(token_count=300)]
+    windows = with_labels.windows_for_page(page, window_size)
+    assert [window.token_count for window in windows] == [300, 301 - stride]
+    assert all(window.page_number == 3 for window in windows)
+
+@pytest.mark.parametrize("token_count", [50, 300, 301, 1000, 2345])
+def test_stitched_windows_match_unwindowed_predictions(token_count):
+    rng = np.random.RandomState(token_count)
+    window_size = 300
+    # A model that looks at every token on its own predicts the same for a token in any window.
+    energies = rng.randn(token_count, 7)
+    expected = energies.argmax(axis=1).astype(np.int8)
+
+    bounds = with_labels.window_bounds(token_count, window_size)
+    window_predictions = [
+        energies[first:one_past_last].argmax(axis=1).astype(np.int8)
+        for first, one_past_last in bounds
+    ]
+    stitched = with_labels.stitch_windows(bounds, window_predictions)
+    assert stitched.dtype == np.int8
+    assert np.array_equal(stitched, expected)
+
+    # Every token comes from the window in which it's furthest from the edge.
+    window_ids = [np.full(one_past_last - first, i) for i, (first, one_past_last) in enumerate(bounds)]
+    owners = with_labels.stitch_windows(bounds, window_ids)
+    for token_index, owner in enumerate(owners):
+        def distance_from_edge(window_index):
+            first, one_past_last = bounds[window_index]
+            if not first <= token_index < one_past_last:
+                return -1
+            return min(
+                token_index - first if window_index > 0 else token_count,
+                one_past_last - 1 - token_index if window_index + 1 < len(bounds) else token_count)
+        best = max(distance_from_edge(i) for i in range(len(bounds)))
+        assert distance_from_edge(owner) >= best - 1
+
+
+@pytest.mark.parametrize("bucket_count", [1, 3, 8, 1000])
+def test_length_buckets_from_histogram(bucket_count):
+    rng = np.random.RandomState(bucket_count)
+    lengths, counts = np.unique(rng.randint(1, 500, size=2000), return_counts=True)
+    length_histogram = list(zip(lengths, counts))
+    length_buckets = with_labels.length_buckets_from_histogram(length_histogram, bucket_count)
+
+    assert 0 < len(length_buckets) <= bucket_count
+    assert length_buckets == sorted(set(length_buckets))
+    assert set(length_buckets) <= set(lengths)
+    # the last bucket takes the longest pages
+    assert length_buckets[-1] == lengths[-1]
+
+    assert with_labels.length_buckets_from_histogram([(7, 3)], bucket_count) == [7]
+
+def test_padded_page_length():
+    rng = np.random.RandomState(11)
+    lengths, counts = np.unique(rng.randint(1, 500, size=2000), return_counts=True)
+    length_buckets = with_labels.length_buckets_from_histogram(list(zip(lengths, counts)), 5)
+
+    for length in range(1, 600):
+        padded_length = with_labels.padded_page_length(length, length_buckets)
+        assert padded_length >= length
+        if length <= length_buckets[-1]:
+            # pages go into the smallest bucket they fit into
+            assert padded_length in length_buckets
+            assert padded_length == min(b for b in length_buckets if b >= length)
+        else:
+            assert padded_length == length
+        assert with_labels.padded_page_length(length, None) == length
+        assert with_labels.padded_page_length(length, []) == length
+
+    for boundary in length_buckets:
+        assert with_labels.padded_page_length(boundary, length_buckets) == boundary
+
+
+@pytest.mark.parametrize("desired_slice_size", [1, 50, 1000])
+def test_page_groups_for_sorted_lengths(desired_slice_size):
+    rng = np.random.RandomState(7)
+    page_lengths = np.sort(rng.randint(1, 200, size=300))
+    groups = with_labels.page_groups_for_sorted_lengths(page_lengths, desired_slice_size)
+
+    # the groups cover all the pages, in order
+    assert groups[0][0] == 0
+    assert groups[-1][1] == len(page_lengths)
+    for (_, one_past_last), (next_first, _) in zip(groups, groups[1:]):
+        assert one_past_last == next_first
+
+    for first, one_past_last in groups:
+        group_size = (one_past_last - first) * page_lengths[one_past_last - 1]
+        assert group_size <= desired_slice_size or one_past_last - first == 1
+        # groups are as big as they can be
+        if one_past_last < len(page_lengths):
+            assert (one_past_last + 1 - first) * page_lengths[one_past_last] > desired_slice_size
+
+    assert with_labels.page_groups_for_sorted_lengths(np.array([], dtype=np.int32), 1000) == []
+
+    # with an rng, the cut points move, but the groups still cover everything and fit
+    cut_points = set()
+    for seed in range(10):
+        jittered_groups = with_labels.page_groups_for_sorted_lengths(
+            page_lengths,
+            desired_slice_size,
+            rng=random.Random(seed))
+        assert jittered_groups[0][0] == 0
+        assert jittered_groups[-1][1] == len(page_lengths)
+        for (_, one_past_last), (next_first, _) in zip(jittered_groups, jittered_groups[1:]):
+            assert one_past_last == next_first
+        for first, one_past_last in jittered_groups:
+            group_size = (one_past_last - first) * page_lengths[one_past_last - 1]
+            assert group_size <= desired_slice_size or one_past_last - first == 1
+        cut_points.add(tuple(first for first, _ in jittered_groups))
+    if desired_slice_size > 1:
+        assert len(cut_points) > 1
+
+
+class FakeTrainingShard:
+    FakePage = collections.namedtuple("FakePage", ["page_number", "token_count", "labels"])
+
+    def __init__(self, name, page_lengths):
+        self.name = name
+        self.page_lengths = np.sort(page_lengths)
+        self.closed = False
+
+    def token_counts(self):
+        return self.page_lengths
+
+    def pages(self, first, one_past_last):
+        assert not self.closed
+        return [
+            (self.name, self.FakePage(index, length, np.ones(length, dtype=np.int8)))
+            for index, length in enumerate(self.page_lengths[first:one_past_last], first)
+        ]
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize("interleaved_shard_count", [1, 2, 4])
+def test_page_groups_from_training_shards(interleaved_shard_count):
+    import settings
+    model_settings = settings.default_model_settings._replace(tokens_per_batch=500)
+    rng = np.random.RandomState(3)
+    shards = [
+        FakeTrainingShard(name, rng.randint(1, 100, size=60))
+        for name in range(5)
+    ]
+    groups = [
+        group
+        for group, length_buckets in with_labels._page_groups_from_training_shards(
+            model_settings,
+            shards,
+            random.Random(1),
+            interleaved_shard_count)
+    ]
+
+    # all pages come out exactly once
+    expected = sorted((shard.name, length) for shard in shards for length in shard.page_lengths)
+    assert sorted((name, page.token_count) for group in groups for name, page in group) == expected
+    assert all(shard.closed for shard in shards)
+
+    # Groups mix the pages of the shards that are open together, and only
+    # interleaved_shard_count shards are in flight.
+    open_shard_sets = []
+    mixed_group_count = 0
+    for group in groups:
+        shard_names = set(name for name, _ in group)
+        open_shard_sets.extend(set(name // interleaved_shard_count for name in shard_names))
+        if len(shard_names) > 1:
+            mixed_group_count += 1
+    assert open_shard_sets == sorted(open_shard_sets)
+    if interleaved_shard_count > 1:
+        assert mixed_group_count > 0
+    else:
+        assert mixed_group_count == 0
+
+def test_page_groups_from_training_shards_change_every_epoch():
+    import settings
+    model_settings = settings.default_model_settings._replace(tokens_per_batch=500)
+    rng = np.random.RandomState(4)
+    page_lengths = [rng.randint(1, 100, size=60) for _ in range(3)]
+
+    # Reading the same shards twice with the same rng is like two epochs of training.
+    group_rng = random.Random(1)
+    epochs = []
+    for epoch in range(2):
+        shards = [FakeTrainingShard(name, lengths) for name, lengths in enumerate(page_lengths)]
+        epochs.append(set(
+            frozenset((name, page.page_number) for name, page in group)
+            for group, _ in with_labels._page_groups_from_training_shards(
+                model_settings,
+                shards,
+                group_rng,
+                length_bucket_count=4)))
+
+    all_pages = set((name, index) for name in range(3) for index in range(60))
+    for groups in epochs:
+        assert set().union(*groups) == all_pages
+        assert sum(len(group) for group in groups) == len(all_pages)
+    assert epochs[0] != epochs[1]
+
+def test_page_groups_from_training_shards_with_windows_and_length_buckets():
+    import settings
+    model_settings = settings.default_model_settings._replace(tokens_per_batch=1000)
+    rng = np.random.RandomState(5)
+    shards = [
+        FakeTrainingShard(name, np.concatenate([rng.randint(1, 300, size=80), [1200, 450, 301]]))
+        for name in range(3)
+    ]
+    window_size = 300
+    groups = list(with_labels._page_groups_from_training_shards(
+        model_settings,
+        shards,
+        random.Random(2),
+        interleaved_shard_count=2,
+        length_bucket_count=4,
+        window_size=window_size))
+
+    length_buckets = groups[0][1]
+    assert len(length_buckets) <= 4
+    assert length_buckets[-1] == window_size
+
+    covered = collections.defaultdict(set)
+    for group, group_length_buckets in groups:
+        assert group_length_buckets == length_buckets
+        lengths = [page.token_count for _, page in group]
+        padded_length = with_labels.padded_page_length(max(lengths), length_buckets)
+        assert padded_length <= window_size
+        assert len(group) * padded_length <= model_settings.tokens_per_batch
+        for name, page in group:
+            if isinstance(page, with_labels.PageWindow):
+                key = (name, page.page_number)
+                first, one_past_last = page.bounds[page.window_index]
+                covered[key].update(range(first, one_past_last))
+            else:
+                covered[(name, page.page_number)].update(range(page.token_count))
+
+    # every token of every page is in some batch, windows included
+    expected = {
+        (shard.name, page_number): length
+        for shard in shards
+        for page_number, length in enumerate(shard.page_lengths)
+    }
+    assert {key: len(tokens) for key, tokens in covered.items()} == expected
+
+
+class TokenLookupModel:
+    """Predicts a label for every token from its hash alone, and counts the batches it sees"""
+
+    def __init__(self):
+        self.batch_count = 0
+
+    def predict_label_ids(self, inputs):
+        self.batch_count += 1
+        token_inputs = inputs[2]
+        return (token_inputs % len(dataprep2.POTENTIAL_LABELS)).astype(np.int8)
+
+WORDS = np.array(["deep", "learning", "-", "Smith", "J.", "1999", "Nature", "of"], dtype=object)
+
+def random_document(rng, doc_id, page_lengths):
+    pages = []
+    for page_number, length in enumerate(page_lengths):
+        token_hashes = rng.randint(1, 2**20, length).astype(np.uint32)
+        pages.append(dataprep2.Page(
+            page_number,
+            612.0,
+            792.0,
+            tokens=WORDS[token_hashes % len(WORDS)],
+            token_hashes=token_hashes,
+            font_hashes=rng.randint(1, 4, length).astype(np.uint32),
+            numeric_features=random_numeric_page(rng, length).numeric_features,
+            scaled_numeric_features=rng.rand(length, 19).astype(np.float32) - 0.5,
+            labels=rng.randint(0, len(dataprep2.POTENTIAL_LABELS), length).astype(np.int8)))
+    return dataprep2.Document(doc_id, doc_id, None, None, None, None, None, None, pages)
+
+def postprocessing_pages(doc):
+    """The post-processing input for a document, with TokenLookupModel's predictions"""
+    return [
+        with_labels._postprocessing_page(page, {
+            "predictions": (page.token_hashes % len(dataprep2.POTENTIAL_LABELS)).astype(np.int8),
+            "labels": page.labels
+        })
+        for page in doc.get_relevant_pages()
+    ]
+
+def test_postprocessing_pool():
+    rng = np.random.RandomState(13)
+    doc = random_document(rng, "doc", [300])
+    pages = postprocessing_pages(doc)
+    dehyphenate = with_labels.Dehyphenator({"deeplearning", "of"})
+    expected = with_labels._postprocess_document(pages, {"predictions", "labels"}, dehyphenate)
+    with with_labels.PostprocessingPool(1, dehyphenate) as postprocessing_pool:
+        result = postprocessing_pool.submit(pages, {"predictions", "labels"})
+        assert result.get(timeout=60) == expected
+
+def dehyphenate_without_memo(tokens, vocab):
+    """Dehyphenation as it was before Dehyphenator, deciding every hyphen from scratch"""
+    tokens = list(tokens)
+    for index, s in reversed(list(enumerate(tokens))):
+        if s != "-":
+            continue
+        index_before = index - 1
+        if index_before <= 0:
+            continue
+        index_after = index + 1
+        if index_after >= len(tokens):
+            continue
+        hyphenated_word = tokens[index_before] + "-" + tokens[index_after]
+        if hyphenated_word in vocab or hyphenated_word.lower() in vocab:
+            continue
+        dehyphenated_word = tokens[index_before] + tokens[index_after]
+        if dehyphenated_word in vocab or dehyphenated_word.lower() in vocab:
+            tokens[index_before:index_before + 3] = [dehyphenated_word]
+    return tokens
+
+DEHYPHENATION_VOCAB = {"deeplearning", "cooperation", "email", "e-mail", "state-of", "of", "art"}
+
+@pytest.mark.parametrize("max_memo_size", [None, 3])
+def test_dehyphenator_matches_unmemoized(monkeypatch, max_memo_size):
+    if max_memo_size is not None:
+        monkeypatch.setattr(with_labels.Dehyphenator, "MAX_MEMO_SIZE", max_memo_size)
+    dehyphenate = with_labels.Dehyphenator(DEHYPHENATION_VOCAB)
+    token_lists = [
+        ["A", "Deep", "-", "Learning", "Approach"],     # joined, matching the vocab in lower case
+        ["The", "e", "-", "mail", "corpus"],            # hyphenated word is in the vocab
+        ["The", "state", "-", "of", "-", "art"],        # chained hyphens
+        ["Co", "-", "operation"],                       # hyphen right after the first token
+        ["Learning", "to", "co", "-"],                  # hyphen at the end
+        ["Non", "-", "hyphenated", "title"],
+        ["No", "hyphens", "at", "all"],
+    ]
+    rng = np.random.RandomState(39)
+    words = ["Deep", "deep", "learning", "Learning", "co", "operation", "e", "mail", "state", "of",
+             "art", "-", "-"]
+    token_lists += [list(rng.choice(words, rng.randint(0, 12))) for _ in range(200)]
+
+    # Run everything twice, so the second time all the decisions come from the memo.
+    for _ in range(2):
+        for tokens in token_lists:
+            assert dehyphenate(tokens) == dehyphenate_without_memo(tokens, DEHYPHENATION_VOCAB), \
+                tokens
+    if max_memo_size is not None:
+        assert len(dehyphenate.pair_to_joined_word) <= max_memo_size
+    assert dehyphenate(["A", "Deep", "-", "Learning", "Approach"]) == \
+        ["A", "DeepLearning", "Approach"]
+    assert dehyphenate(["The", "e", "-", "mail", "corpus"]) == ["The", "e", "-", "mail", "corpus"]
+
+def test_dehyphenator_joins_title_across_lines():
+    # A title on two lines, with the first line ending in a hyphen
+    tokens = np.array(["Towards", "Deep", "-", "Learning", "Co", "-", "operation"])
+    lines = [0, 0, 0, 1, 1, 1, 1]
+    left = np.array([10.0, 60.0, 95.0, 10.0, 75.0, 90.0, 95.0])
+    top = 100.0 + 14.0 * np.array(lines)
+    numeric_features = np.stack(
+        [left, left + 30.0, top, top + 12.0, np.full(7, 12.0), np.full(7, 2.5)],
+        axis=1).astype(np.float32)
+    page = with_labels.PostprocessingPage(
+        0,
+        {"predictions": np.full(len(tokens), dataprep2.TITLE_LABEL, dtype=np.int8)},
+        tokens,
+        np.ones(len(tokens), dtype=np.uint32),
+        numeric_features)
+    expected_title = " ".join(dehyphenate_without_memo(tokens, DEHYPHENATION_VOCAB))
+    assert expected_title == "Towards DeepLearning Cooperation"
+    dehyphenate = with_labels.Dehyphenator(DEHYPHENATION_VOCAB)
+    for _ in range(2):
+        mode_to_results = with_labels._postprocess_document([page], {"predictions"}, dehyphenate)
+        assert mode_to_results["predictions"][0] == expected_title
+
+@pytest.mark.parametrize("window_size,postprocessing_workers", [(None, 0), (300, 0), (None, 2)])
+def test_run_model_yields_every_document_once(window_size, postprocessing_workers):
+    import settings
+    rng = np.random.RandomState(12)
+    docs = []
+    for doc_index in range(80):
+        kind = doc_index % 5
+        if kind == 0:
+            page_lengths = []                   # no pages
+        elif kind == 1:
+            page_lengths = [0, 0, 0]            # no pages with tokens
+        elif kind == 2:
+            page_lengths = [rng.randint(1, 800)]
+        else:
+            page_lengths = rng.randint(0, 1500, size=rng.randint(2, 20))
+        docs.append(random_document(rng, "doc%d" % doc_index, page_lengths))
+
+    dehyphenate = with_labels.Dehyphenator({"deeplearning", "of"})
+    postprocessing_pool = None
+    if postprocessing_workers > 0:
+        postprocessing_pool = with_labels.PostprocessingPool(postprocessing_workers, dehyphenate)
+    model = TokenLookupModel()
+    try:
+        results = list(with_labels.run_model(
+            model,
+            settings.default_model_settings,
+            dehyphenate,
+            lambda: iter(docs),
+            window_size=window_size,
+            postprocessing_pool=postprocessing_pool))
+    finally:
+        if postprocessing_pool is not None:
+            postprocessing_pool.shutdown()
+    assert model.batch_count > 2
+
+    assert sorted(doc.doc_id for doc, _ in results) == sorted(doc.doc_id for doc in docs)
+    for doc, mode_to_results in results:
+        pages = postprocessing_pages(doc)
+        expected = with_labels._postprocess_document(pages, {"predictions", "labels"}, dehyphenate)
+        assert mode_to_results == expected, doc.doc_id
+
+
+def fill_batch_buffers(buffers, page_count, max_length):
+    inputs, labels_one_hot = buffers.views(page_count, max_length)
+    for input_index, batch_input in enumerate(inputs):
+        batch_input[...] = input_index + 1
+    labels_one_hot[...] = 0.5
+
+def test_batch_buffers_in_shared_memory():
+    context = multiprocessing.get_context("spawn")
+    capacity = 1000
+    buffers = with_labels.BatchBuffers(
+        capacity,
+        shared_memory=context.RawArray("b", with_labels.BatchBuffers.shared_memory_size(capacity)))
+    process = context.Process(target=fill_batch_buffers, args=(buffers, 4, 200))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    inputs, labels_one_hot = buffers.views(4, 200)
+    for input_index, batch_input in enumerate(inputs):
+        assert np.all(batch_input == input_index + 1)
+    assert np.all(labels_one_hot == 0.5)
+
+def allocated_batch_from_page_group(page_group, max_length):
+    """Builds a batch the way batches were built before BatchBuffers, one padded page at a time"""
+    batch_inputs = [[], [], [], [], []]
+    batch_outputs = []
+    for doc, page in page_group:
+        page_length = page.token_count
+        required_padding = max_length - page_length
+        page_number_feature = 0.0 if len(doc.pages) <= 1 else \
+            (page.page_number / (len(doc.pages) - 1)) - 0.5
+        numeric_inputs = np.concatenate((
+            page.scaled_numeric_features[:,:with_labels.NUMERIC_FEATURE_COUNT],
+            np.full((page_length, 1), page_number_feature, dtype=np.float32)
+        ), axis=-1)
+        page_inputs = [
+            np.full(page_length, min(with_labels.MAX_EMBEDDED_PAGES, page.page_number) + 1),
+            np.full(
+                page_length,
+                min(with_labels.MAX_EMBEDDED_PAGES, len(doc.pages) - page.page_number - 1) + 1),
+            page.token_hashes,
+            page.font_hashes,
+            numeric_inputs
+        ]
+        for index, page_input in enumerate(page_inputs):
+            padding = ((0, required_padding),) + ((0, 0),) * (page_input.ndim - 1)
+            batch_inputs[index].append(np.pad(page_input, padding, mode='constant'))
+        labels_one_hot = np.zeros(
+            (page_length, len(dataprep2.POTENTIAL_LABELS)),
+            dtype=np.float32)
+        labels_one_hot[np.arange(page_length), page.labels] = 1
+        batch_outputs.append(np.pad(labels_one_hot, ((0, required_padding), (0, 0)), mode='constant'))
+    return list(map(np.stack, batch_inputs)), np.stack(batch_outputs)
+
+@pytest.mark.parametrize("length_buckets", [None, [64, 128, 256]])
+def test_batch_from_page_group_matches_allocated_batches(length_buckets):
+    import settings
+    rng = np.random.RandomState(32)
+    docs = [
+        random_document(rng, "doc%d" % doc_index, rng.randint(1, 300, rng.randint(1, 5)))
+        for doc_index in range(20)
+    ]
+    doc_page_pairs = [(doc, page) for doc in docs for page in doc.pages]
+    page_groups = [
+        [doc_page_pairs[i] for i in rng.choice(len(doc_page_pairs), rng.randint(1, 8))]
+        for _ in range(30)
+    ]
+
+    # Reused buffers start out full of garbage, which all has to be overwritten.
+    buffer_pool = with_labels.BatchBufferPool(500)
+    buffers = buffer_pool.get(4000)
+    fill_batch_buffers(buffers, 1, 4000)
+    garbage_inputs, _ = buffers.views(1, 4000)
+    buffer_pool.track(garbage_inputs, buffers)
+    buffer_pool.release(garbage_inputs)
+
+    for page_group in page_groups:
+        max_length = with_labels.padded_page_length(
+            max(page.token_count for _, page in page_group),
+            length_buckets)
+        expected_inputs, expected_outputs = allocated_batch_from_page_group(page_group, max_length)
+        for pool in [None, buffer_pool]:
+            batch_inputs, batch_outputs = with_labels.batch_from_page_group(
+                settings.default_model_settings,
+                page_group,
+                buffer_pool=pool,
+                length_buckets=length_buckets)
+            assert len(batch_inputs) == len(expected_inputs)
+            for batch_input, expected_input in zip(batch_inputs, expected_inputs):
+                assert batch_input.shape == expected_input.shape
+                assert np.array_equal(batch_input, expected_input)
+            assert np.array_equal(batch_outputs, expected_outputs)
+            if pool is not None:
+                pool.release(batch_inputs)
+    assert len(buffer_pool.in_use) == 0
+
+@pytest.mark.parametrize("length_buckets", [None, [64, 128, 256]])
+def test_inputs_from_page_group_match_training_batches(length_buckets):
+    import settings
+    rng = np.random.RandomState(33)
+    docs = [
+        random_document(rng, "doc%d" % doc_index, rng.randint(1, 300, rng.randint(1, 5)))
+        for doc_index in range(10)
+    ]
+    doc_page_pairs = [(doc, page) for doc in docs for page in doc.pages]
+    inference_buffer_pool = with_labels.BatchBufferPool(500, include_labels=False)
+    for _ in range(20):
+        page_group = [doc_page_pairs[i] for i in rng.choice(len(doc_page_pairs), rng.randint(1, 8))]
+        expected_inputs, _ = with_labels.batch_from_page_group(
+            settings.default_model_settings,
+            page_group,
+            length_buckets=length_buckets)
+        max_length = with_labels.padded_page_length(
+            max(page.token_count for _, page in page_group),
+            length_buckets)
+        for pool in [None, inference_buffer_pool]:
+            inputs = with_labels.inputs_from_page_group(
+                settings.default_model_settings,
+                page_group,
+                buffer_pool=pool,
+                length_buckets=length_buckets)
+            assert len(inputs) == len(expected_inputs)
+            for batch_input, expected_input in zip(inputs, expected_inputs):
+                assert batch_input.shape[:2] == (len(page_group), max_length)
+                assert batch_input.shape == expected_input.shape
+                assert batch_input.dtype == expected_input.dtype
+                assert np.array_equal(batch_input, expected_input)
+
+            # Keras masks on zeros, so exactly the padding has to be zero.
+            for row, (_, page) in enumerate(page_group):
+                for batch_input in inputs[:4]:
+                    assert np.all(batch_input[row,:page.token_count] != 0)
+                    assert np.all(batch_input[row,page.token_count:] == 0)
+                assert np.all(inputs[4][row,page.token_count:,:] == 0.0)
+            if pool is not None:
+                pool.release(inputs)
+
+def test_inputs_from_page_group_without_labels():
+    import settings
+    rng = np.random.RandomState(34)
+    doc = random_document(rng, "doc", [50, 120])
+    labeled_inputs, _ = with_labels.batch_from_page_group(
+        settings.default_model_settings,
+        [(doc, page) for page in doc.pages])
+    unlabeled_doc = doc._replace(pages=[page._replace(labels=None) for page in doc.pages])
+    inputs = with_labels.inputs_from_page_group(
+        settings.default_model_settings,
+        [(unlabeled_doc, page) for page in unlabeled_doc.pages])
+    for batch_input, labeled_input in zip(inputs, labeled_inputs):
+        assert np.array_equal(batch_input, labeled_input)
+
+def test_training_batch_loader(tmpdir):
+    import gzip
+    import h5py
+    import settings
+    import test_dataprep2
+
+    glove_filename = str(tmpdir.join("glove.txt.gz"))
+    with gzip.open(glove_filename, "wt", encoding="UTF-8") as f:
+        f.write("the 0.1 0.2 0.3\n")
+    model_settings = settings.default_model_settings._replace(
+        tokens_per_batch=100,
+        glove_vectors=glove_filename)
+
+    # the same small shard in every training bucket
+    featurized_filename = str(tmpdir.join("featurized.h5"))
+    test_dataprep2.write_featurized_tokens_file(
+        featurized_filename,
+        np.random.RandomState(8),
+        [3, 12, 1])
+    shard_filename = str(tmpdir.join("shard.h5"))
+    with h5py.File(featurized_filename, "r") as f:
+        dataprep2.make_training_shard_file(shard_filename, f)
+    with h5py.File(shard_filename, "r") as f:
+        shard_page_lengths = f["page_table"]["token_count"]
+    assert shard_page_lengths.max() > model_settings.tokens_per_batch
+    pmc_dir = str(tmpdir.join("pmc"))
+    buckets = dataprep2.buckets_for_document_set(dataprep2.DocumentSet.TRAIN)
+    for bucket in buckets:
+        bucket_path = os.path.join(pmc_dir, bucket)
+        os.makedirs(bucket_path)
+        shutil.copy(shard_filename, dataprep2.training_shard_path(bucket_path, model_settings))
+
+    with with_labels.TrainingBatchLoader(
+        pmc_dir,
+        model_settings,
+        epochs=1,
+        worker_count=2,
+        prefetch_depth=3
+    ) as loader:
+        batches = iter(loader)
+        page_count = 0
+        oversized_batch_count = 0
+
+        # Batches hold on to their slots, oversized ones included, until they are released.
+        held_batches = [next(batches) for _ in loader.slots]
+        with pytest.raises(queue.Empty):
+            loader.free_slots.get(timeout=1.0)
+        for batch_inputs, batch_outputs in itertools.chain(held_batches, batches):
+            batch_page_count, max_length = batch_inputs[0].shape
+            assert batch_outputs.shape[:2] == (batch_page_count, max_length)
+            page_count += batch_page_count
+            if batch_page_count * max_length > model_settings.tokens_per_batch:
+                oversized_batch_count += 1
+            loader.release(batch_inputs)
+
+        assert page_count == len(buckets) * len(shard_page_lengths)
+        assert oversized_batch_count >= len(buckets)
+        assert len(loader.in_use) == 0
+        free_slots = [loader.free_slots.get(timeout=5.0) for _ in loader.slots]
+        assert sorted(free_slots) == list(range(len(loader.slots)))
+
+    # Leaving the loader with an exception stops the workers all the same.
+    with pytest.raises(KeyboardInterrupt):
+        with with_labels.TrainingBatchLoader(pmc_dir, model_settings, 1, 2) as loader:
+            workers = list(loader.prefetcher.workers)
+            next(iter(loader))
+            raise KeyboardInterrupt()
+    assert len(loader.prefetcher.workers) == 0
+    assert not any(worker.is_alive() for worker in workers)
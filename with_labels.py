@@ -1,5 +1,6 @@
 import numpy as np
 import itertools
+import bisect
 import logging
 import typing
 import re
@@ -10,19 +11,16 @@ import math
 import scipy.stats
 import multiset
 import collections
-
-from keras.layers import Embedding, Input, LSTM, Dense, Masking
-from keras.layers.merge import Concatenate
-from keras.layers.wrappers import TimeDistributed, Bidirectional
-from keras.models import Model
-from keras.optimizers import Adam
-from keras_contrib.layers import CRF
+import threading
+import multiprocessing
+import functools
 
 import sklearn
 import sklearn.metrics
 
 import settings
 import dataprep2
+import numpy_model
 import unicodedata
 
 
@@ -30,12 +28,24 @@ import unicodedata
 # Make Model 👯
 #
 
+# Keras is imported only where a Keras model is built or loaded, so that inference with
+# numpy_model.NumpyModel doesn't have to load TensorFlow.
+
 MAX_EMBEDDED_PAGES = 3
 
-def model_with_labels(
+def _uncompiled_model_with_labels(
     model_settings: settings.ModelSettings,
-    embeddings: dataprep2.CombinedEmbeddings
-) -> Model:
+    embeddings: dataprep2.CombinedEmbeddings,
+    initial_embeddings: bool = True
+) -> typing.Tuple["keras.models.Model", "keras_contrib.layers.CRF"]:
+    """Builds the forward graph of the model, without the loss and the optimizer. Without
+    initial_embeddings, the token embedding starts out random instead of with the glove vectors."""
+    from keras.layers import Embedding, Input, LSTM, Dense, Masking
+    from keras.layers.merge import Concatenate
+    from keras.layers.wrappers import TimeDistributed, Bidirectional
+    from keras.models import Model
+    from keras_contrib.layers import CRF
+
     PAGENO_VECTOR_SIZE = 8
 
     pageno_input = Input(name='pageno_input', shape=(None,))
@@ -60,13 +70,15 @@ def model_with_labels(
 
     token_input = Input(name='token_input', shape=(None,))
     logging.info("token_input:\t%s", token_input.shape)
+    # When we load trained weights right after this, we don't need the initial embedding matrix.
+    embedding_matrix = embeddings.matrix_for_keras() if initial_embeddings else None
     token_embedding = \
         Embedding(
             name='token_embedding',
             mask_zero=True,
             input_dim=embeddings.vocab_size()+1,    # one for the mask
             output_dim=embeddings.dimensions(),
-            weights=[embeddings.matrix_for_keras()])(token_input)
+            weights=None if embedding_matrix is None else [embedding_matrix])(token_input)
     logging.info("token_embedding:\t%s", token_embedding.shape)
 
     FONT_VECTOR_SIZE = 10
@@ -117,59 +129,433 @@ def model_with_labels(
         font_input,
         numeric_inputs
     ], outputs=crf_layer)
+    return model, crf
+
+def model_with_labels(
+    model_settings: settings.ModelSettings,
+    embeddings: dataprep2.CombinedEmbeddings,
+    initial_embeddings: bool = True
+) -> "keras.models.Model":
+    from keras.optimizers import Adam
+
+    model, crf = _uncompiled_model_with_labels(model_settings, embeddings, initial_embeddings)
     model.compile(Adam(), crf.loss_function, metrics=[crf.accuracy])
     return model
 
+def inference_model_with_labels(
+    model_settings: settings.ModelSettings,
+    embeddings: dataprep2.CombinedEmbeddings,
+    weights_filename: str
+) -> "keras.models.Model":
+    """Builds the model for prediction only, and loads the weights of a trained model into it.
+
+    The model is never compiled, so it has no loss, optimizer state, or training ops. The CRF
+    outputs the Viterbi decoding of each page."""
+    model, _ = _uncompiled_model_with_labels(model_settings, embeddings, initial_embeddings=False)
+    model.load_weights(weights_filename)
+    model._make_predict_function()
+    return model
+
+def save_inference_model(model: "keras.models.Model", filename: str):
+    """Saves the architecture and weights of an inference model into one file, so that
+    load_inference_model() can load it without rebuilding the model from the settings."""
+    model.save(filename, overwrite=True, include_optimizer=False)
+
+def load_inference_model(filename: str) -> "keras.models.Model":
+    from keras.models import load_model
+    from keras_contrib.layers import CRF
+
+    model = load_model(filename, custom_objects={"CRF": CRF}, compile=False)
+    model._make_predict_function()
+    return model
+
 
 #
 # Prepare the Data 🐙
 #
 
-def featurize_page(doc: dataprep2.Document, page: dataprep2.Page):
-    page_inputs = np.full(
-        (len(page.tokens),),
-        min(MAX_EMBEDDED_PAGES, page.page_number) + 1,    # one for keras' mask
-        dtype=np.int32)
-    page_from_back_inputs = np.full(
-        (len(page.tokens),),
-        min(MAX_EMBEDDED_PAGES, len(doc.pages) - page.page_number - 1) + 1,    # one for keras' mask
-        dtype=np.int32)
-    token_inputs = page.token_hashes
-    font_inputs = page.font_hashes
-    numeric_inputs = page.scaled_numeric_features[:,:17] # DEBUG: put back the vision features
+NUMERIC_FEATURE_COUNT = 17    # DEBUG: put back the vision features
+NUMERIC_INPUT_COUNT = NUMERIC_FEATURE_COUNT + 1    # plus the numeric page number feature
+
+class BatchBuffers(object):
+    """Flat arrays that hold the inputs and outputs of batches of up to `capacity` tokens
+
+    A batch of page_count pages with max_length tokens each is a contiguous view of the first
+    page_count * max_length tokens of each array. Buffers for inference leave out the labels.
+
+    If shared_memory is given, the arrays live in it instead of being allocated. It has to have
+    at least shared_memory_size() bytes. Buffers in shared memory are passed to child processes
+    as the shared memory itself, not as a copy."""
+
+    def __init__(self, capacity: int, include_labels: bool = True, shared_memory=None):
+        self.capacity = capacity
+        self.include_labels = include_labels
+        self.shared_memory = shared_memory
+
+        offset = 0
+        def allocate(shape, dtype):
+            nonlocal offset
+            if shared_memory is None:
+                return np.empty(shape, dtype=dtype)
+            a = np.frombuffer(
+                shared_memory,
+                dtype=dtype,
+                count=int(np.prod(shape)),
+                offset=offset).reshape(shape)
+            offset += a.nbytes
+            return a
+
+        self.page_inputs = allocate((capacity,), np.int32)
+        self.page_from_back_inputs = allocate((capacity,), np.int32)
+        self.token_inputs = allocate((capacity,), np.uint32)
+        self.font_inputs = allocate((capacity,), np.uint32)
+        self.numeric_inputs = allocate((capacity, NUMERIC_INPUT_COUNT), np.float32)
+        if include_labels:
+            self.labels_one_hot = allocate(
+                (capacity, len(dataprep2.POTENTIAL_LABELS)),
+                np.float32)
+        else:
+            self.labels_one_hot = None
+
+    @staticmethod
+    def shared_memory_size(capacity: int, include_labels: bool = True) -> int:
+        values_per_token = 4 + NUMERIC_INPUT_COUNT
+        if include_labels:
+            values_per_token += len(dataprep2.POTENTIAL_LABELS)
+        return capacity * values_per_token * 4    # all the arrays have four byte values
+
+    def __reduce__(self):
+        if self.shared_memory is None:
+            return super().__reduce__()
+        return BatchBuffers, (self.capacity, self.include_labels, self.shared_memory)
+
+    def views(self, page_count: int, max_length: int):
+        token_count = page_count * max_length
+        assert token_count <= self.capacity
+
+        def view(a):
+            return a[:token_count].reshape((page_count, max_length) + a.shape[1:])
+
+        inputs = [
+            view(self.page_inputs),
+            view(self.page_from_back_inputs),
+            view(self.token_inputs),
+            view(self.font_inputs),
+            view(self.numeric_inputs)
+        ]
+        if self.labels_one_hot is None:
+            return inputs, None
+        return inputs, view(self.labels_one_hot)
+
+class BatchBufferPool(object):
+    """Hands out BatchBuffers, and takes them back once a batch is no longer needed
+
+    Batches are usually consumed on a different thread than the one assembling them, and a few of
+    them are queued up in between, so buffers go back into the pool only when the consumer calls
+    release() with the batch inputs."""
+
+    def __init__(self, capacity: int, include_labels: bool = True):
+        self.capacity = capacity
+        self.include_labels = include_labels
+        self.free = collections.deque()
+        self.in_use = {}
+        self.lock = threading.Lock()
+
+    def get(self, token_count: int) -> BatchBuffers:
+        with self.lock:
+            for _ in range(len(self.free)):
+                buffers = self.free.popleft()
+                if buffers.capacity >= token_count:
+                    return buffers
+                self.free.append(buffers)
+        return BatchBuffers(max(self.capacity, token_count), self.include_labels)
+
+    def track(self, batch_inputs: typing.List[np.ndarray], buffers: BatchBuffers):
+        with self.lock:
+            self.in_use[id(batch_inputs[0])] = buffers
+
+    def release(self, batch_inputs: typing.List[np.ndarray]):
+        """Returns the buffers of a batch to the pool. Neither the inputs nor the outputs of the
+        batch must be used after this."""
+        with self.lock:
+            buffers = self.in_use.pop(id(batch_inputs[0]))
+            self.free.append(buffers)
+
+def _featurize_page_into(
+    doc: dataprep2.Document,
+    page: dataprep2.Page,
+    inputs: typing.List[np.ndarray],
+    labels_one_hot: typing.Optional[np.ndarray],
+    row: int
+):
+    """Writes the features of a page into one row of the batch arrays, and zeroes the padding.
+    Pass None for labels_one_hot to write only the inputs."""
+    page_inputs, page_from_back_inputs, token_inputs, font_inputs, numeric_inputs = inputs
+    length = page.token_count
+
+    page_inputs[row,:length] = min(MAX_EMBEDDED_PAGES, page.page_number) + 1    # one for keras' mask
+    page_inputs[row,length:] = 0
+    page_from_back_inputs[row,:length] = \
+        min(MAX_EMBEDDED_PAGES, doc.page_count - page.page_number - 1) + 1    # one for keras' mask
+    page_from_back_inputs[row,length:] = 0
+    token_inputs[row,:length] = page.token_hashes
+    token_inputs[row,length:] = 0
+    font_inputs[row,:length] = page.font_hashes
+    font_inputs[row,length:] = 0
+    numeric_inputs[row,:length,:NUMERIC_FEATURE_COUNT] = \
+        page.scaled_numeric_features[:,:NUMERIC_FEATURE_COUNT]
 
     # add the numeric page number feature
-    if len(doc.pages) <= 1:
-        numeric_page_number_feature = np.full(
-            (len(page.tokens), 1),
-            0.0,
-            dtype=np.float32)
+    if doc.page_count <= 1:
+        numeric_inputs[row,:length,NUMERIC_FEATURE_COUNT] = 0.0
     else:
-        numeric_page_number_feature = np.full(
-            (len(page.tokens), 1),
-            (page.page_number / (len(doc.pages) - 1)) - 0.5,
-            dtype=np.float32)
-    numeric_inputs = np.concatenate((numeric_inputs, numeric_page_number_feature), axis=-1)
-
-    labels_as_ints = page.labels
-    labels_one_hot = np.zeros(
-        shape=(len(page.tokens), len(dataprep2.POTENTIAL_LABELS)),
-        dtype=np.float32)
+        numeric_inputs[row,:length,NUMERIC_FEATURE_COUNT] = \
+            (page.page_number / (doc.page_count - 1)) - 0.5
+    numeric_inputs[row,length:,:] = 0.0
+
+    if labels_one_hot is None:
+        return
+    labels_one_hot[row,:,:] = 0.0
     if page.labels is not None:
         try:
-            labels_one_hot[np.arange(len(page.tokens)),labels_as_ints] = 1
+            labels_one_hot[row,np.arange(length),page.labels] = 1
         except:
             logging.error("Error in document %s", doc.doc_id)
             raise
 
-    return (page_inputs, page_from_back_inputs, token_inputs, font_inputs, numeric_inputs), labels_one_hot
+def featurize_page(doc: dataprep2.Document, page: dataprep2.Page):
+    inputs, labels_one_hot = BatchBuffers(page.token_count).views(1, page.token_count)
+    _featurize_page_into(doc, page, inputs, labels_one_hot, 0)
+    return tuple(page_input[0] for page_input in inputs), labels_one_hot[0]
+
+# How many tokens neighboring windows share, so that every token sees some context on both sides
+WINDOW_OVERLAP = 128
+
+def window_bounds(
+    token_count: int,
+    window_size: int,
+    window_overlap: int = WINDOW_OVERLAP
+) -> typing.List[typing.Tuple[int, int]]:
+    """Returns (first, one past last) token indices of overlapping windows that cover a page"""
+    assert window_size > window_overlap
+    if token_count <= window_size:
+        return [(0, token_count)]
+    stride = window_size - window_overlap
+    bounds = []
+    first = 0
+    while True:
+        one_past_last = min(first + window_size, token_count)
+        bounds.append((first, one_past_last))
+        if one_past_last >= token_count:
+            return bounds
+        first += stride
+
+class PageWindow(object):
+    """A window of tokens from a page that is too long to go into a batch whole. It has the fields
+    of dataprep2.Page that batching needs."""
+
+    __slots__ = ["page", "window_index", "bounds"]
+
+    def __init__(self, page: dataprep2.Page, window_index: int, bounds: typing.List[typing.Tuple[int, int]]):
+        self.page = page
+        self.window_index = window_index
+        self.bounds = bounds
+
+    def __repr__(self):
+        return "PageWindow(%d, %d, ...)" % (self.page.page_number, self.window_index)
+
+    @property
+    def page_number(self) -> int:
+        return self.page.page_number
+
+    @property
+    def first_token_index(self) -> int:
+        return self.bounds[self.window_index][0]
+
+    @property
+    def token_count(self) -> int:
+        first, one_past_last = self.bounds[self.window_index]
+        return one_past_last - first
+
+    def _window(self, a: typing.Optional[np.ndarray]) -> typing.Optional[np.ndarray]:
+        if a is None:
+            return None
+        first, one_past_last = self.bounds[self.window_index]
+        return a[first:one_past_last]
+
+    @property
+    def token_hashes(self) -> np.ndarray:
+        return self._window(self.page.token_hashes)
+
+    @property
+    def font_hashes(self) -> np.ndarray:
+        return self._window(self.page.font_hashes)
+
+    @property
+    def scaled_numeric_features(self) -> np.ndarray:
+        return self._window(self.page.scaled_numeric_features)
+
+    @property
+    def labels(self) -> typing.Optional[np.ndarray]:
+        return self._window(self.page.labels)
+
+def windows_for_page(page: dataprep2.Page, window_size: typing.Optional[int], window_overlap: int = WINDOW_OVERLAP):
+    """Returns the page itself if it fits into window_size tokens, and PageWindows otherwise"""
+    if window_size is None or page.token_count <= window_size:
+        return [page]
+    bounds = window_bounds(page.token_count, window_size, window_overlap)
+    return [PageWindow(page, window_index, bounds) for window_index in range(len(bounds))]
+
+def stitch_windows(
+    bounds: typing.List[typing.Tuple[int, int]],
+    window_predictions: typing.List[np.ndarray]
+) -> np.ndarray:
+    """Puts the predictions for the windows of a page back together. Where two windows overlap,
+    each takes the half of the overlap that's closer to its own center, so every token gets its
+    prediction from the window where it has the most context."""
+    token_count = bounds[-1][1]
+    result = np.empty(
+        (token_count,) + window_predictions[0].shape[1:],
+        dtype=window_predictions[0].dtype)
+    cut = 0
+    for window_index, ((first, one_past_last), predictions) in enumerate(zip(bounds, window_predictions)):
+        if window_index + 1 < len(bounds):
+            next_cut = (bounds[window_index + 1][0] + one_past_last) // 2
+        else:
+            next_cut = one_past_last
+        result[cut:next_cut] = predictions[cut - first:next_cut - first]
+        cut = next_cut
+    return result
 
 def page_length_for_doc_page_pair(doc_page_pair) -> int:
-    return len(doc_page_pair[1].tokens)
-
-def batch_from_page_group(model_settings: settings.ModelSettings, page_group):
+    return doc_page_pair[1].token_count
+
+def padded_page_length(length: int, length_buckets: typing.Optional[typing.List[int]]) -> int:
+    """Rounds a page length up to the next bucket boundary. Lengths beyond the last boundary, or
+    without any buckets, stay as they are."""
+    if not length_buckets:
+        return length
+    bucket_index = bisect.bisect_left(length_buckets, length)
+    if bucket_index >= len(length_buckets):
+        return length
+    return length_buckets[bucket_index]
+
+def length_buckets_from_histogram(
+    length_histogram: typing.List[typing.Tuple[int, int]],
+    bucket_count: int
+) -> typing.List[int]:
+    """Chooses up to bucket_count boundaries from a sorted list of (page length, page count), so
+    that every bucket holds about the same number of pages. The last boundary is the longest
+    length in the histogram."""
+    total_page_count = sum(count for _, count in length_histogram)
+    boundaries = []
+    cumulative_page_count = 0
+    next_quantile = 1
+    for length, count in length_histogram:
+        cumulative_page_count += count
+        while next_quantile <= bucket_count and \
+                cumulative_page_count * bucket_count >= next_quantile * total_page_count:
+            if len(boundaries) <= 0 or boundaries[-1] != length:
+                boundaries.append(length)
+            next_quantile += 1
+    return boundaries
+
+class PaddingStats(object):
+    """Counts how many tokens of the batches are padding, per length bucket"""
+
+    def __init__(self, length_buckets: typing.Optional[typing.List[int]]):
+        self.length_buckets = length_buckets or []
+        # bucket index -> [batches, pages, tokens, padded tokens]
+        self.bucket_to_counts = collections.defaultdict(lambda: [0, 0, 0, 0])
+        self.shapes = set()
+        self.batch_count = 0
+
+    def add(self, page_lengths: typing.List[int]):
+        max_length = max(page_lengths)
+        padded_length = padded_page_length(max_length, self.length_buckets)
+        counts = self.bucket_to_counts[bisect.bisect_left(self.length_buckets, max_length)]
+        counts[0] += 1
+        counts[1] += len(page_lengths)
+        counts[2] += sum(page_lengths)
+        counts[3] += padded_length * len(page_lengths)
+        self.shapes.add((len(page_lengths), padded_length))
+        self.batch_count += 1
+
+    def log(self):
+        total_counts = [0, 0, 0, 0]
+        for bucket_index, counts in sorted(self.bucket_to_counts.items()):
+            if bucket_index < len(self.length_buckets):
+                bucket_name = "<= %d" % self.length_buckets[bucket_index]
+            elif len(self.length_buckets) > 0:
+                bucket_name = "> %d" % self.length_buckets[-1]
+            else:
+                bucket_name = "unbucketed"
+            batches, pages, tokens, padded_tokens = counts
+            logging.info(
+                "Length bucket %s: %d batches, %d pages, %d tokens, %.2f%% waste",
+                bucket_name,
+                batches,
+                pages,
+                tokens,
+                100.0 * (padded_tokens - tokens) / padded_tokens)
+            total_counts = [total + count for total, count in zip(total_counts, counts)]
+        batches, pages, tokens, padded_tokens = total_counts
+        if batches > 0:
+            logging.info(
+                "%d batches in %d distinct shapes, %.2f%% waste overall",
+                batches,
+                len(self.shapes),
+                100.0 * (padded_tokens - tokens) / padded_tokens)
+
+def padded_page_lengths(
+    page_lengths: np.ndarray,
+    length_buckets: typing.Optional[typing.List[int]]
+) -> np.ndarray:
+    """padded_page_length() for a whole array of page lengths"""
+    if not length_buckets:
+        return page_lengths
+    length_buckets = np.asarray(length_buckets, dtype=page_lengths.dtype)
+    bucket_indices = length_buckets.searchsorted(page_lengths)
+    return np.where(
+        bucket_indices < len(length_buckets),
+        length_buckets[np.minimum(bucket_indices, len(length_buckets) - 1)],
+        page_lengths)
+
+def page_groups_for_sorted_lengths(
+    page_lengths: np.ndarray,
+    desired_slice_size: int,
+    length_buckets: typing.Optional[typing.List[int]] = None,
+    rng: typing.Optional[random.Random] = None
+) -> typing.List[typing.Tuple[int, int]]:
+    """Cuts pages that are sorted by padded length into contiguous ranges, each of which fits into
+    a batch of desired_slice_size tokens, with pages padded up to length_buckets if it's given.
+    Pages that are bigger than that get a range of their own.
+
+    If rng is given, the first range gets a random number of the pages that would fit, so that
+    the cut points between all the ranges move every time."""
+    groups = []
+    first = 0
+    while first < len(page_lengths):
+        one_past_last = first + 1
+        while one_past_last < len(page_lengths) and \
+                (one_past_last + 1 - first) * \
+                padded_page_length(int(page_lengths[one_past_last]), length_buckets) <= \
+                desired_slice_size:
+            one_past_last += 1
+        if rng is not None and len(groups) <= 0:
+            one_past_last = first + rng.randint(1, one_past_last - first)
+        groups.append((first, one_past_last))
+        first = one_past_last
+    return groups
+
+def _assemble_batch(
+    page_group,
+    buffer_pool: typing.Optional[BatchBufferPool],
+    include_labels: bool,
+    length_buckets: typing.Optional[typing.List[int]]
+):
     page_lengths = list(map(page_length_for_doc_page_pair, page_group))
-    max_length = max(page_lengths)
+    max_length = padded_page_length(max(page_lengths), length_buckets)
 
     padded_token_count = max_length * len(page_group)
     unpadded_token_count = sum(page_lengths)
@@ -181,67 +567,108 @@ def batch_from_page_group(model_settings: settings.ModelSettings, page_group):
         padded_token_count,
         waste * 100)
 
-    batch_inputs = [[], [], [], [], []]
-    batch_outputs = []
+    if buffer_pool is None:
+        buffers = BatchBuffers(padded_token_count, include_labels)
+    else:
+        buffers = buffer_pool.get(padded_token_count)
+        assert buffers.include_labels or not include_labels
+    batch_inputs, batch_outputs = buffers.views(len(page_group), max_length)
+    if not include_labels:
+        batch_outputs = None
 
-    for doc, page in page_group:
-        page_length = len(page.tokens)
-        required_padding = max_length - page_length
-        featurized_input, featurized_output = featurize_page(doc, page)
+    for row, (doc, page) in enumerate(page_group):
+        _featurize_page_into(doc, page, batch_inputs, batch_outputs, row)
 
-        def pad1D(a):
-            return np.pad(a, (0, required_padding), mode='constant')
+    if buffer_pool is not None:
+        buffer_pool.track(batch_inputs, buffers)
+    return batch_inputs, batch_outputs
 
-        featurized_input = (
-            pad1D(featurized_input[0]),
-            pad1D(featurized_input[1]),
-            pad1D(featurized_input[2]),
-            pad1D(featurized_input[3]),
-            np.pad(featurized_input[4], ((0, required_padding), (0, 0)), mode='constant')
-        )
-        featurized_output = np.pad(
-            featurized_output, ((0, required_padding), (0, 0)), mode='constant'
-        )
+def batch_from_page_group(
+    model_settings: settings.ModelSettings,
+    page_group,
+    buffer_pool: typing.Optional[BatchBufferPool] = None,
+    length_buckets: typing.Optional[typing.List[int]] = None
+):
+    """Assembles inputs and one-hot labels for a group of pages. If buffer_pool is given, the
+    batch is assembled in buffers from the pool, and the caller has to hand the batch inputs to
+    buffer_pool.release() when it's done with the batch. If length_buckets is given, the batch is
+    padded to the bucket boundary above its longest page."""
+    return _assemble_batch(page_group, buffer_pool, True, length_buckets)
 
-        for index, input in enumerate(featurized_input):
-            batch_inputs[index].append(input)
-        batch_outputs.append(featurized_output)
+def inputs_from_page_group(
+    model_settings: settings.ModelSettings,
+    page_group,
+    buffer_pool: typing.Optional[BatchBufferPool] = None,
+    length_buckets: typing.Optional[typing.List[int]] = None
+) -> typing.List[np.ndarray]:
+    """Like batch_from_page_group(), but assembles only the model inputs, for inference"""
+    batch_inputs, _ = _assemble_batch(page_group, buffer_pool, False, length_buckets)
+    return batch_inputs
 
-    batch_inputs = list(map(np.stack, batch_inputs))
-    batch_outputs = np.stack(batch_outputs)
 
-    return batch_inputs, batch_outputs
+class PagePool:
+    """A pool of (doc, page) pairs, kept in buckets by page length
 
+    Pages of the same length stay in insertion order, so iterating over the buckets from short to
+    long gives the same order as a stable sort of the whole pool by page length.
 
-class PagePool:
-    def __init__(self):
-        self.pool = []
+    If length_buckets is set, slices are sized for pages padded up to the bucket boundaries."""
+
+    def __init__(self, length_buckets: typing.Optional[typing.List[int]] = None):
+        self.length_buckets = length_buckets
+        self.lengths = []   # sorted list of the page lengths that have a bucket
+        self.buckets = {}   # page length -> list of (doc, page) in insertion order
+        self.cumulative_counts = None   # pages in the buckets up to each length, built on demand
+        self.page_count = 0
         self.random = random.Random()
         self.random.seed(1337)
 
     def add(self, doc: dataprep2.Document, page: dataprep2.Page):
-        assert len(page.tokens) > 0
-        self.pool.append((doc, page))
+        assert page.token_count > 0
+        bucket = self.buckets.get(page.token_count)
+        if bucket is None:
+            bucket = []
+            self.buckets[page.token_count] = bucket
+            bisect.insort(self.lengths, page.token_count)
+        bucket.append((doc, page))
+        self.cumulative_counts = None
+        self.page_count += 1
 
     def __len__(self) -> int:
-        return len(self.pool)
-
-    @staticmethod
-    def _prepare_slice_for_release(slice, desired_slice_size: int):
+        return self.page_count
+
+    def length_histogram(self) -> typing.List[typing.Tuple[int, int]]:
+        """Returns (page length, page count) for all pages in the pool, sorted by length"""
+        return [(length, len(self.buckets[length])) for length in self.lengths]
+
+    def _take(self, length: int, start: int, count: int):
+        """Removes count pages from the bucket for the given length, starting at start"""
+        bucket = self.buckets[length]
+        taken = bucket[start:start + count]
+        del bucket[start:start + count]
+        if len(bucket) <= 0:
+            del self.buckets[length]
+            del self.lengths[bisect.bisect_left(self.lengths, length)]
+        self.cumulative_counts = None
+        self.page_count -= len(taken)
+        return taken
+
+    def _prepare_slice_for_release(self, slice, desired_slice_size: int):
         slice.sort(key=page_length_for_doc_page_pair)
 
         # issue warning if the slice is bigger than it should be
         # This happens when a single page is bigger than our desired number of tokens
         # per batch.
         last_slice_doc, last_slice_page = slice[-1]
-        slice_token_count = len(slice) * len(last_slice_page.tokens)
+        slice_token_count = \
+            len(slice) * padded_page_length(last_slice_page.token_count, self.length_buckets)
         if slice_token_count > desired_slice_size:
             assert len(slice) == 1
             logging.warning(
                 "Doc %s, page %d has %d tokens, more than tokens_per_batch (%d). Batch will be too large.",
                 last_slice_doc.doc_id,
                 last_slice_page.page_number,
-                len(last_slice_page.tokens),
+                last_slice_page.token_count,
                 desired_slice_size)
 
         return slice
@@ -258,11 +685,9 @@ class PagePool:
           bias, so we select random page sizes. At test time, we don't care about bias, so we can
           use the smallest pages and thus hope to get closer to the desired slice size.
         """
-        if len(self.pool) <= 0:
+        if self.page_count <= 0:
             raise ValueError
 
-        self.pool.sort(key=page_length_for_doc_page_pair)
-
         if smallest_pages:
             slice_start_index = 0
         else:
@@ -270,77 +695,336 @@ class PagePool:
             min_slice_start_index = 0
             # The maximum slice start is harder: There have to be enough pages between the max slice
             # start and the end of the pool to fill up the slice with as many tokens as possible.
-            token_count_of_largest_page = len(self.pool[-1][1].tokens)
+            token_count_of_largest_page = padded_page_length(self.lengths[-1], self.length_buckets)
             max_slice_start_index = \
-                math.ceil(len(self.pool) - desired_slice_size / token_count_of_largest_page)
+                math.ceil(self.page_count - desired_slice_size / token_count_of_largest_page)
             # We always include the last page, even if it's too big.
-            max_slice_start_index = min(max_slice_start_index, len(self.pool) - 1)
+            max_slice_start_index = min(max_slice_start_index, self.page_count - 1)
             max_slice_start_index = max(0, max_slice_start_index)
             slice_start_index = self.random.randint(min_slice_start_index, max_slice_start_index)
 
+        # find the bucket that contains the page at slice_start_index
+        if self.cumulative_counts is None:
+            self.cumulative_counts = list(
+                itertools.accumulate(len(self.buckets[length]) for length in self.lengths))
+        first_bucket_index = bisect.bisect_right(self.cumulative_counts, slice_start_index)
+        offset_in_bucket = slice_start_index
+        if first_bucket_index > 0:
+            offset_in_bucket -= self.cumulative_counts[first_bucket_index - 1]
+
+        # Take pages from the buckets, shortest first, for as long as they fit. Since the buckets
+        # are sorted by length, the page we're adding is always the longest in the slice so far.
         slice = []
-        slice_max_token_count = 0
-        while len(self.pool) > slice_start_index:
-            next_doc, next_page = self.pool[slice_start_index]
-            new_slice_token_count = \
-                (len(slice) + 1) * max(len(next_page.tokens), slice_max_token_count)
-            if new_slice_token_count > desired_slice_size and len(slice) > 0:
+        for length in self.lengths[first_bucket_index:]:
+            available = len(self.buckets[length]) - offset_in_bucket
+            padded_length = padded_page_length(length, self.length_buckets)
+            count = max(0, desired_slice_size // padded_length - len(slice))
+            if len(slice) <= 0:
+                count = max(1, count)
+            slice.extend(self._take(length, offset_in_bucket, min(count, available)))
+            offset_in_bucket = 0
+            if count < available:
                 slice = self._prepare_slice_for_release(slice, desired_slice_size)
                 return slice
 
-            slice.append(self.pool[slice_start_index])
-            slice_max_token_count = max(slice_max_token_count, len(next_page.tokens))
-            del self.pool[slice_start_index]
-
         logging.info("Page pool empty, returning the remaining pages")
         slice = self._prepare_slice_for_release(slice, desired_slice_size)
         return slice
 
-def make_batches(
+def _window_groups(
     model_settings: settings.ModelSettings,
-    docs: typing.Generator[dataprep2.Document, None, None],
-    keep_unlabeled_pages=True
+    doc_page_pair,
+    window_size: int,
+    length_buckets: typing.Optional[typing.List[int]]
 ):
-    max_page_pool_size = model_settings.tokens_per_batch // 8    # rule of thumb
-    page_pool = PagePool()
-
-    def pages_generator():
-        for doc in docs:
-            for page in doc.get_relevant_pages():
-                # filter out pages that have no labeled tokens
-                if not keep_unlabeled_pages:
-                    if not np.any(page.labels):
-                        continue
-                yield doc, page
-    pages = pages_generator()
+    """Splits a page that's longer than window_size into groups of its windows, leaving out
+    windows without labels, since they teach the model nothing"""
+    doc, page = doc_page_pair
+    windows = [
+        (doc, window)
+        for window in windows_for_page(page, window_size)
+        if np.any(window.labels)
+    ]
+    windows_per_group = max(
+        1,
+        model_settings.tokens_per_batch // padded_page_length(window_size, length_buckets))
+    return [
+        windows[first:first + windows_per_group]
+        for first in range(0, len(windows), windows_per_group)
+    ]
 
-    # fill up the page pool first
-    for doc, page in pages:
-        page_pool.add(doc, page)
-        if len(page_pool) >= max_page_pool_size:
+def _pages_from_shards(
+    shards: typing.List[dataprep2.TrainingShard],
+    shard_indices: np.ndarray,
+    page_indices: np.ndarray
+):
+    """Reads pages from several shards, in the order of the (shard index, page index) pairs.
+    Every run of consecutive pages in a shard takes one read."""
+    order = np.lexsort((page_indices, shard_indices))
+    pages = [None] * len(page_indices)
+    run_starts = np.flatnonzero(
+        (np.diff(shard_indices[order]) != 0) | (np.diff(page_indices[order]) != 1)) + 1
+    for run in np.split(order, run_starts):
+        shard = shards[shard_indices[run[0]]]
+        first_page_index = int(page_indices[run[0]])
+        run_pages = shard.pages(first_page_index, first_page_index + len(run))
+        for position, page in zip(run, run_pages):
+            pages[position] = page
+    return pages
+
+def _page_groups_from_training_shards(
+    model_settings: settings.ModelSettings,
+    shards: typing.Iterable[dataprep2.TrainingShard],
+    rng: typing.Optional[random.Random] = None,
+    interleaved_shard_count: int = 1,
+    length_bucket_count: int = 0,
+    window_size: typing.Optional[int] = None
+):
+    """Yields (page group, length buckets) for every training batch. Since the pages in a shard
+    are sorted by length, this needs no page pool.
+
+    Shards are read interleaved_shard_count at a time, and only the page tables of the open shards
+    are in memory. Their length tables are merged before they are cut into groups, so a batch can
+    have pages from all of them. Pages of the same padded length come in a random order, and the
+    cut points between groups move randomly, so the same shards make up different batches every
+    time we read them. Shards are closed when they're used up.
+
+    If length_bucket_count is more than zero, page lengths are rounded up to that many bucket
+    boundaries, chosen from the pages of the first shards that are opened. If window_size is
+    given, pages that are longer than that are split into overlapping windows."""
+    if rng is None:
+        rng = random.Random(1337)
+    np_rng = np.random.RandomState(rng.getrandbits(32))
+    length_buckets = None
+    padding_stats = None
+    shards = iter(shards)
+    while True:
+        open_shards = list(itertools.islice(shards, interleaved_shard_count))
+        if len(open_shards) <= 0:
             break
-        elif len(page_pool) % 100 == 0:
-            logging.info(
-                "Loading up the page pool. %d / %d (%.2f%%)",
-                len(page_pool),
-                max_page_pool_size,
-                100.0 * len(page_pool) / max_page_pool_size)
-
-    # yield from the page pool
-    for doc, page in pages:
-        page_pool.add(doc, page)
 
-        if len(page_pool) >= max_page_pool_size:
-            yield batch_from_page_group(
+        if padding_stats is None:
+            if length_bucket_count > 0:
+                page_lengths = np.concatenate([shard.token_counts() for shard in open_shards])
+                if window_size is not None:
+                    page_lengths = np.minimum(page_lengths, window_size)
+                if len(page_lengths) > 0:
+                    length_histogram = list(zip(*np.unique(page_lengths, return_counts=True)))
+                    length_buckets = length_buckets_from_histogram(
+                        length_histogram,
+                        length_bucket_count)
+                    length_buckets = [int(length) for length in length_buckets]
+                    logging.info("Padding pages to length buckets %s", length_buckets)
+            padding_stats = PaddingStats(length_buckets)
+
+        page_groups = []
+        short_page_lengths = []
+        short_shard_indices = []
+        short_page_indices = []
+        for shard_index, shard in enumerate(open_shards):
+            token_counts = shard.token_counts()
+            if window_size is None:
+                short_page_count = len(token_counts)
+            else:
+                short_page_count = int(token_counts.searchsorted(window_size, side="right"))
+            short_page_lengths.append(token_counts[:short_page_count])
+            short_shard_indices.append(np.full(short_page_count, shard_index, dtype=np.int32))
+            short_page_indices.append(np.arange(short_page_count, dtype=np.int32))
+            # pages that are too long get split into windows when we read them
+            page_groups.extend(
+                (np.array([shard_index]), np.array([page_index]), True)
+                for page_index in range(short_page_count, len(token_counts)))
+
+        short_page_lengths = np.concatenate(short_page_lengths)
+        short_shard_indices = np.concatenate(short_shard_indices)
+        short_page_indices = np.concatenate(short_page_indices)
+        page_order = np.lexsort((
+            np_rng.random_sample(len(short_page_lengths)),
+            padded_page_lengths(short_page_lengths, length_buckets)))
+        page_groups.extend(
+            (
+                short_shard_indices[page_order[first:one_past_last]],
+                short_page_indices[page_order[first:one_past_last]],
+                False
+            )
+            for first, one_past_last in page_groups_for_sorted_lengths(
+                short_page_lengths[page_order],
+                model_settings.tokens_per_batch,
+                length_buckets,
+                rng))
+        rng.shuffle(page_groups)
+
+        for shard_indices, page_indices, windowed in page_groups:
+            page_group = _pages_from_shards(open_shards, shard_indices, page_indices)
+            if windowed:
+                window_groups = \
+                    _window_groups(model_settings, page_group[0], window_size, length_buckets)
+            else:
+                window_groups = [page_group]
+            for page_group in window_groups:
+                padding_stats.add(list(map(page_length_for_doc_page_pair, page_group)))
+                if padding_stats.batch_count % 1000 == 0:
+                    padding_stats.log()
+                yield page_group, length_buckets
+        for shard in open_shards:
+            shard.close()
+    if padding_stats is not None:
+        padding_stats.log()
+
+def _training_batch_messages(
+    worker_index: int,
+    worker_count: int,
+    pmc_dir: str,
+    model_settings: settings.ModelSettings,
+    epochs: int,
+    seed: int,
+    interleaved_shard_count: int,
+    length_bucket_count: int,
+    window_size: typing.Optional[int],
+    slots: typing.List[BatchBuffers],
+    free_slots: multiprocessing.Queue
+):
+    """Runs in a worker process of TrainingBatchLoader. Assembles batches from its share of the
+    training buckets into free slots, and says which slot holds which batch. Batches that are too
+    big for a slot go through the queue instead, but they still take a free slot, so that no more
+    than one batch per slot is ever in flight."""
+    def shards():
+        for epoch in range(epochs):
+            # All workers shuffle the buckets the same way, and then take their share, so the
+            # buckets go to different workers in every epoch.
+            buckets = dataprep2.buckets_for_document_set(dataprep2.DocumentSet.TRAIN)
+            random.Random(seed + epoch).shuffle(buckets)
+            logging.info("Loader worker %d starts epoch %d/%d", worker_index, epoch, epochs)
+            yield from dataprep2.training_shards(
+                pmc_dir,
                 model_settings,
-                page_pool.get_slice(model_settings.tokens_per_batch))
+                buckets[worker_index::worker_count])
 
-    # emit all leftover pages
-    while len(page_pool) > 0:
-        yield batch_from_page_group(
-            model_settings,
-            page_pool.get_slice(model_settings.tokens_per_batch))
+    rng = random.Random(seed + 1000 * (worker_index + 1))
+    for page_group, length_buckets in _page_groups_from_training_shards(
+        model_settings,
+        shards(),
+        rng,
+        interleaved_shard_count,
+        length_bucket_count,
+        window_size
+    ):
+        max_length = padded_page_length(
+            max(map(page_length_for_doc_page_pair, page_group)),
+            length_buckets)
+        slot = free_slots.get()
+        if len(page_group) * max_length > slots[slot].capacity:
+            # too big for the shared memory, so it goes through the queue
+            yield "batch", (
+                slot,
+                batch_from_page_group(model_settings, page_group, None, length_buckets))
+            continue
+        batch_inputs, batch_outputs = slots[slot].views(len(page_group), max_length)
+        for row, (doc, page) in enumerate(page_group):
+            _featurize_page_into(doc, page, batch_inputs, batch_outputs, row)
+        yield "slot", (slot, len(page_group), max_length)
+
+class TrainingBatchLoader(object):
+    """Assembles training batches from the training shards in worker processes
+
+    In every epoch, the buckets are shuffled, and every worker reads a different share of them,
+    interleaved_shard_count at a time (see _page_groups_from_training_shards()). Workers
+    assemble batches into one of prefetch_depth slots in shared memory, so at most that many
+    batches are ready ahead of the consumer. Batches that don't fit into a slot are pickled
+    instead, but they hold on to a slot all the same. The caller has to hand the inputs of every
+    batch to release() when it's done with the batch, so that the slot can take the next one.
+    If a worker fails, iterating raises its exception. stats says how long the consumer waited
+    for batches.
+
+    There can't be more workers than training buckets, so worker_count is capped at that."""
+
+    def __init__(
+        self,
+        pmc_dir: str,
+        model_settings: settings.ModelSettings,
+        epochs: int,
+        worker_count: int,
+        prefetch_depth: int = 8,
+        interleaved_shard_count: int = 4,
+        seed: int = 1337,
+        length_bucket_count: int = 0,
+        window_size: typing.Optional[int] = None
+    ):
+        bucket_count = len(dataprep2.buckets_for_document_set(dataprep2.DocumentSet.TRAIN))
+        if worker_count > bucket_count:
+            logging.warning(
+                "There are only %d training buckets, so using %d loader workers instead of %d",
+                bucket_count,
+                bucket_count,
+                worker_count)
+            worker_count = bucket_count
+        assert worker_count > 0
+
+        # Spawned workers don't inherit Keras and TensorFlow from the trainer.
+        context = multiprocessing.get_context("spawn")
+        capacity = model_settings.tokens_per_batch
+        self.slots = [
+            BatchBuffers(
+                capacity,
+                shared_memory=context.RawArray("b", BatchBuffers.shared_memory_size(capacity)))
+            for _ in range(max(prefetch_depth, worker_count))
+        ]
+        self.free_slots = context.Queue()
+        for slot in range(len(self.slots)):
+            self.free_slots.put(slot)
+        self.in_use = {}
+
+        self.prefetcher = dataprep2.Prefetcher(
+            [
+                functools.partial(
+                    _training_batch_messages,
+                    worker_index,
+                    worker_count,
+                    pmc_dir,
+                    model_settings,
+                    epochs,
+                    seed,
+                    interleaved_shard_count,
+                    length_bucket_count,
+                    window_size,
+                    self.slots,
+                    self.free_slots)
+                for worker_index in range(worker_count)
+            ],
+            maxsize=len(self.slots),
+            backend="process",
+            start_method="spawn",
+            name="Training batches")
+
+    @property
+    def stats(self) -> dataprep2.PrefetchStats:
+        return self.prefetcher.stats
+
+    def __iter__(self):
+        for kind, payload in self.prefetcher:
+            if kind == "batch":
+                slot, (batch_inputs, batch_outputs) = payload
+            else:
+                slot, page_count, max_length = payload
+                batch_inputs, batch_outputs = self.slots[slot].views(page_count, max_length)
+            self.in_use[id(batch_inputs[0])] = slot
+            yield batch_inputs, batch_outputs
+
+    def release(self, batch_inputs: typing.List[np.ndarray]):
+        """Gives the slot of a batch back to the workers. Neither the inputs nor the outputs of
+        the batch must be used after this."""
+        slot = self.in_use.pop(id(batch_inputs[0]), None)
+        if slot is not None:
+            self.free_slots.put(slot)
+
+    def close(self):
+        self.prefetcher.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 #
 # Train 🏋
@@ -363,44 +1047,70 @@ def _continuous_index_sequences_taking_gap_size_into_account(indices: np.array,
     author names right next to each other, we can't tell from the labels that they are
     two authors. We can tell if there is a big gap between the tokens though.
     """
-    for index_sequence in _continuous_index_sequences(indices):
-        yield_from = 0
-        for ii in range(0, len(index_sequence) - 1):
-            before_token_index = index_sequence[ii]
-            after_token_index = index_sequence[ii + 1]
-
-            before_left, before_right, before_top, before_bottom, before_font_size, before_space_width = \
-                page.numeric_features[before_token_index]
-            after_left, after_right, after_top, after_bottom, after_font_size, after_space_width = \
-                page.numeric_features[after_token_index]
-            space_width = max(before_space_width, after_space_width)
-
-            same_font_size = abs(before_font_size - after_font_size) <= 1.0
-            same_line = \
-                abs(before_top - after_top) <= before_font_size / 2 and \
-                abs(before_bottom - after_bottom) <= before_font_size / 2
-            big_horizontal_gap = before_right + 3 * space_width <= after_left
-
-            if same_font_size and same_line and not big_horizontal_gap:
-                continue
-            else:
-                yield index_sequence[yield_from:ii + 1]
-                yield_from = ii + 1
-        yield index_sequence[yield_from:]
+    indices = np.asarray(indices)
+    if len(indices) <= 0:
+        return []
+
+    # look at all pairs of adjacent indices at once
+    features = page.numeric_features[indices]
+    before = features[:-1]
+    after = features[1:]
+    before_left, before_right, before_top, before_bottom, before_font_size, before_space_width = \
+        (before[:,i] for i in range(6))
+    after_left, after_right, after_top, after_bottom, after_font_size, after_space_width = \
+        (after[:,i] for i in range(6))
+    space_width = np.maximum(before_space_width, after_space_width)
+
+    same_font_size = np.abs(before_font_size - after_font_size) <= 1.0
+    same_line = \
+        (np.abs(before_top - after_top) <= before_font_size / 2) & \
+        (np.abs(before_bottom - after_bottom) <= before_font_size / 2)
+    big_horizontal_gap = before_right + 3 * space_width <= after_left
+
+    continuous = np.diff(indices) == 1
+    together = continuous & same_font_size & same_line & ~big_horizontal_gap
+    return np.split(indices, np.where(~together)[0] + 1)
 
 def _longest_continuous_index_sequence(indices):
     """Given an array of indices, this returns the longest continuously increasing
     subsequence in the array."""
     return max(_continuous_index_sequences(indices), key=len)
 
-def run_model(
-    model,
-    model_settings: settings.ModelSettings,
-    vocab,
-    get_docs,
-    enabled_modes: typing.Set[str] = {"predictions", "labels"}
-):
-    def dehyphenate(tokens: typing.List[str]) -> typing.List[str]:
+class Dehyphenator(object):
+    """Removes hyphens from bib titles and venues when the word without the hyphen is in the
+    vocabulary, and the word with the hyphen isn't. Build it once when the model is loaded. It
+    remembers its decision for every pair of words it has seen."""
+
+    MAX_MEMO_SIZE = 1024 * 1024
+
+    def __init__(self, vocab):
+        self.vocab = frozenset(vocab)
+        self.pair_to_joined_word = {}
+
+    def _in_vocab(self, word: str) -> bool:
+        return word in self.vocab or word.lower() in self.vocab
+
+    def joined_word(self, before: str, after: str) -> typing.Optional[str]:
+        """Returns the word that "before - after" should become, or None if it should stay"""
+        key = (before, after)
+        try:
+            return self.pair_to_joined_word[key]
+        except KeyError:
+            pass
+
+        joined_word = None
+        # if the hyphenated word is in the vocab, keep it
+        if not self._in_vocab(before + "-" + after):
+            # if the dehyphenated word is in the vocab, remove the hyphen
+            if self._in_vocab(before + after):
+                joined_word = before + after
+
+        if len(self.pair_to_joined_word) >= self.MAX_MEMO_SIZE:
+            self.pair_to_joined_word.clear()
+        self.pair_to_joined_word[key] = joined_word
+        return joined_word
+
+    def __call__(self, tokens: typing.List[str]) -> typing.List[str]:
         tokens = list(tokens)   # If tokens is a numpy list, this fixes it.
         for index, s in reversed(list(enumerate(tokens))):
             if s != "-":
@@ -411,150 +1121,340 @@ def run_model(
             index_after = index + 1
             if index_after >= len(tokens):
                 continue
-            # if the hyphenated word is in the vocab, keep it
-            hyphenated_word = tokens[index_before] + "-" + tokens[index_after]
-            if hyphenated_word in vocab or hyphenated_word.lower() in vocab:
-                continue
-            dehyphenated_word = tokens[index_before] + tokens[index_after]
-            # if the dehyphenated word is in the vocab, remove the hyphen
-            if dehyphenated_word in vocab or dehyphenated_word.lower() in vocab:
-                tokens[index_before:index_before + 3] = [dehyphenated_word] # this does not work right with numpy arrays
+            joined_word = self.joined_word(tokens[index_before], tokens[index_after])
+            if joined_word is not None:
+                tokens[index_before:index_before + 3] = [joined_word] # this does not work right with numpy arrays
         return tokens
 
-    def slices_from_test_docs():
-        SLICE_SIZE = 64 * 1024  # for evaluation, we use the largest slice we can get away with
+PostprocessingPage = collections.namedtuple(
+    "PostprocessingPage", [
+        "page_number",
+        "mode_to_predictions",  # mode -> label id for every token on the page
+        "tokens",
+        "font_hashes",
+        "numeric_features"
+    ]
+)
 
-        page_pool = PagePool()
+def _postprocessing_page(page: dataprep2.Page, mode_to_predictions) -> PostprocessingPage:
+    """Copies out the parts of a page that post-processing needs, so it can go to another process"""
+    return PostprocessingPage(
+        page.page_number,
+        mode_to_predictions,
+        np.asarray(page.tokens),
+        np.asarray(page.font_hashes),
+        np.asarray(page.numeric_features))
+
+def _postprocess_document(
+    pages: typing.List[PostprocessingPage],
+    enabled_modes: typing.Set[str],
+    dehyphenate: Dehyphenator
+):
+    """Finds title, authors and bibs in the predictions for the pages of a document"""
+    mode_to_results = {}
+
+    for mode in enabled_modes:
+        predicted_title = np.empty(shape=(0,), dtype=np.unicode)
+        predicted_authors = []
+        predicted_bibs = []
+
+        for page in pages:
+            page_predictions = page.mode_to_predictions[mode]
+
+            # find predicted titles
+            indices_predicted_title = np.where(page_predictions == dataprep2.TITLE_LABEL)[0]
+            if len(indices_predicted_title) > 0:
+                predicted_title_on_page = _longest_continuous_index_sequence(indices_predicted_title)
+                if len(predicted_title_on_page) > len(predicted_title):
+                    predicted_title_on_page = np.take(page.tokens, predicted_title_on_page)
+                    predicted_title = predicted_title_on_page
+
+            # find predicted authors
+            indices_predicted_author = np.where(page_predictions == dataprep2.AUTHOR_LABEL)[0]
+            # authors must all be in the same font
+            if len(indices_predicted_author) > 0:
+                author_fonts_on_page = np.take(page.font_hashes, indices_predicted_author)
+                author_fonts_on_page, author_font_counts_on_page = \
+                    np.unique(author_fonts_on_page, return_counts=True)
+                author_font_on_page = author_fonts_on_page[np.argmax(author_font_counts_on_page)]
+                indices_predicted_author = \
+                    [i for i in indices_predicted_author if page.font_hashes[i] == author_font_on_page]
+            # authors must all come from the same page
+            predicted_authors_on_page = [
+                np.take(page.tokens, index_sequence)
+                for index_sequence in _continuous_index_sequences_taking_gap_size_into_account(indices_predicted_author, page)
+            ]
+            if len(predicted_authors_on_page) > len(predicted_authors):
+                predicted_authors = predicted_authors_on_page
+
+            # find predicted bibs
+            BIB_LABELS = {
+                dataprep2.BIBTITLE_LABEL,
+                dataprep2.BIBAUTHOR_LABEL,
+                dataprep2.BIBVENUE_LABEL,
+                dataprep2.BIBYEAR_LABEL
+            }
+
+            # find all sections of text with bib labels, and put them into a single list
+            bib_index_sequences = []
+            for bib_label in BIB_LABELS:
+                indices_predicted_biblabel = np.where(page_predictions == bib_label)[0]
+                for index_sequence in _continuous_index_sequences(indices_predicted_biblabel):
+                    bib_index_sequences.append((index_sequence, bib_label))
+            # order the list by starting position
+            bib_index_sequences.sort(key=lambda x: x[0][0])
+
+            # go through the index sequences one by one. start a new bib entry when we see the same
+            # bib field again. concatenate if we see the same field twice.
+            bib_fields = {}
+            last_bib_field = None
+            for index_sequence, field in bib_index_sequences:
+                if field in bib_fields and field != last_bib_field:
+                    predicted_bibs.append((
+                        bib_fields.get(dataprep2.BIBTITLE_LABEL, None),
+                        bib_fields.get(dataprep2.BIBAUTHOR_LABEL, []),
+                        bib_fields.get(dataprep2.BIBVENUE_LABEL, None),
+                        bib_fields.get(dataprep2.BIBYEAR_LABEL, None),
+                    ))
+                    bib_fields = {}
+
+                bib_field_string = list(np.take(page.tokens, index_sequence))
+                if field in {dataprep2.BIBTITLE_LABEL, dataprep2.BIBVENUE_LABEL}:
+                    bib_field_string = dehyphenate(bib_field_string)
+                bib_field_string = " ".join(bib_field_string)
+
+                if field == dataprep2.BIBAUTHOR_LABEL:
+                    bib_fields[field] = bib_fields.get(field, [])
+                    bib_fields[field].append(bib_field_string)
+                else:
+                    bib_fields[field] = (bib_fields.get(field, "") + " " + bib_field_string).strip()
+                last_bib_field = field
+            if len(bib_fields) > 0:
+                predicted_bibs.append((
+                    bib_fields.get(dataprep2.BIBTITLE_LABEL, None),
+                    bib_fields.get(dataprep2.BIBAUTHOR_LABEL, []),
+                    bib_fields.get(dataprep2.BIBVENUE_LABEL, None),
+                    bib_fields.get(dataprep2.BIBYEAR_LABEL, None),
+                ))
+
+        predicted_title = " ".join(dehyphenate(predicted_title))
+        predicted_authors = [" ".join(ats) for ats in predicted_authors]
+
+        mode_to_results[mode] = (predicted_title, predicted_authors, predicted_bibs)
+
+    return mode_to_results
+
+# Worker processes get the dehyphenator once, when they start, instead of once per document.
+_postprocessing_dehyphenator = None
+
+def _install_postprocessing_dehyphenator(dehyphenate: Dehyphenator):
+    global _postprocessing_dehyphenator
+    _postprocessing_dehyphenator = dehyphenate
+
+def _postprocess_document_in_worker(pages: typing.List[PostprocessingPage], enabled_modes: typing.Set[str]):
+    return _postprocess_document(pages, enabled_modes, _postprocessing_dehyphenator)
+
+class PostprocessingPool(object):
+    """Processes that find titles, authors and bibs in the predictions of run_model(). Make one
+    when the model is loaded, and pass it to every call of run_model().
+
+    The workers are spawned, not forked, because the parent has TensorFlow loaded and threads
+    running, and forking that is asking for deadlocks."""
+
+    def __init__(self, worker_count: int, dehyphenate: Dehyphenator):
+        assert worker_count > 0
+        self.worker_count = worker_count
+        # This is a multiprocessing.Pool, not a ProcessPoolExecutor, because the executor only
+        # takes a start method and an initializer from Python 3.7 on.
+        self.pool = multiprocessing.get_context("spawn").Pool(
+            worker_count,
+            initializer=_install_postprocessing_dehyphenator,
+            initargs=(dehyphenate,))
+
+    def submit(
+        self,
+        pages: typing.List[PostprocessingPage],
+        enabled_modes: typing.Set[str]
+    ) -> "multiprocessing.pool.AsyncResult":
+        return self.pool.apply_async(_postprocess_document_in_worker, (pages, enabled_modes))
+
+    def shutdown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+def predict_label_ids(model, inputs: typing.List[np.ndarray]) -> np.ndarray:
+    """Returns the label id the model predicts for every token in a batch, as int8
+    (pages, tokens). Models that decode straight to label ids, like numpy_model.NumpyModel, do so;
+    for the Keras model, we turn the one-hot output of the CRF into ids."""
+    predict = getattr(model, "predict_label_ids", None)
+    if predict is not None:
+        return predict(inputs)
+    return model.predict_on_batch(inputs).argmax(axis=2).astype(np.int8)
+
+def run_model(
+    model,
+    model_settings: settings.ModelSettings,
+    vocab,
+    get_docs,
+    enabled_modes: typing.Set[str] = {"predictions", "labels"},
+    length_bucket_count: int = 0,
+    window_size: typing.Optional[int] = None,
+    postprocessing_pool: typing.Optional[PostprocessingPool] = None
+):
+    """Runs the model over the documents from get_docs(), and yields (doc, mode_to_results) for
+    each of them.
+
+    If length_bucket_count is more than zero, page lengths are rounded up to that many bucket
+    boundaries, chosen from the lengths of the pages in the first full page pool. That way,
+    batch shapes repeat, at the cost of some extra padding. If window_size is given, pages that
+    are longer than that are split into overlapping windows of at most window_size tokens, which
+    are batched like pages.
+    Predictions for the windows of a page are stitched back together before post-processing.
+
+    If postprocessing_pool is given, finding titles, authors and bibs in the predictions happens
+    in its worker processes, while the model works on the next batch. The pool's workers use
+    their own dehyphenator, not vocab.
+
+    vocab is either a Dehyphenator, or the vocabulary to build one from."""
+    if isinstance(vocab, Dehyphenator):
+        dehyphenate = vocab
+    else:
+        dehyphenate = Dehyphenator(vocab)
+
+    SLICE_SIZE = 64 * 1024  # for evaluation, we use the largest slice we can get away with
+
+    page_pool = PagePool()
+    padding_stats = None
+
+    def get_slice(smallest_pages: bool = False):
+        nonlocal padding_stats
+        if padding_stats is None:
+            if length_bucket_count > 0:
+                page_pool.length_buckets = \
+                    length_buckets_from_histogram(page_pool.length_histogram(), length_bucket_count)
+                logging.info("Padding pages to length buckets %s", page_pool.length_buckets)
+            padding_stats = PaddingStats(page_pool.length_buckets)
+        slice = page_pool.get_slice(SLICE_SIZE, smallest_pages)
+        padding_stats.add(list(map(page_length_for_doc_page_pair, slice)))
+        return slice
+
+    def docs_and_slices():
+        """Yields (doc, None) for every document once its pages are in the pool, and (None, slice)
+        for every slice. A document always comes before any slice with its pages in it."""
         for doc in get_docs():
             for page in doc.get_relevant_pages():
-                page_pool.add(doc, page)
+                for window in windows_for_page(page, window_size):
+                    page_pool.add(doc, window)
+            yield doc, None
 
             if len(page_pool) > SLICE_SIZE // 8:
-                yield page_pool.get_slice(SLICE_SIZE)
+                yield None, get_slice()
 
         while len(page_pool) > 0:
-            yield page_pool.get_slice(SLICE_SIZE, smallest_pages=True)
-
-    docpage_to_results = {}
-    for slice in dataprep2.threaded_generator(slices_from_test_docs()):
-        x, y = batch_from_page_group(model_settings, slice)
+            yield None, get_slice(smallest_pages=True)
 
-        mode_to_raw_predictions = {}
-        if "predictions" in enabled_modes:
-            mode_to_raw_predictions["predictions"] = model.predict_on_batch(x)
-        if "labels" in enabled_modes:
-            mode_to_raw_predictions["labels"] = y
+        if padding_stats is not None:
+            padding_stats.log()
 
-        for index, docpage in enumerate(slice):
-            doc, page = docpage
+    in_flight = collections.deque()    # (doc, async result), in the order the documents finished
 
-            key = (doc.doc_id, page.page_number)
-            assert key not in docpage_to_results
-            docpage_to_results[key] = {}
-            for mode in enabled_modes:
-                docpage_to_results[key][mode] = \
-                    mode_to_raw_predictions[mode][index,:len(page.tokens)]
+    def postprocessed_docs(wait_for_all: bool):
+        while len(in_flight) > 0:
+            doc, result = in_flight[0]
+            if not wait_for_all and not result.ready() and \
+                    len(in_flight) < 4 * postprocessing_pool.worker_count:
+                break
+            in_flight.popleft()
+            yield (doc, result.get())
 
-    for doc in get_docs():
+    def postprocess(doc: dataprep2.Document, page_number_to_results):
+        """Post-processes a document, and yields the documents that are done"""
         logging.info("Processing %s", doc.doc_id)
+        pages = [
+            _postprocessing_page(page, page_number_to_results[page.page_number])
+            for page in doc.get_relevant_pages()
+            if page.page_number in page_number_to_results
+        ]
+        if postprocessing_pool is None:
+            yield (doc, _postprocess_document(pages, enabled_modes, dehyphenate))
+        else:
+            in_flight.append((doc, postprocessing_pool.submit(pages, enabled_modes)))
+            yield from postprocessed_docs(False)
+
+    doc_id_to_page_number_to_results = {}
+    doc_id_to_outstanding_page_count = {}
+    docpage_to_window_predictions = {}  # windows of pages we haven't seen all windows for yet
+    buffer_pool = BatchBufferPool(SLICE_SIZE, include_labels=False)
+    slices = dataprep2.prefetch(docs_and_slices(), name="run_model slices")
+    try:
+        for doc, slice in slices:
+            if doc is not None:
+                outstanding_page_count = sum(1 for _ in doc.get_relevant_pages())
+                if outstanding_page_count <= 0:
+                    yield from postprocess(doc, {})
+                else:
+                    assert doc.doc_id not in doc_id_to_outstanding_page_count
+                    doc_id_to_outstanding_page_count[doc.doc_id] = outstanding_page_count
+                    doc_id_to_page_number_to_results[doc.doc_id] = {}
+                continue
 
-        mode_to_results = {}
-
-        for mode in enabled_modes:
-            predicted_title = np.empty(shape=(0,), dtype=np.unicode)
-            predicted_authors = []
-            predicted_bibs = []
-
-            for page in doc.get_relevant_pages():
-                mode_to_page_raw_predictions = \
-                    docpage_to_results.get((doc.doc_id, page.page_number), None)
-                if mode_to_page_raw_predictions is None:
-                    continue
-                page_raw_predictions = mode_to_page_raw_predictions[mode]
-                page_predictions = page_raw_predictions.argmax(axis=1)
-
-                # find predicted titles
-                indices_predicted_title = np.where(page_predictions == dataprep2.TITLE_LABEL)[0]
-                if len(indices_predicted_title) > 0:
-                    predicted_title_on_page = _longest_continuous_index_sequence(indices_predicted_title)
-                    if len(predicted_title_on_page) > len(predicted_title):
-                        predicted_title_on_page = np.take(page.tokens, predicted_title_on_page)
-                        predicted_title = predicted_title_on_page
-
-                # find predicted authors
-                indices_predicted_author = np.where(page_predictions == dataprep2.AUTHOR_LABEL)[0]
-                # authors must all be in the same font
-                if len(indices_predicted_author) > 0:
-                    author_fonts_on_page = np.take(page.font_hashes, indices_predicted_author)
-                    author_fonts_on_page, author_font_counts_on_page = \
-                        np.unique(author_fonts_on_page, return_counts=True)
-                    author_font_on_page = author_fonts_on_page[np.argmax(author_font_counts_on_page)]
-                    indices_predicted_author = \
-                        [i for i in indices_predicted_author if page.font_hashes[i] == author_font_on_page]
-                # authors must all come from the same page
-                predicted_authors_on_page = [
-                    np.take(page.tokens, index_sequence)
-                    for index_sequence in _continuous_index_sequences_taking_gap_size_into_account(indices_predicted_author, page)
-                ]
-                if len(predicted_authors_on_page) > len(predicted_authors):
-                    predicted_authors = predicted_authors_on_page
-
-                # find predicted bibs
-                BIB_LABELS = {
-                    dataprep2.BIBTITLE_LABEL,
-                    dataprep2.BIBAUTHOR_LABEL,
-                    dataprep2.BIBVENUE_LABEL,
-                    dataprep2.BIBYEAR_LABEL
-                }
-
-                # find all sections of text with bib labels, and put them into a single list
-                bib_index_sequences = []
-                for bib_label in BIB_LABELS:
-                    indices_predicted_biblabel = np.where(page_predictions == bib_label)[0]
-                    for index_sequence in _continuous_index_sequences(indices_predicted_biblabel):
-                        bib_index_sequences.append((index_sequence, bib_label))
-                # order the list by starting position
-                bib_index_sequences.sort(key=lambda x: x[0][0])
-
-                # go through the index sequences one by one. start a new bib entry when we see the same
-                # bib field again. concatenate if we see the same field twice.
-                bib_fields = {}
-                last_bib_field = None
-                for index_sequence, field in bib_index_sequences:
-                    if field in bib_fields and field != last_bib_field:
-                        predicted_bibs.append((
-                            bib_fields.get(dataprep2.BIBTITLE_LABEL, None),
-                            bib_fields.get(dataprep2.BIBAUTHOR_LABEL, []),
-                            bib_fields.get(dataprep2.BIBVENUE_LABEL, None),
-                            bib_fields.get(dataprep2.BIBYEAR_LABEL, None),
-                        ))
-                        bib_fields = {}
-
-                    bib_field_string = list(np.take(page.tokens, index_sequence))
-                    if field in {dataprep2.BIBTITLE_LABEL, dataprep2.BIBVENUE_LABEL}:
-                        bib_field_string = dehyphenate(bib_field_string)
-                    bib_field_string = " ".join(bib_field_string)
-
-                    if field == dataprep2.BIBAUTHOR_LABEL:
-                        bib_fields[field] = bib_fields.get(field, [])
-                        bib_fields[field].append(bib_field_string)
+            label_ids = None
+            if "predictions" in enabled_modes:
+                x = inputs_from_page_group(model_settings, slice, buffer_pool, page_pool.length_buckets)
+                label_ids = predict_label_ids(model, x)
+                buffer_pool.release(x)
+
+            for index, docpage in enumerate(slice):
+                doc, page = docpage
+
+                key = (doc.doc_id, page.page_number)
+                page_number_to_results = doc_id_to_page_number_to_results[doc.doc_id]
+                assert page.page_number not in page_number_to_results
+                predictions = None
+                if label_ids is not None:
+                    # copy, so that pages waiting for the rest of their document don't keep the
+                    # whole batch around
+                    predictions = label_ids[index,:page.token_count].copy()
+
+                if isinstance(page, PageWindow):
+                    window_index_to_predictions = docpage_to_window_predictions.setdefault(key, {})
+                    window_index_to_predictions[page.window_index] = predictions
+                    if len(window_index_to_predictions) < len(page.bounds):
+                        continue
+                    del docpage_to_window_predictions[key]
+                    if predictions is not None:
+                        predictions = stitch_windows(
+                            page.bounds,
+                            [window_index_to_predictions[i] for i in range(len(page.bounds))])
+                    page = page.page
+
+                mode_to_predictions = {}
+                if "predictions" in enabled_modes:
+                    mode_to_predictions["predictions"] = predictions
+                if "labels" in enabled_modes:
+                    if page.labels is None:
+                        mode_to_predictions["labels"] = np.zeros(page.token_count, dtype=np.int8)
                     else:
-                        bib_fields[field] = (bib_fields.get(field, "") + " " + bib_field_string).strip()
-                    last_bib_field = field
-                if len(bib_fields) > 0:
-                    predicted_bibs.append((
-                        bib_fields.get(dataprep2.BIBTITLE_LABEL, None),
-                        bib_fields.get(dataprep2.BIBAUTHOR_LABEL, []),
-                        bib_fields.get(dataprep2.BIBVENUE_LABEL, None),
-                        bib_fields.get(dataprep2.BIBYEAR_LABEL, None),
-                    ))
-
-            predicted_title = " ".join(dehyphenate(predicted_title))
-            predicted_authors = [" ".join(ats) for ats in predicted_authors]
+                        mode_to_predictions["labels"] = page.labels
+                page_number_to_results[page.page_number] = mode_to_predictions
 
-            mode_to_results[mode] = (predicted_title, predicted_authors, predicted_bibs)
+                # Once the last page of a document is back, we can send the document on its way.
+                doc_id_to_outstanding_page_count[doc.doc_id] -= 1
+                if doc_id_to_outstanding_page_count[doc.doc_id] <= 0:
+                    del doc_id_to_outstanding_page_count[doc.doc_id]
+                    del doc_id_to_page_number_to_results[doc.doc_id]
+                    yield from postprocess(doc, page_number_to_results)
 
-        yield (doc, mode_to_results)
+        assert len(doc_id_to_outstanding_page_count) == 0
+        yield from postprocessed_docs(True)
+    finally:
+        slices.close()
 
 EvaluationResult = collections.namedtuple(
     "EvaluationResult", [
@@ -634,7 +1534,7 @@ _unicode_quotes_re = _make_re(_unicode_quotes)
 def evaluate_model(
     model,
     model_settings: settings.ModelSettings,
-    vocab,
+    dehyphenator,
     pmc_dir: str,
     log_filename: str,
     doc_set: dataprep2.DocumentSet = dataprep2.DocumentSet.TEST,
@@ -658,6 +1558,7 @@ def evaluate_model(
                 yielded_doc_count)
         else:
             logging.info("Evaluating on %d documents", yielded_doc_count)
+        dataprep2.log_shared_resources()
 
     # these are arrays of tuples (precision, recall) to produce an SPV1-style metric
     title_prs = []
@@ -668,7 +1569,7 @@ def evaluate_model(
     bibyear_prs = []
 
     with open(log_filename, "w", encoding="UTF-8") as log_file:
-        for doc, mode_to_results in run_model(model, model_settings, vocab, test_docs):
+        for doc, mode_to_results in run_model(model, model_settings, dehyphenator, test_docs):
             log_file.write("\nDocument %s\n" % doc.doc_id)
 
             def normalize(s: str) -> str:
@@ -1008,15 +1909,20 @@ def _combined_score_from_evaluation_result(ev_result) -> float:
         return 0
 
 def train(
-    model: Model,
+    model: "keras.models.Model",
     embeddings: dataprep2.CombinedEmbeddings,
     pmc_dir: str,
     output_filename: str,
     test_doc_count: int=2000,
-    model_settings: settings.ModelSettings=settings.default_model_settings
-) -> Model:
+    model_settings: settings.ModelSettings=settings.default_model_settings,
+    loader_workers: int=4,
+    interleaved_buckets: int=4,
+    length_bucket_count: int=0,
+    window_size: typing.Optional[int]=None
+) -> "keras.models.Model":
     """Returns a trained model using the data in dir as training data"""
     best_model_filename = output_filename + ".best"
+    dehyphenator = Dehyphenator(embeddings.glove_vocab())
 
     scored_results = []
     def print_scored_results(training_time = None):
@@ -1034,92 +1940,105 @@ def train(
 
     start_time = None
     trained_batches = 0
+    data_wait_time = 0.0
+    compute_time = 0.0
 
-    # default n is very large, should to be considered as infinite
-    def documents_epochs(n=1000000):
-        for i in range(0, n):
-            logging.info('Start new epoch {}/{}'.format(i, n))
-            yield from dataprep2.documents(
-                pmc_dir,
-                model_settings,
-                document_set=dataprep2.DocumentSet.TRAIN)
-    train_docs = documents_epochs(n=8)
-    training_data = make_batches(model_settings, train_docs, keep_unlabeled_pages=False)
-
-    for batch in dataprep2.threaded_generator(training_data):
-        if trained_batches == 0:
-            # It takes a while to get here the first time, since things have to be
-            # loaded from cache, the page pool has to be filled up, and so on, so we
-            # don't officially start until we get here for the first time.
-            start_time = time.time()
-            time_at_last_eval = start_time
-
-        batch_start_time = time.time()
-        x, y = batch
-        metrics = model.train_on_batch(x, y)
-
-        trained_batches += 1
-
-        now = time.time()
-        if trained_batches % 1 == 0:
-            metric_string = ", ".join(
-                ["%s: %.3f" % x for x in zip(model.metrics_names, metrics)]
-            )
-            logging.info(
-                "Trained on %d batches in %.0f s (%.2f spb). Last batch: %.2f s. %s",
-                trained_batches,
-                now - start_time,
-                (now - start_time) / trained_batches,
-                now - batch_start_time,
-                metric_string)
-        time_since_last_eval = now - time_at_last_eval
-        EVAL_AFTER_BATCH_COUNT = 500
-        if trained_batches % EVAL_AFTER_BATCH_COUNT == 0:
-            logging.info(
-                "Trained %d batches in %.2f seconds. Triggering another eval.",
-                time_since_last_eval,
-                trained_batches)
-
-            eval_start_time = time.time()
-
-            logging.info("Writing temporary model to %s", output_filename)
-            model.save(output_filename, overwrite=True)
-            ev_result = evaluate_model(
-                model,
-                model_settings,
-                embeddings.glove_vocab(),
-                pmc_dir,
-                output_filename + ".log",
-                dataprep2.DocumentSet.TEST,
-                test_doc_count)
-            scored_results.append((now - start_time, trained_batches, ev_result))
-            print_scored_results(now - start_time)
-
-            # check if this one is better than the last one
-            combined_scores = get_combined_scores()
-            for score in combined_scores:
-                logging.debug("combined_scores: %f", score)
-            if combined_scores[-1] == max(combined_scores):
+    # The first epoch makes the training shards, the ones after that only read them.
+    with TrainingBatchLoader(
+        pmc_dir,
+        model_settings,
+        epochs=8,
+        worker_count=loader_workers,
+        interleaved_shard_count=interleaved_buckets,
+        length_bucket_count=length_bucket_count,
+        window_size=window_size
+    ) as training_data:
+        last_batch_end_time = None
+        for batch in training_data:
+            if trained_batches == 0:
+                # It takes a while to get here the first time, since things have to be
+                # loaded from cache, the training shards have to be made, and so on, so we
+                # don't officially start until we get here for the first time.
+                start_time = time.time()
+                time_at_last_eval = start_time
+
+            batch_start_time = time.time()
+            if last_batch_end_time is None:
+                batch_data_wait_time = 0.0
+            else:
+                batch_data_wait_time = batch_start_time - last_batch_end_time
+            x, y = batch
+            metrics = model.train_on_batch(x, y)
+            training_data.release(x)
+
+            trained_batches += 1
+
+            now = time.time()
+            data_wait_time += batch_data_wait_time
+            compute_time += now - batch_start_time
+            if trained_batches % 1 == 0:
+                metric_string = ", ".join(
+                    ["%s: %.3f" % x for x in zip(model.metrics_names, metrics)]
+                )
                 logging.info(
-                   "High score (%.3f)! Saving model to %s",
-                   max(combined_scores),
-                   best_model_filename)
-                model.save(best_model_filename, overwrite=True)
-
-            eval_end_time = time.time()
-            # adjust start time to ignore the time we spent evaluating
-            start_time += eval_end_time - eval_start_time
-
-            time_at_last_eval = eval_end_time
-
-            # check if we've stopped improving
-            best_score = max(combined_scores)
-            SUCCESSIVE_DOWN_EVALS = 5
-            if all([score < best_score for score in combined_scores[-SUCCESSIVE_DOWN_EVALS:]]):
+                    "Trained on %d batches in %.0f s (%.2f spb, %.0f%% waiting for data). Last batch: %.2f s, %.2f s waiting for data. %s",
+                    trained_batches,
+                    now - start_time,
+                    (now - start_time) / trained_batches,
+                    100.0 * data_wait_time / max(data_wait_time + compute_time, 1e-6),
+                    now - batch_start_time,
+                    batch_data_wait_time,
+                    metric_string)
+            time_since_last_eval = now - time_at_last_eval
+            EVAL_AFTER_BATCH_COUNT = 500
+            if trained_batches % EVAL_AFTER_BATCH_COUNT == 0:
                 logging.info(
-                    "No improvement for %d batches. Stopping training.",
-                    SUCCESSIVE_DOWN_EVALS * EVAL_AFTER_BATCH_COUNT)
-                break
+                    "Trained %d batches in %.2f seconds. Triggering another eval.",
+                    time_since_last_eval,
+                    trained_batches)
+
+                eval_start_time = time.time()
+
+                logging.info("Writing temporary model to %s", output_filename)
+                model.save(output_filename, overwrite=True)
+                ev_result = evaluate_model(
+                    model,
+                    model_settings,
+                    dehyphenator,
+                    pmc_dir,
+                    output_filename + ".log",
+                    dataprep2.DocumentSet.TEST,
+                    test_doc_count)
+                scored_results.append((now - start_time, trained_batches, ev_result))
+                print_scored_results(now - start_time)
+
+                # check if this one is better than the last one
+                combined_scores = get_combined_scores()
+                for score in combined_scores:
+                    logging.debug("combined_scores: %f", score)
+                if combined_scores[-1] == max(combined_scores):
+                    logging.info(
+                       "High score (%.3f)! Saving model to %s",
+                       max(combined_scores),
+                       best_model_filename)
+                    model.save(best_model_filename, overwrite=True)
+
+                eval_end_time = time.time()
+                # adjust start time to ignore the time we spent evaluating
+                start_time += eval_end_time - eval_start_time
+
+                time_at_last_eval = eval_end_time
+
+                # check if we've stopped improving
+                best_score = max(combined_scores)
+                SUCCESSIVE_DOWN_EVALS = 5
+                if all([score < best_score for score in combined_scores[-SUCCESSIVE_DOWN_EVALS:]]):
+                    logging.info(
+                        "No improvement for %d batches. Stopping training.",
+                        SUCCESSIVE_DOWN_EVALS * EVAL_AFTER_BATCH_COUNT)
+                    break
+
+            last_batch_end_time = time.time()
 
     if len(scored_results) > 0:
         model.load_weights(best_model_filename)
@@ -1131,7 +2050,7 @@ def train(
     final_ev = evaluate_model(
         model,
         model_settings,
-        embeddings.glove_vocab(),
+        dehyphenator,
         pmc_dir,
         output_filename + ".log",
         dataprep2.DocumentSet.VALIDATE)
@@ -1192,25 +2111,96 @@ def main():
     parser.add_argument(
         "--test-doc-count", default=2000, type=int, help="number of documents to test on"
     )
+    parser.add_argument(
+        "--loader-workers",
+        default=4,
+        type=int,
+        help="number of processes that assemble training batches"
+    )
+    parser.add_argument(
+        "--interleaved-buckets",
+        default=4,
+        type=int,
+        help="number of buckets every loader process interleaves its batches from"
+    )
+    parser.add_argument(
+        "--length-buckets",
+        default=0,
+        type=int,
+        help="pad training pages up to this many length bucket boundaries, so batch shapes repeat"
+    )
+    parser.add_argument(
+        "--window-size",
+        default=None,
+        type=int,
+        help="split training pages that are longer than this into overlapping windows"
+    )
     parser.add_argument(
         "--evaluate-only",
         action='store_true'
     )
+    parser.add_argument(
+        "--export-inference-model",
+        action='store_true',
+        help="write the model from --start-weights to the output file for inference, and exit"
+    )
+    parser.add_argument(
+        "--numpy-precisions",
+        nargs="+",
+        choices=numpy_model.PRECISIONS,
+        default=None,
+        help="with --evaluate-only, evaluate the weights from --start-weights with the NumPy model in each of these precisions, instead of with Keras"
+    )
 
     args = parser.parse_args()
+    if args.loader_workers < 1:
+        parser.error("--loader-workers has to be at least 1")
 
     model_settings = model_settings._replace(tokens_per_batch=args.tokens_per_batch)
     model_settings = model_settings._replace(glove_vectors=args.glove_vectors)
     print(model_settings)
 
     """Returns a trained model using the data in dir as training data"""
-    embeddings = dataprep2.CombinedEmbeddings(
-        dataprep2.tokenstats_for_pmc_dir(args.pmc_dir),
-        dataprep2.GloveVectors(model_settings.glove_vectors),
-        model_settings.embedded_tokens_fraction
-    )
+    embeddings = dataprep2.embeddings_for_pmc_dir(args.pmc_dir, model_settings)
+
+    if args.evaluate_only and args.numpy_precisions is not None:
+        if args.start_weights is None:
+            parser.error("--numpy-precisions needs --start-weights")
+        dehyphenator = Dehyphenator(embeddings.glove_vocab())
+        precision_to_result = collections.OrderedDict()
+        for precision in args.numpy_precisions:
+            model = numpy_model.NumpyModel.load(args.start_weights, precision)
+            precision_to_result[precision] = evaluate_model(
+                model,
+                model_settings,
+                dehyphenator,
+                args.pmc_dir,
+                "%s.%s.log" % (args.output, precision),
+                dataprep2.DocumentSet.VALIDATE,
+                args.test_doc_count)
 
-    model = model_with_labels(model_settings, embeddings)
+        print()
+        print("precision\tscore\ttitle_p\ttitle_r\tauthor_p\tauthor_r\tbibtitle_p\tbibtitle_r\tbibauthor_p\tbibauthor_r\tbibvenue_p\tbibvenue_r\tbibyear_p\tbibyear_r")
+        for precision, ev_result in precision_to_result.items():
+            print("\t".join(map(str,
+                (precision, _combined_score_from_evaluation_result(ev_result)) +
+                tuple(value for pr in ev_result for value in pr))))
+        return
+
+    if args.export_inference_model:
+        if args.start_weights is None:
+            parser.error("--export-inference-model needs --start-weights")
+        model = inference_model_with_labels(model_settings, embeddings, args.start_weights)
+        model.summary()
+        save_inference_model(model, args.output)
+        logging.info("Wrote the inference model to %s", args.output)
+        return
+
+    model = model_with_labels(
+        model_settings,
+        embeddings,
+        initial_embeddings=args.start_weights is None    # otherwise the weights overwrite them
+    )
     model.summary()
 
     if args.start_weights is not None:
@@ -1218,10 +2208,11 @@ def main():
         model.load_weights(args.start_weights)
 
     if args.evaluate_only:
+        dehyphenator = Dehyphenator(embeddings.glove_vocab())
         evaluate_model(
             model,
             model_settings,
-            embeddings.glove_vocab(),
+            dehyphenator,
             args.pmc_dir,
             args.output + ".log",
             dataprep2.DocumentSet.VALIDATE,
@@ -1235,7 +2226,11 @@ def main():
             args.pmc_dir,
             args.output,
             args.test_doc_count,
-            model_settings)
+            model_settings,
+            args.loader_workers,
+            args.interleaved_buckets,
+            args.length_buckets,
+            args.window_size)
 
         model.save(args.output, overwrite=True)
 